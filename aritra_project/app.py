@@ -1,26 +1,32 @@
 import torch
 import matplotlib.pyplot as plt
-from data_loader import loaders
+from data_loader import loaders, all_views
 from network import UNet
+from distributed import get_device
+from compiled import inference_model
 
-def my_app():
+def my_app(views=all_views, compiled=False, head='conv', width=1.0):
 
     batch_size_app = 1
-    loader_ap = loaders(batch_size_app, 2)
+    loader_ap = loaders(batch_size_app, 2, views=views)
 
-    output = UNet()
-    output.cuda()
+    device = get_device()
+    output = UNet(in_channels=len(views), width=width, head=head)
+    output.to(device)
 
     #output.load_state_dict(torch.load('/home/daisylabs/aritra_project/results/output.pth'))
 
-    output.load_state_dict(torch.load('/home/daisylabs/aritra_project/results/output_best.pth'))
+    output.load_state_dict(torch.load('/home/daisylabs/aritra_project/results/output_best.pth', map_location=device))
 
     output.eval()
 
+    if compiled:
+        output = inference_model(output)
+
     with torch.set_grad_enabled(False):
         for u, (inputs, targets) in enumerate(loader_ap):
             if (u == 0):
-                inputs = inputs.reshape((batch_size_app, 3, 256, 256))
+                inputs = inputs.reshape((batch_size_app, len(views), 256, 256)).to(device)
                 targets = targets.reshape((batch_size_app, 256, 256, 256))
 
                 out_1, out_2 = output(inputs)
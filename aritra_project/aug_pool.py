@@ -0,0 +1,140 @@
+import json
+import os
+import random
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import Dataset
+from augment import VolumeAugment
+from drr_projector import project
+from manifest import load_manifest, file_path
+
+#offline pool of augmented (DRR, CT) pairs, K variants per patient, refreshed a fraction at a time
+
+all_views = ('frontal', 'lateral', 'top')
+
+
+def load_base(root, patient):
+    manifest = load_manifest(root)
+    info = next(p['ct'] for p in manifest['patients'] if p['id'] == patient)
+    return np.load(file_path(manifest, info)).astype('float32')
+
+
+def make_variant(targets, aug=None, views=all_views):
+    # the same work ImageData does per training item: augment the volume, then project it
+    aug = aug or VolumeAugment(size=targets.shape[-2:])
+    targets, _ = aug(torch.from_numpy(targets))
+    inputs = project(targets, views)
+    return inputs.numpy(), targets.numpy()
+
+
+def entry_path(pool_dir, patient, k):
+    return os.path.join(pool_dir, patient, '%d.npz' % k)
+
+
+def _init_worker():
+    # one pool process per core; keep torch from spawning its own thread team in each of them
+    torch.set_num_threads(1)
+
+
+def _write_entries(root, pool_dir, patient, ks, dtype, views, seed):
+    torch.manual_seed(seed)
+    targets = load_base(root, patient)
+    os.makedirs(os.path.join(pool_dir, patient), exist_ok=True)
+    for k in ks:
+        inputs, aug_targets = make_variant(targets, views=views)
+        path = entry_path(pool_dir, patient, k)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, inputs=inputs.astype(dtype), targets=aug_targets.astype(dtype))
+        # readers in DataLoader workers only ever see complete files
+        os.replace(tmp, path)
+    return patient, list(ks)
+
+
+def build_pool(root, pool_dir, variants=8, workers=None, dtype='float16', overwrite=False, views=all_views):
+    patients = [p['id'] for p in load_manifest(root)['patients']]
+    os.makedirs(pool_dir, exist_ok=True)
+
+    # entries built for other views or another dtype cannot be reused
+    meta_path = os.path.join(pool_dir, 'pool.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('views') != list(views) or meta.get('dtype') != dtype:
+            overwrite = True
+
+    jobs = []
+    for patient in patients:
+        ks = [k for k in range(variants) if overwrite or not os.path.exists(entry_path(pool_dir, patient, k))]
+        if ks:
+            jobs.append((patient, ks))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(_write_entries, root, pool_dir, patient, ks, dtype, views,
+                                   random.randrange(2 ** 31))
+                   for patient, ks in jobs]
+        for n, future in enumerate(futures):
+            patient, ks = future.result()
+            print('pool', n + 1, 'of', len(futures), '-', patient, '-', len(ks), 'variants')
+
+    with open(meta_path, 'w') as f:
+        json.dump({'root': root, 'patients': patients, 'variants': variants, 'dtype': dtype,
+                   'views': list(views)}, f)
+
+    return pool_dir
+
+
+class PoolRefresher:
+    def __init__(self, pool_dir, fraction=0.1, workers=2):
+        with open(os.path.join(pool_dir, 'pool.json')) as f:
+            self.meta = json.load(f)
+        self.pool_dir = pool_dir
+        self.fraction = fraction
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        self.pending = []
+
+    def step(self):
+        # called once per epoch: regenerate a random fraction of entries in the background
+        self.pending = [f for f in self.pending if not f.done()]
+        if self.pending or self.fraction <= 0:
+            return 0
+
+        entries = [(p, k) for p in self.meta['patients'] for k in range(self.meta['variants'])]
+        chosen = random.sample(entries, int(round(self.fraction * len(entries))))
+
+        by_patient = {}
+        for patient, k in chosen:
+            by_patient.setdefault(patient, []).append(k)
+        for patient, ks in by_patient.items():
+            self.pending.append(self.executor.submit(_write_entries, self.meta['root'], self.pool_dir, patient, ks,
+                                                     self.meta['dtype'], self.meta['views'],
+                                                     random.randrange(2 ** 31)))
+        return len(chosen)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class PoolData(Dataset):
+    def __init__(self, pool_dir, views=all_views):
+        with open(os.path.join(pool_dir, 'pool.json')) as f:
+            meta = json.load(f)
+        self.pool_dir = pool_dir
+        self.folder = meta['patients']
+        self.variants = meta['variants']
+        # a pool built with more views can serve any subset of them
+        missing = [view for view in views if view not in meta['views']]
+        if missing:
+            raise ValueError('pool %s has no %s DRRs' % (pool_dir, ', '.join(missing)))
+        self.channels = [meta['views'].index(view) for view in views]
+
+    def __len__(self):
+        return (len(self.folder))
+
+    def __getitem__(self, index):
+        k = random.randrange(self.variants)
+        with np.load(entry_path(self.pool_dir, self.folder[index], k)) as entry:
+            inputs = torch.from_numpy(entry['inputs'][self.channels].astype('float32'))
+            targets = torch.from_numpy(entry['targets'].astype('float32'))
+
+        return inputs, targets
@@ -0,0 +1,157 @@
+import torch
+import torch.nn.functional as F
+
+#volumetric augmentation: one sampling grid per sample, applied once to every slice along axis 0
+
+class VolumeAugment:
+    def __init__(self, shift_limit=0.15, scale_limit=0.15, rotate_limit=45, p_affine=0.3, crop_size=220,
+                 p_hflip=0.2, p_vflip=0.2, alpha=1, sigma=50, alpha_affine=50, p_elastic=0.5, size=256,
+                 padding_mode='reflection', mode='bilinear', generator=None):
+        # defaults mirror the albumentations pipeline ImageData used to run on the H x W x 256 target, of which
+        # only the spatial transforms ever reached the mask that was kept
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.p_affine = p_affine
+        self.crop_size = crop_size
+        self.p_hflip = p_hflip
+        self.p_vflip = p_vflip
+        self.alpha = alpha
+        self.sigma = sigma
+        self.alpha_affine = alpha_affine
+        self.p_elastic = p_elastic
+        self.size = size
+        self.padding_mode = padding_mode
+        self.mode = mode
+        self.generator = generator
+
+    def _uniform(self, batch, low, high):
+        return torch.rand(batch, generator=self.generator, dtype=torch.float64) * (high - low) + low
+
+    def _coin(self, batch, p):
+        return torch.rand(batch, generator=self.generator) < p
+
+    def sample(self, batch, shape):
+        # draws the transform parameters for a batch of volumes of shape (D, H, W); the returned dict fully
+        # determines the warp, so DRRs or other derived images can be transformed consistently with grid()
+        height, width = shape[-2:]
+
+        angle = torch.deg2rad(self._uniform(batch, -self.rotate_limit, self.rotate_limit))
+        scale = self._uniform(batch, 1 - self.scale_limit, 1 + self.scale_limit)
+        shift = torch.stack([self._uniform(batch, -self.shift_limit, self.shift_limit),
+                             self._uniform(batch, -self.shift_limit, self.shift_limit)], dim=1)
+        use_affine = self._coin(batch, self.p_affine)
+
+        crop_h, crop_w = min(self.crop_size, height), min(self.crop_size, width)
+        crop_y = torch.randint(0, height - crop_h + 1, (batch,), generator=self.generator)
+        crop_x = torch.randint(0, width - crop_w + 1, (batch,), generator=self.generator)
+
+        flip_x = self._coin(batch, self.p_hflip)
+        flip_y = self._coin(batch, self.p_vflip)
+
+        use_elastic = self._coin(batch, self.p_elastic)
+        jitter = (torch.rand(batch, 3, 2, generator=self.generator, dtype=torch.float64) * 2 - 1) * self.alpha_affine
+        coarse = max(2, int(round(max(height, width) / max(self.sigma, 1))) + 1)
+        field = (torch.rand(batch, 2, coarse, coarse, generator=self.generator) * 2 - 1) * self.alpha
+
+        return {
+            'shape': (height, width),
+            'angle': torch.where(use_affine, angle, torch.zeros_like(angle)),
+            'scale': torch.where(use_affine, scale, torch.ones_like(scale)),
+            'shift': torch.where(use_affine[:, None], shift, torch.zeros_like(shift)),
+            'crop': torch.stack([crop_y, crop_x, torch.full_like(crop_y, crop_h), torch.full_like(crop_x, crop_w)], 1),
+            'flip_x': flip_x,
+            'flip_y': flip_y,
+            'elastic_affine': torch.where(use_elastic[:, None, None], jitter, torch.zeros_like(jitter)),
+            'elastic_field': field * use_elastic[:, None, None, None],
+        }
+
+    def grid(self, params, size=None, device=None):
+        # output pixel -> input pixel: crop and resize, flips, elastic, then inverse shift/scale/rotate
+        height, width = params['shape']
+        size = size or self.size
+        out_h, out_w = (size, size) if isinstance(size, int) else size
+        batch = params['angle'].shape[0]
+
+        ys = torch.linspace(0, 1, out_h, dtype=torch.float64)
+        xs = torch.linspace(0, 1, out_w, dtype=torch.float64)
+        y, x = torch.meshgrid(ys, xs, indexing='ij')
+
+        crop = params['crop'].double()
+        y = crop[:, 0, None, None] + y * (crop[:, 2, None, None] - 1)
+        x = crop[:, 1, None, None] + x * (crop[:, 3, None, None] - 1)
+
+        x = torch.where(params['flip_x'][:, None, None], (width - 1) - x, x)
+        y = torch.where(params['flip_y'][:, None, None], (height - 1) - y, y)
+
+        # smooth random displacement, in pixels
+        field = F.interpolate(params['elastic_field'], size=(height, width), mode='bicubic', align_corners=True)
+        points = torch.stack([x, y], dim=-1)
+        norm = torch.tensor([width - 1, height - 1], dtype=torch.float64)
+        displacement = F.grid_sample(field.double(), points / norm * 2 - 1, align_corners=True)
+        points = points + displacement.permute(0, 2, 3, 1)
+
+        # affine jitter of the elastic transform: map three reference points onto their perturbed copies
+        cy, cx, half = height / 2.0, width / 2.0, min(height, width) / 3.0
+        src = torch.tensor([[cx + half, cy + half], [cx + half, cy - half], [cx - half, cy - half]],
+                           dtype=torch.float64).expand(batch, 3, 2)
+        dst = src + params['elastic_affine']
+        ones = torch.ones(batch, 3, 1, dtype=torch.float64)
+        matrix = torch.linalg.solve(torch.cat([dst, ones], -1), torch.cat([src, ones], -1))
+        points = torch.cat([points, torch.ones_like(points[..., :1])], -1) @ matrix[:, None]
+        points = points[..., :2]
+
+        # inverse of shift/scale/rotate about the image centre
+        centre = torch.tensor([(width - 1) / 2.0, (height - 1) / 2.0], dtype=torch.float64)
+        shift = params['shift'] * torch.tensor([width, height], dtype=torch.float64)
+        rel = points - centre - shift[:, None, None]
+        cos = torch.cos(params['angle'])[:, None, None]
+        sin = torch.sin(params['angle'])[:, None, None]
+        scale = params['scale'][:, None, None]
+        x = (cos * rel[..., 0] + sin * rel[..., 1]) / scale
+        y = (-sin * rel[..., 0] + cos * rel[..., 1]) / scale
+        points = torch.stack([x, y], -1) + centre
+
+        grid = (points / norm * 2 - 1).float()
+        return grid if device is None else grid.to(device)
+
+    def apply(self, volume, params):
+        # volume (B, D, H, W) or (D, H, W); the D slices ride along as channels of a single 2D grid_sample.
+        # Anything in the same H x W plane, e.g. a frontal DRR as (B, 1, H, W), warps identically with these params
+        single = volume.dim() == 3
+        if single:
+            volume = volume.unsqueeze(0)
+        grid = self.grid(params, device=volume.device)
+        out = F.grid_sample(volume.float(), grid, mode=self.mode, padding_mode=self.padding_mode, align_corners=True)
+        return out[0] if single else out
+
+    def __call__(self, volume):
+        single = volume.dim() == 3
+        batch = 1 if single else volume.shape[0]
+        params = self.sample(batch, volume.shape)
+        out = min_max(self.apply(volume, params))
+        return out, params
+
+
+def min_max(volume):
+    dims = tuple(range(-3, 0)) if volume.dim() == 4 else tuple(range(volume.dim()))
+    low = volume.amin(dim=dims, keepdim=True)
+    high = volume.amax(dim=dims, keepdim=True)
+    return (volume - low) * (1.0 / (high - low))
+
+
+def identity_params(batch, shape):
+    height, width = shape[-2:]
+    zeros = torch.zeros(batch, dtype=torch.float64)
+    false = torch.zeros(batch, dtype=torch.bool)
+    return {
+        'shape': (height, width),
+        'angle': zeros,
+        'scale': torch.ones(batch, dtype=torch.float64),
+        'shift': torch.zeros(batch, 2, dtype=torch.float64),
+        'crop': torch.tensor([[0, 0, height, width]] * batch),
+        'flip_x': false,
+        'flip_y': false,
+        'elastic_affine': torch.zeros(batch, 3, 2, dtype=torch.float64),
+        'elastic_field': torch.zeros(batch, 2, 2, 2),
+    }
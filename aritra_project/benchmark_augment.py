@@ -0,0 +1,67 @@
+import argparse
+import time
+import numpy as np
+import torch
+import albumentations as A
+from augment import VolumeAugment
+
+#augmentation CPU time per sample: old albumentations image+mask path against VolumeAugment
+
+def legacy_pipeline(size=256):
+    # the spatial part of the pipeline ImageData used to build; the intensity transforms only touched the
+    # discarded image, and their old argument names no longer exist in current albumentations. The 220 crop of the
+    # 256 slices scales with the benchmark size
+    crop = 220 * size // 256
+    return A.Compose([
+        A.ShiftScaleRotate(shift_limit=0.15, scale_limit=0.15, rotate_limit=45, interpolation=1, border_mode=4, p=0.3),
+        A.RandomCrop(crop, crop, p=1.0),
+        A.HorizontalFlip(p=0.2),
+        A.VerticalFlip(p=0.2),
+        A.ElasticTransform(alpha=1, sigma=50, interpolation=1, border_mode=4, p=0.5),
+        A.Resize(size, size),
+    ])
+
+
+def legacy_step(aug, targets):
+    targets = np.transpose(targets, (1, 2, 0))
+    transformed = aug(image=targets, mask=targets)
+    targets = transformed['mask']
+    targets = (targets - np.min(targets)) * (1.0 / (np.max(targets) - np.min(targets)))
+    return np.transpose(targets, (2, 0, 1))
+
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=2)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    targets = rng.random((args.size, args.size, args.size), dtype=np.float32)
+    batch = torch.from_numpy(rng.random((args.batch, args.size, args.size, args.size), dtype=np.float32))
+
+    legacy = legacy_pipeline(args.size)
+    volume = VolumeAugment(size=args.size)
+
+    old = timed(lambda: legacy_step(legacy, targets), args.repeats)
+    new = timed(lambda: volume(torch.from_numpy(targets)), args.repeats)
+    new_batch = timed(lambda: volume(batch), args.repeats) / args.batch
+
+    print('volume', '%d^3' % args.size, '-', 'torch threads', torch.get_num_threads())
+    print('%-32s' % 'albumentations image+mask', '%8.1f ms/sample' % (old * 1000))
+    print('%-32s' % 'VolumeAugment', '%8.1f ms/sample' % (new * 1000), '-', '%.1fx' % (old / new))
+    print('%-32s' % ('VolumeAugment batch of %d' % args.batch), '%8.1f ms/sample' % (new_batch * 1000), '-',
+          '%.1fx' % (old / new_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import os
+import time
+import torch
+import torch.optim as optim
+from network import UNet
+from compiled import CompiledModel, inference_model
+import loss_metric
+
+#eager against compiled execution on CPU: a my_train step (forward, loss, backward, Adam) and an inference pass, each
+#in NCHW / channels_last, with the first-call (compile) overhead and the steady-state time per step
+
+train_modes = (('eager', False, False), ('eager channels_last', False, True), ('compiled', True, False),
+               ('compiled channels_last', True, True))
+infer_modes = (('eager', False, False, False), ('eager channels_last', False, True, False),
+               ('compiled channels_last', True, True, False), ('BN-folded compiled channels_last', True, True, True))
+
+
+def batch(args, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    inputs = torch.rand((args.batch, 3, args.size, args.size), generator=generator)
+    targets = torch.rand((args.batch, 256, args.size, args.size), generator=generator)
+    return inputs, targets
+
+
+def timed(fn, repeats):
+    start = time.perf_counter()
+    out = fn()
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return first, min(times), out
+
+
+def train_step(model, optimizer, inputs, targets):
+    optimizer.zero_grad()
+    out_1, out_2 = model(inputs)
+    loss_1, _ = loss_metric.loss1_mse(out_1.reshape(targets.shape), targets)
+    loss = loss_1 + 0.5 * loss_metric.loss2(out_2.reshape(inputs.shape), inputs)
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--width', type=float, default=0.05, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--skip-train', action='store_true')
+    args = parser.parse_args()
+
+    # cold compiles: inductor's on-disk caches would hide the compile time on a second run
+    os.environ.setdefault('TORCHINDUCTOR_FORCE_DISABLE_CACHES', '1')
+    inputs, targets = batch(args)
+    torch.manual_seed(0)
+    state = UNet(in_channels=3, width=args.width).state_dict()
+    rows = []
+
+    if not args.skip_train:
+        for name, compile, channels_last in train_modes:
+            torch._dynamo.reset()
+            model = UNet(in_channels=3, width=args.width)
+            model.load_state_dict(state)
+            model = CompiledModel(model, compile, channels_last).train()
+            # lr 0 keeps the weights fixed; losses still differ a little between modes, as channels_last and inductor
+            # draw the dropout mask in a different order
+            optimizer = optim.Adam(model.parameters(), lr=0.0)
+
+            def step():
+                torch.manual_seed(0)
+                return train_step(model, optimizer, inputs, targets)
+
+            first, steady, loss = timed(step, args.repeats)
+            rows.append(('train', name, first, steady, loss, model.fallback))
+
+    with torch.no_grad():
+        for name, compile, channels_last, fold in infer_modes:
+            torch._dynamo.reset()
+            model = UNet(in_channels=3, width=args.width)
+            model.load_state_dict(state)
+            model = inference_model(model, compile, channels_last, fold)
+            first, steady, (out_1, out_2) = timed(lambda: model(inputs), args.repeats)
+            if name == 'eager':
+                reference = out_1
+            rows.append(('inference', name, first, steady, float((out_1 - reference).abs().max()), model.fallback))
+
+    print('batch', args.batch, '-', 'input %dx%d' % (args.size, args.size), '-', 'width', args.width, '-',
+          'threads', torch.get_num_threads())
+    base = {}
+    for kind, name, first, steady, value, fallback in rows:
+        base.setdefault(kind, steady)
+        print('%-9s' % kind, '%-34s' % name, 'first call %7.2f s' % first, '-', 'compile overhead %7.2f s' %
+              (first - steady), '-', 'step %7.3f s' % steady, '-', 'speed-up %.2fx' % (base[kind] / steady), '-',
+              ('loss %.3f' % value) if kind == 'train' else ('max |diff| %.1e' % value),
+              '' if fallback is None else '- fell back to eager (%s)' % fallback)
+
+
+if __name__ == '__main__':
+    main()
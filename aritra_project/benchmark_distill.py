@@ -0,0 +1,108 @@
+import argparse
+import tempfile
+import time
+import torch
+import torch.optim as optim
+from network import UNet
+from distill import Teacher, TeacherCache, Distiller
+from benchmark_heads import phantoms
+import loss_metric
+
+#the student's latency / accuracy trade-off: CPU inference time and parameters of the UNet at several widths at the
+#real 256x256 -> 256^3 shape, then a teacher and students trained on the same synthetic phantoms at a reduced size,
+#each student once on the ground truth alone and once distilled, with the teacher cache's hit rate and the time it saves
+
+
+def latency(width, repeats):
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=width).eval()
+    x = torch.rand(1, 3, 256, 256)
+    times = []
+    with torch.no_grad():
+        for _ in range(repeats + 1):
+            start = time.perf_counter()
+            model.volume(x)
+            times.append(time.perf_counter() - start)
+    # the first call pays for allocation
+    return sum(p.numel() for p in model.parameters()), min(times[1:])
+
+
+def step(model, optimizer, inputs, targets, distiller=None):
+    # my_train's step
+    optimizer.zero_grad()
+    taught = distiller.teacher(inputs) if distiller is not None else None
+    out_1, out_2 = model(inputs)
+    out_1 = out_1.reshape(targets.shape)
+    out_2 = out_2.reshape(inputs.shape)
+    loss = loss_metric.loss1(out_1, targets) + 0.5 * loss_metric.loss2(out_2, inputs)
+    if distiller is not None:
+        loss = distiller(loss, taught, out_1, out_2)
+    loss.backward()
+    optimizer.step()
+
+
+def fit(width, args, train, val, epochs, teacher=None):
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=width, depth=args.train_size)
+    distiller = Distiller(model, teacher) if teacher is not None else None
+    parameters = list(model.parameters()) + (list(distiller.parameters()) if distiller is not None else [])
+    optimizer = optim.Adam(parameters, lr=args.lr)
+    generator = torch.Generator().manual_seed(0)
+    epoch_times = []
+    for _ in range(epochs):
+        model.train()
+        start = time.perf_counter()
+        for index in torch.randperm(len(train[0]), generator=generator).split(args.batch):
+            step(model, optimizer, train[0][index], train[1][index], distiller)
+        epoch_times.append(time.perf_counter() - start)
+    model.eval()
+    with torch.no_grad():
+        out_1 = model.volume(val[0])
+    return model, loss_metric.psnr(out_1, val[1]), float(loss_metric.ssim(out_1, val[1])), epoch_times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency-widths', type=float, nargs='+', default=[1.0, 0.5, 0.25, 0.1, 0.05])
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--teacher-width', type=float, default=0.15)
+    parser.add_argument('--student-widths', type=float, nargs='+', default=[0.05, 0.1])
+    parser.add_argument('--train-size', type=int, default=64, help='phantom size for training and evaluation')
+    parser.add_argument('--train', type=int, default=48)
+    parser.add_argument('--val', type=int, default=8)
+    parser.add_argument('--teacher-epochs', type=int, default=16)
+    parser.add_argument('--epochs', type=int, default=16)
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    print('inference, batch 1, 256x256 -> 256^3')
+    for width in args.latency_widths:
+        params, seconds = latency(width, args.repeats)
+        print('width %-5s' % width, 'params %10d' % params, '-', 'latency %7.3f s' % seconds, flush=True)
+
+    train = phantoms(args.train, args.train_size, seed=0)
+    val = phantoms(args.val, args.train_size, seed=1)
+    teacher_model, psnr, ssim, _ = fit(args.teacher_width, args, train, val, args.teacher_epochs)
+    print('trained on %d phantoms of %d^3, evaluated on %d' % (args.train, args.train_size, args.val))
+    print('teacher width %-5s' % args.teacher_width, 'val PSNR %6.2f dB' % psnr, '-', 'val SSIM %.4f' % ssim, '-',
+          '%d epochs' % args.teacher_epochs, flush=True)
+
+    for width in args.student_widths:
+        _, psnr, ssim, times = fit(width, args, train, val, args.epochs)
+        print('student width %-5s' % width, 'ground truth only', '-', 'val PSNR %6.2f dB' % psnr, '-',
+              'val SSIM %.4f' % ssim, '-', 'epoch %.1f s' % (sum(times) / len(times)), flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TeacherCache(directory)
+            teacher = Teacher(teacher_model, cache=cache)
+            _, psnr, ssim, times = fit(width, args, train, val, args.epochs, teacher)
+            stats = cache.stats()
+        # every phantom is a fixed (sample, augmentation) pair: the teacher runs in the first epoch only
+        print('student width %-5s' % width, 'distilled', '-', 'val PSNR %6.2f dB' % psnr, '-', 'val SSIM %.4f' % ssim,
+              '-', 'first epoch %.1f s' % times[0], '-', 'later epochs %.1f s' % (sum(times[1:]) / max(len(times) - 1, 1)),
+              '-', 'teacher forwards %d' % teacher.forwards, '-', 'cache hit rate %.2f' % stats['hit_rate'], '-',
+              'cache %.1f MB' % (stats['bytes'] / 2 ** 20), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import time
+import numpy as np
+import torch
+from generate_drr import generate_drr_from_ct
+from drr_projector import project, ProjectionGeometry
+
+#throughput of the numba projector against the batched ray-marching projector on CPU
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    rng = np.random.default_rng(0)
+    volumes = rng.uniform(-1000, 1000, (args.batch, args.size, args.size, args.size)).astype('float32')
+    views = ('frontal', 'lateral', 'top')
+
+    def numba_views():
+        for volume in volumes:
+            for direction in views:
+                generate_drr_from_ct(volume, direction=direction)
+
+    batch = torch.from_numpy(volumes)
+    cone = [ProjectionGeometry(angle=a, beam='cone', source_distance=4 * args.size) for a in (0, 45, 90)]
+    oblique = [ProjectionGeometry(angle=a, elevation=15) for a in (30, 60, 120)]
+
+    n = args.batch * len(views)
+    rows = [
+        ('numba axis-aligned', timed(numba_views, args.repeats)),
+        ('ray-march axis-aligned', timed(lambda: project(batch, views), args.repeats)),
+        ('ray-march oblique parallel', timed(lambda: project(batch, oblique), args.repeats)),
+        ('ray-march cone', timed(lambda: project(batch, cone), args.repeats)),
+    ]
+
+    ref = [generate_drr_from_ct(volumes[0], direction=d) for d in views]
+    ref[1] = np.rot90(ref[1], 3)
+    out = project(batch[:1], views, normalize=False)[0].numpy()
+    error = max(float(np.abs(r - o).max()) for r, o in zip(ref, out))
+
+    print('volume', '%d^3' % args.size, '-', 'batch', args.batch, '-', 'torch threads', torch.get_num_threads())
+    for name, seconds in rows:
+        print('%-28s' % name, '%8.3f s' % seconds, '-', '%8.2f projections/s' % (n / seconds))
+    print('max abs difference to generate_drr_from_ct', ':', '%.2e' % error)
+
+
+if __name__ == '__main__':
+    main()
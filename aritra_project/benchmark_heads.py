@@ -0,0 +1,133 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.utils.flop_counter import FlopCounterMode
+from network import UNet
+from drr_projector import project
+import loss_metric
+
+#the published 1x1-conv head (one output channel per slice) against network.LiftingHead: parameters, forward FLOPs
+#and train-step time / peak RSS at the real 256^3 shape, then PSNR / SSIM after training both on the same synthetic
+#phantoms at a reduced size
+
+heads = ('conv', 'lift')
+views = ('frontal', 'lateral', 'top')
+
+
+def phantoms(count, size, seed):
+    """HU volumes of 3-6 random ellipsoids in air, the [0, 1] targets and their DRRs"""
+    rng = np.random.default_rng(seed)
+    grid = np.linspace(-1, 1, size, dtype=np.float32)
+    z, y, x = np.meshgrid(grid, grid, grid, indexing='ij')
+    volumes = np.full((count, size, size, size), -1000, dtype=np.float32)
+    for volume in volumes:
+        for _ in range(rng.integers(3, 7)):
+            centre = rng.uniform(-0.4, 0.4, 3)
+            axes = rng.uniform(0.15, 0.5, 3)
+            inside = sum(((c - m) / a) ** 2 for c, m, a in zip((z, y, x), centre, axes)) <= 1
+            volume[inside] = rng.uniform(-600, 1200)
+    targets = (volumes + 1000) / 2200
+    drrs = project(torch.from_numpy(volumes), views)
+    return drrs.float(), torch.from_numpy(targets)
+
+
+def step(model, optimizer, inputs, targets):
+    optimizer.zero_grad()
+    out_1, out_2 = model(inputs)
+    loss_1, _ = loss_metric.loss1_mse(out_1.reshape(targets.shape), targets)
+    loss = loss_1 + 0.5 * loss_metric.loss2(out_2.reshape(inputs.shape), inputs)
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+def cost(head, args, queue):
+    # own process, so the peak RSS is this head's alone
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=args.width, head=head)
+    inputs = torch.rand(args.cost_batch, 3, 256, 256)
+    targets = torch.rand(args.cost_batch, 256, 256, 256)
+    with FlopCounterMode(display=False) as counter:
+        with torch.no_grad():
+            model.eval()
+            model.volume(inputs[:1])
+    # the head alone on decoder features of the right shape
+    first = model.dconv[0] if head == 'conv' else model.dconv.lift[0]
+    with FlopCounterMode(display=False) as head_counter:
+        with torch.no_grad():
+            model.dconv(torch.rand(1, first.in_channels, 256, 256))
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        step(model, optimizer, inputs, targets)
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'params': sum(p.numel() for p in model.parameters()),
+               'head_params': sum(p.numel() for p in model.dconv.parameters()),
+               'flops': counter.get_total_flops(), 'head_flops': head_counter.get_total_flops(),
+               'step_s': min(times), 'peak_mb': (peak - base) / 1024.0})
+
+
+def quality(head, args, train, val):
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=args.width, head=head, depth=args.train_size)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    generator = torch.Generator().manual_seed(0)
+    start = time.perf_counter()
+    model.train()
+    for _ in range(args.epochs):
+        for index in torch.randperm(len(train[0]), generator=generator).split(args.batch):
+            step(model, optimizer, train[0][index], train[1][index])
+    seconds = time.perf_counter() - start
+    model.eval()
+    with torch.no_grad():
+        out_1 = model.volume(val[0])
+        return (loss_metric.psnr(out_1, val[1]), float(loss_metric.ssim(out_1, val[1])), seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=float, default=0.05, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--batch', type=int, default=2, help='training batch for the PSNR / SSIM comparison')
+    parser.add_argument('--cost-batch', type=int, default=1, help='batch for the 256^3 cost measurements')
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--train-size', type=int, default=64, help='phantom size for the PSNR / SSIM comparison')
+    parser.add_argument('--train', type=int, default=48)
+    parser.add_argument('--val', type=int, default=8)
+    parser.add_argument('--epochs', type=int, default=8)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    costs = {}
+    for head in heads:
+        queue = ctx.Queue()
+        process = ctx.Process(target=cost, args=(head, args, queue))
+        process.start()
+        costs[head] = queue.get()
+        process.join()
+
+    train = phantoms(args.train, args.train_size, seed=0)
+    val = phantoms(args.val, args.train_size, seed=1)
+    scores = {head: quality(head, args, train, val) for head in heads}
+
+    print('width', args.width, '-', 'batch', args.cost_batch, '-', 'cost at 256x256 -> 256^3')
+    for head, c in costs.items():
+        print('%-5s' % head, 'params %9d (head %7d)' % (c['params'], c['head_params']), '-',
+              'forward %6.2f GFLOP (head %6.2f)' % (c['flops'] / 1e9, c['head_flops'] / 1e9), '-',
+              'train step %6.2f s' % c['step_s'], '-', 'peak RSS +%7.0f MB' % c['peak_mb'])
+    print('trained on %d phantoms of %d^3 for %d epochs, evaluated on %d' % (args.train, args.train_size,
+                                                                             args.epochs, args.val))
+    for head, (psnr, ssim, seconds) in scores.items():
+        print('%-5s' % head, 'val PSNR %6.2f dB' % psnr, '-', 'val SSIM %.4f' % ssim, '-', 'training %.0f s' % seconds)
+
+
+if __name__ == '__main__':
+    main()
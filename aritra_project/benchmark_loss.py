@@ -0,0 +1,89 @@
+import argparse
+import math
+import multiprocessing
+import resource
+import time
+import torch
+import torch.nn as nn
+import loss_metric
+
+#loss + PSNR step of my_train: the unfused autograd expressions against loss_metric's fused NormLoss, for time,
+#peak RSS and gradients
+
+criterion = nn.MSELoss()
+
+
+def reference(out_1, targets, out_2, inputs):
+    # loss_metric before the fused kernels
+    l = (out_1 - targets)
+    loss_1 = 0.1 * torch.sum(torch.abs(l)) + 0.9 * torch.sqrt(torch.sum(l ** 2))
+    l = (out_2 - inputs)
+    loss_2 = torch.sqrt(torch.sum(l ** 2))
+    metric = 10 * math.log10(1 / criterion(out_1, targets).item())
+    return loss_1 + 0.5 * loss_2, metric
+
+
+def fused(out_1, targets, out_2, inputs):
+    loss_1, mse = loss_metric.loss1_mse(out_1, targets)
+    loss_2 = loss_metric.loss2(out_2, inputs)
+    return loss_1 + 0.5 * loss_2, loss_metric.psnr_from_mse(mse)
+
+
+methods = {'unfused': reference, 'fused': fused}
+
+
+def tensors(shape, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    out_1 = torch.rand(shape, generator=generator).requires_grad_()
+    targets = torch.rand(shape, generator=generator)
+    out_2 = torch.rand(shape[:2] + shape[-2:], generator=generator).requires_grad_()
+    inputs = torch.rand(shape[:2] + shape[-2:], generator=generator)
+    return out_1, targets, out_2, inputs
+
+
+def step(name, shape, repeats, queue):
+    out_1, targets, out_2, inputs = tensors(shape)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeats):
+        out_1.grad = out_2.grad = None
+        start = time.perf_counter()
+        loss, metric = methods[name](out_1, targets, out_2, inputs)
+        loss.backward()
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # numpy copies: torch tensors would be shared through file descriptors that die with this process
+    queue.put((min(times), (peak - base) / 1024.0, float(loss.detach()), metric, out_1.grad.numpy(), out_2.grad.numpy()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    shape = (args.batch, 256, args.size, args.size)
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name in methods:
+        # fresh process per method, so the peak RSS of one does not hide the other's
+        queue = ctx.Queue()
+        process = ctx.Process(target=step, args=(name, shape, args.repeats, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+
+    print('out_1', tuple(shape), '-', '%.0f MB per tensor' % (torch.Size(shape).numel() * 4 / 2 ** 20))
+    for name, (seconds, extra, loss, metric, _, _) in results.items():
+        print('%-10s' % name, '%8.3f s/step' % seconds, '-', 'peak RSS +%8.1f MB' % extra, '-',
+              'loss %.3f' % loss, '-', 'PSNR %.4f dB' % metric)
+    old, new = results['unfused'], results['fused']
+    for i, name in ((4, 'out_1'), (5, 'out_2')):
+        diff = float(abs(old[i] - new[i]).max())
+        print('max gradient difference', name, ':', '%.2e' % diff, '-', 'relative', ':',
+              '%.2e' % (diff / float(abs(old[i]).max())))
+
+
+if __name__ == '__main__':
+    main()
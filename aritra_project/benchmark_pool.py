@@ -0,0 +1,68 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from aug_pool import build_pool, load_base, make_variant, PoolData
+from manifest import load_manifest
+
+#training samples/s with on-the-fly augmentation + DRRs against drawing from the precomputed pool
+
+class OnTheFly(Dataset):
+    # the per-item work of ImageData in the training phase, without the Ray round trip
+    def __init__(self, root):
+        self.root = root
+        self.folder = [p['id'] for p in load_manifest(root)['patients']]
+
+    def __len__(self):
+        return len(self.folder)
+
+    def __getitem__(self, index):
+        inputs, targets = make_variant(load_base(self.root, self.folder[index]))
+        return torch.from_numpy(inputs), torch.from_numpy(targets)
+
+
+def samples_per_second(dataset, workers, epochs):
+    loader = DataLoader(dataset, batch_size=2, shuffle=True, num_workers=workers)
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for inputs, targets in loader:
+            samples += len(inputs)
+    return samples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patients', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--variants', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=2)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'train')
+        for i in range(args.patients):
+            os.makedirs(os.path.join(root, 'patient%03d' % i))
+            volume = rng.random((args.size, args.size, args.size), dtype=np.float32)
+            np.save(os.path.join(root, 'patient%03d' % i, 'patient%03d.npy' % i), volume)
+
+        start = time.perf_counter()
+        pool_dir = build_pool(root, os.path.join(tmp, 'pool'), args.variants, workers=args.workers)
+        build = time.perf_counter() - start
+
+        fly = samples_per_second(OnTheFly(root), args.workers, args.epochs)
+        pool = samples_per_second(PoolData(pool_dir), args.workers, args.epochs)
+
+    print('patients', args.patients, '-', 'volume', '%d^3' % args.size, '-', 'workers', args.workers)
+    print('%-24s' % 'pool build', '%8.1f s' % build, '-', '%d entries' % (args.patients * args.variants))
+    print('%-24s' % 'on-the-fly', '%8.2f samples/s' % fly)
+    print('%-24s' % 'pool', '%8.2f samples/s' % pool, '-', '%.1fx' % (pool / fly))
+
+
+if __name__ == '__main__':
+    main()
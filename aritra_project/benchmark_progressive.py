@@ -0,0 +1,79 @@
+import argparse
+import math
+import time
+import numpy as np
+import torch
+from network import UNet
+from compiled import inference_model
+from progressive import refine, level_volume, ProgressiveReconstruction
+
+#time to first volume against time to full volume: one-shot UNet inference, on-demand refinement (the caller pulls
+#each level) and background refinement (preview returned while the worker thread continues), plus how close each
+#preview is to the full output pooled to the same size
+
+
+def psnr(a, b):
+    mse = float(torch.mean((a - b) ** 2))
+    return float('inf') if mse == 0 else 10 * math.log10(1 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--width', type=float, default=0.05, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--checkpoint', default=None,
+                        help='trained state dict; preview quality is only meaningful with trained weights')
+    parser.add_argument('--drrs', default=None, help='.npy DRR set (views, 256, 256); default random')
+    parser.add_argument('--compiled', action='store_true', help='BN-folded, channels_last, torch.compile')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=args.width)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+    if args.compiled:
+        model = inference_model(model)
+    drrs = torch.from_numpy(np.load(args.drrs)).float()[None] if args.drrs else torch.rand(1, 3, 256, 256)
+    # warm-up (and compilation) of every level, so the timings below are steady state
+    for _ in refine(model, drrs, args.levels):
+        pass
+
+    one_shot = []
+    with torch.no_grad():
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            full = model.volume(drrs)
+            one_shot.append(time.perf_counter() - start)
+
+    on_demand = {}
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        previews = {}
+        for size, volume, _ in refine(model, drrs, args.levels):
+            on_demand.setdefault(size, []).append(time.perf_counter() - start)
+            previews[size] = volume
+
+    background = {}
+    for _ in range(args.repeats):
+        job = ProgressiveReconstruction(model, drrs, args.levels)
+        job.wait(min(args.levels))
+        background.setdefault('preview', []).append(time.perf_counter() - job.started)
+        job.wait()
+        background.setdefault('full', []).append(time.perf_counter() - job.started)
+
+    print('input 256x256', '-', 'width', args.width, '-', 'compiled' if args.compiled else 'eager', '-', 'threads',
+          torch.get_num_threads())
+    print('%-28s' % 'one-shot full volume', '%7.3f s' % min(one_shot))
+    for size in sorted(on_demand):
+        quality = psnr(previews[size], level_volume(full, size))
+        print('%-28s' % ('on demand, %d^3 ready' % size), '%7.3f s' % min(on_demand[size]), '-',
+              '%5.1f%% of one-shot' % (100 * min(on_demand[size]) / min(one_shot)), '-',
+              'PSNR vs pooled full output %s' % ('exact' if math.isinf(quality) else '%.1f dB' % quality))
+    print('%-28s' % 'background, first preview', '%7.3f s' % min(background['preview']))
+    print('%-28s' % 'background, full volume', '%7.3f s' % min(background['full']))
+
+
+if __name__ == '__main__':
+    main()
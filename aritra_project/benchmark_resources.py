@@ -0,0 +1,146 @@
+import argparse
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+import numpy as np
+import psutil
+import ray
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, Dataset
+from augment import VolumeAugment
+from generate_drr import do_full_prprocessing, drr_views
+from network import UNet
+from resources import CpuPlan, available_cores, default_plan
+import loss_metric
+
+#training throughput (samples/s through augmentation, Ray DRRs and a train step) under different CPU splits
+#(resources.CpuPlan) on this machine, against the old setup (Ray on every physical core, 8 loader workers, every
+#library at its default thread count) and a single process. Prints the best split as a CPU_PLAN line. Each candidate
+#runs in a fresh process, so thread pools and Ray start from scratch
+
+
+def candidates(cores, pin=False):
+    """Splits of `cores` between model threads, loader workers and DRR workers x numba threads (Ray), or loader
+    workers projecting with numba threads each (drr=0xN), the defaults first"""
+    plans = [str(default_plan(range(cores), pin=pin)), str(default_plan(range(cores), use_ray=True, pin=pin))]
+    for model in sorted({max(1, cores // 4), max(1, cores // 2), max(1, 3 * cores // 4)}):
+        rest = max(cores - model, 1)
+        for threads in (1, 2, 4):
+            for loader in sorted({1, 2, max(1, rest // threads)}):
+                if loader * threads <= rest:
+                    plans.append(str(CpuPlan(model, loader, 0, threads, pin, range(cores))))
+                drr = (rest - loader) // threads
+                if drr >= 1:
+                    plans.append(str(CpuPlan(model, loader, drr, threads, pin, range(cores))))
+    return list(dict.fromkeys(plans))
+
+
+class Synthetic(Dataset):
+    # ImageData's training item: augment the volume, project its DRRs (through Ray when it runs)
+    def __init__(self, size, samples, use_ray):
+        rng = np.random.default_rng(0)
+        self.volumes = [rng.uniform(-1000, 1000, (size,) * 3).astype(np.float32) for _ in range(4)]
+        self.aug = VolumeAugment(size=size)
+        self.samples = samples
+        self.use_ray = use_ray
+
+    def __len__(self):
+        return self.samples
+
+    def __getitem__(self, index):
+        targets, _ = self.aug(torch.from_numpy(self.volumes[index % len(self.volumes)]))
+        targets = targets.numpy()
+        if self.use_ray:
+            inputs = ray.get(do_full_prprocessing.remote(ray.put(targets)))
+        else:
+            inputs = drr_views(targets)
+        inputs[1] = np.rot90(inputs[1], 3)
+        return torch.from_numpy(np.array(inputs)), torch.from_numpy(targets)
+
+
+def run(spec, args, queue):
+    # terminated on timeout: exit through atexit, which stops the Ray processes this run started
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    ray_args = {'include_dashboard': False, 'logging_level': logging.WARNING}
+    if spec == 'legacy':
+        use_ray, workers, worker_init = True, 8, None
+        ray.init(num_cpus=psutil.cpu_count(logical=False), **ray_args)
+    elif spec == 'single':
+        use_ray, workers, worker_init = False, 0, None
+    else:
+        plan = CpuPlan.parse(spec)
+        plan.apply()
+        use_ray, workers, worker_init = plan.drr_workers > 0, plan.loader_workers, plan.worker_init
+        if use_ray:
+            plan.init_ray(**ray_args)
+
+    loader = DataLoader(Synthetic(args.size, args.samples, use_ray), batch_size=args.batch, shuffle=True,
+                        num_workers=workers, worker_init_fn=worker_init)
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=args.width, depth=args.size)
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    samples, start = 0, None
+    for step, (inputs, targets) in enumerate(loader):
+        if step == args.warmup:
+            # numba compilation in every worker, Ray start-up and the first allocations are behind us
+            samples, start = 0, time.perf_counter()
+        optimizer.zero_grad()
+        out_1, out_2 = model(inputs)
+        loss = loss_metric.loss1(out_1.reshape(targets.shape), targets) + 0.5 * loss_metric.loss2(
+            out_2.reshape(inputs.shape), inputs)
+        loss.backward()
+        optimizer.step()
+        samples += len(inputs)
+    elapsed = time.perf_counter() - start
+    if use_ray:
+        ray.shutdown()
+    queue.put(samples / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cores', type=int, default=None, help='cores to split; default: resources.available_cores')
+    parser.add_argument('--plans', nargs='+', default=None, help="CPU_PLAN specs to try instead of the search, plus "
+                                                                 "'legacy' and 'single' for the baselines")
+    parser.add_argument('--pin', action='store_true', help='search pinned plans')
+    parser.add_argument('--size', type=int, default=128, help='volume size (the DRRs are size x size)')
+    parser.add_argument('--width', type=float, default=0.05, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--samples', type=int, default=24, help='samples per run, warm-up included')
+    parser.add_argument('--warmup', type=int, default=2, help='batches excluded from the timing')
+    parser.add_argument('--max-plans', type=int, default=12)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before a run counts as failed')
+    args = parser.parse_args()
+
+    cores = args.cores or len(available_cores())
+    plans = args.plans or ['legacy', 'single'] + candidates(cores, args.pin)[:args.max_plans]
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for spec in plans:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(spec, args, queue))
+        process.start()
+        process.join(args.timeout)
+        if process.is_alive():
+            # e.g. Ray calls from forked loader workers, which some Ray versions do not survive
+            process.terminate()
+            process.join()
+        results[spec] = queue.get() if process.exitcode == 0 else None
+        print('%-34s' % spec, '-', 'failed' if results[spec] is None else '%.2f samples/s' % results[spec],
+              flush=True)
+
+    ranked = sorted((rate, spec) for spec, rate in results.items() if rate is not None)
+    if ranked:
+        rate, spec = ranked[-1]
+        baseline = results.get('legacy')
+        print('cores', ':', cores, '-', 'best', ':', spec, '-', '%.2f samples/s' % rate,
+              '(%.2fx legacy)' % (rate / baseline) if baseline else '')
+        if spec not in ('legacy', 'single'):
+            print("export CPU_PLAN='%s'" % spec)
+
+
+if __name__ == '__main__':
+    main()
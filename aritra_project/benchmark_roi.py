@@ -0,0 +1,58 @@
+import argparse
+import time
+import torch
+from network import UNet
+
+#region-of-interest inference: UNet.volume_roi (the requested slices / window only from the head, no reprojection)
+#against the full forward pass and the full volume, and how far its output is from the same region of the full one
+
+
+def best(fn, repeats):
+    times = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=float, default=0.25, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--head', default='conv', choices=['conv', 'lift'])
+    parser.add_argument('--slices', type=int, nargs='+', default=[1, 8, 32, 128, 256],
+                        help='ROI depths (centred slice ranges)')
+    parser.add_argument('--window', type=int, nargs='+', default=[256, 64],
+                        help='ROI height / width (centred), per slice count')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = UNet(in_channels=3, width=args.width, head=args.head)
+    # non-trivial BatchNorm statistics, then inference mode
+    with torch.no_grad():
+        model.volume(torch.rand(2, 3, 256, 256))
+    model.eval()
+    x = torch.rand(1, 3, 256, 256)
+
+    forward, _ = best(lambda: model(x), args.repeats)
+    volume, full = best(lambda: model.volume(x), args.repeats)
+    decode, features = best(lambda: model.decode(x), args.repeats)
+    head, _ = best(lambda: model.dconv(features), args.repeats)
+    print('width', args.width, '-', 'head', args.head, '-', 'forward (volume + reprojection) %.3f s' % forward, '-',
+          'volume %.3f s' % volume, '-', 'trunk %.3f s' % decode, '-', 'full head %.4f s' % head)
+    for window in args.window:
+        for count in args.slices:
+            s0, r0 = (256 - count) // 2, (256 - window) // 2
+            roi = ((s0, s0 + count), (r0, r0 + window), (r0, r0 + window))
+            seconds, out = best(lambda: model.volume_roi(x, *roi), args.repeats)
+            roi_head, _ = best(lambda: model.head_roi(features, *roi), args.repeats)
+            reference = full[:, roi[0][0]:roi[0][1], roi[1][0]:roi[1][1], roi[2][0]:roi[2][1]]
+            print('roi %3d slices x %3d x %3d' % (count, window, window), '-', 'volume_roi %.3f s' % seconds, '-',
+                  'head %.4f s (%5.1f%% of full)' % (roi_head, 100 * roi_head / head), '-',
+                  'max |diff| %.2e' % float((out - reference).abs().max()), flush=True)
+
+
+if __name__ == '__main__':
+    main()
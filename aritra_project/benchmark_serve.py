@@ -0,0 +1,114 @@
+import argparse
+import http.client
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+#load generator for serve.py on localhost: concurrent clients posting DRR sets, with the server started once per
+#max batch size, so unbatched (max batch 1) and batched serving are compared on the same model
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start(port, max_batch, args):
+    command = [sys.executable, os.path.join(here, 'serve.py'), '--checkpoint', '', '--port', str(port),
+               '--max-batch', str(max_batch), '--max-wait-ms', str(args.max_wait_ms), '--width', str(args.width),
+               '--views'] + args.views
+    process = subprocess.Popen(command, cwd=here, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            stats(port)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not come up on port %d' % port)
+
+
+def stats(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.request('GET', '/stats')
+    return json.loads(connection.getresponse().read())
+
+
+def client(port, body, count, dtype, latencies, lock):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    for _ in range(count):
+        start = time.perf_counter()
+        connection.request('POST', '/reconstruct?dtype=' + dtype, body, {'Content-Type': 'application/octet-stream'})
+        response = connection.getresponse()
+        volume = np.load(io.BytesIO(response.read()))
+        if response.status != 200 or volume.shape != (256, 256, 256):
+            raise RuntimeError('bad reply %d %s' % (response.status, volume.shape))
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+
+def run(port, args):
+    drrs = np.random.default_rng(0).random((len(args.views), 256, 256), dtype=np.float32)
+    buffer = io.BytesIO()
+    np.save(buffer, drrs)
+    body = buffer.getvalue()
+
+    # one untimed request so the first batch does not pay for lazy initialisation
+    client(port, body, 1, args.dtype, [], threading.Lock())
+    latencies, lock = [], threading.Lock()
+    threads = [threading.Thread(target=client, args=(port, body, args.requests, args.dtype, latencies, lock))
+               for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    return len(latencies) / wall, np.array(latencies) * 1000.0, stats(port)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=4, help='per client')
+    parser.add_argument('--max-batch', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--max-wait-ms', type=float, default=20.0)
+    parser.add_argument('--width', type=float, default=0.05, help='UNet width; 1.0 is the published network')
+    parser.add_argument('--views', nargs='+', default=['frontal', 'lateral', 'top'])
+    parser.add_argument('--dtype', default='float16')
+    args = parser.parse_args()
+
+    print('clients', args.clients, '-', 'requests per client', args.requests, '-', 'width', args.width, '-',
+          'reply', args.dtype)
+    results = {}
+    for max_batch in args.max_batch:
+        port = free_port()
+        process = start(port, max_batch, args)
+        try:
+            results[max_batch] = run(port, args)
+        finally:
+            process.terminate()
+            process.wait()
+
+    for max_batch, (rate, latencies, server) in results.items():
+        print('max batch %2d' % max_batch, '-', '%6.2f req/s' % rate, '-',
+              'latency p50 %7.0f ms' % np.percentile(latencies, 50), '-',
+              'p99 %7.0f ms' % np.percentile(latencies, 99), '-', 'mean batch %.2f' % server['mean_batch'], '-',
+              'max queue depth', server['max_queue_depth'])
+    base = results[args.max_batch[0]][0]
+    for max_batch in args.max_batch[1:]:
+        print('throughput, max batch', max_batch, 'vs', args.max_batch[0], ':', '%.2fx' % (results[max_batch][0] / base))
+
+
+if __name__ == '__main__':
+    main()
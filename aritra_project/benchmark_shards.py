@@ -0,0 +1,94 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from manifest import load_manifest, select, file_path, view_suffix
+from shards import write_shards, ShardData
+
+#epoch read throughput on a cold page cache: per-patient np.load of the dataset directories (the validation path of
+#ImageData) against streaming the same data from shards
+
+views = ('frontal', 'lateral', 'top')
+
+
+class PerFile(Dataset):
+    # what ImageData does per item in the validation phase
+    def __init__(self, root):
+        self.manifest = load_manifest(root)
+        self.patients = select(self.manifest, views)
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __getitem__(self, index):
+        patient = self.patients[index]
+        targets = np.load(file_path(self.manifest, patient['ct'])).astype('float32')
+        inputs = np.array([np.load(file_path(self.manifest, patient['drr'][v])).astype('float32') for v in views])
+        return torch.from_numpy(inputs), torch.from_numpy(targets)
+
+
+def drop_cache(folder):
+    # evicts the folder's files from the page cache (clean pages only, hence the sync); no root needed
+    os.sync()
+    for dirpath, _, names in os.walk(folder):
+        for name in names:
+            fd = os.open(os.path.join(dirpath, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def epoch(dataset, folder, workers, shuffle):
+    drop_cache(folder)
+    loader = DataLoader(dataset, batch_size=2, shuffle=shuffle, num_workers=workers)
+    samples, nbytes = 0, 0
+    start = time.perf_counter()
+    for inputs, targets in loader:
+        samples += len(inputs)
+        nbytes += inputs.numel() * 4 + targets.numel() * 4
+    seconds = time.perf_counter() - start
+    return samples / seconds, nbytes / seconds / 2 ** 20, samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patients', type=int, default=16)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--shard-mb', type=int, default=512)
+    parser.add_argument('--dir', default=None, help='scratch directory on the disk to measure (default: tmp)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        root = os.path.join(tmp, 'val')
+        for i in range(args.patients):
+            patient = 'patient%03d' % i
+            os.makedirs(os.path.join(root, patient))
+            np.save(os.path.join(root, patient, patient + '.npy'),
+                    rng.random((args.size, args.size, args.size), dtype=np.float32))
+            for view in views:
+                np.save(os.path.join(root, patient, patient + view_suffix[view] + '.npy'),
+                        rng.random((args.size, args.size), dtype=np.float32))
+
+        shard_dir = os.path.join(tmp, 'shards')
+        start = time.perf_counter()
+        index = write_shards(root, shard_dir, args.shard_mb << 20)
+        pack = time.perf_counter() - start
+
+        per_file = epoch(PerFile(root), root, args.workers, True)
+        sharded = epoch(ShardData(shard_dir, views, train=False, batch_size=2), shard_dir, args.workers, False)
+
+    print('patients', args.patients, '-', 'volume', '%d^3' % args.size, '-', 'workers', args.workers, '-',
+          len(index['shards']), 'shards', '-', 'packed in %.1f s' % pack)
+    for name, (rate, mb, samples) in (('per-file np.load', per_file), ('shards', sharded)):
+        print('%-20s' % name, '%8.2f samples/s' % rate, '-', '%8.1f MB/s' % mb, '-', samples, 'samples')
+    print('speed-up', ':', '%.2fx' % (sharded[0] / per_file[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import copy
+import torch
+import torch.nn as nn
+from distributed import unwrap
+
+#opt-in compiled execution: channels_last layout, torch.compile (inductor fuses the conv / BN / ReLU / upsample / cat
+#chains into oneDNN convolutions plus generated kernels) and, for inference copies, BatchNorm folded into the
+#convolutions. Any failure to compile falls back to eager execution of the same module
+
+
+def fold_bn(model):
+    """Fold every BatchNorm2d that directly follows a Conv2d in an nn.Sequential into the convolution (inference only:
+    the running statistics become part of the weights). Changes the state_dict layout, so use it on a copy"""
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules)
+        for first, second in zip(names, names[1:]):
+            conv, bn = module._modules[first], module._modules[second]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else \
+                    1.0 / torch.sqrt(bn.running_var + bn.eps)
+                shift = bn.bias if bn.affine else torch.zeros_like(bn.running_mean)
+                bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+                with torch.no_grad():
+                    conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + shift)
+                module._modules[second] = nn.Identity()
+    return model
+
+
+class CompiledModel(nn.Module):
+    """Runs `module` (a UNet, possibly inside DistributedDataParallel) compiled and/or in channels_last. Parameters are
+    the module's own, so optimizers and unwrap(...).state_dict() see the usual UNet"""
+
+    def __init__(self, module, compile=True, channels_last=True, mode=None):
+        super().__init__()
+        self.module = module
+        self.channels_last = channels_last
+        self.fallback = None
+        bare = unwrap(module)
+        if channels_last:
+            # the 2D convolutions only: the lifting head's 3D weights have no channels_last layout
+            for m in bare.modules():
+                if isinstance(m, nn.Conv2d):
+                    m.to(memory_format=torch.channels_last)
+        # (forward, volume, decode) compiled; a plain tuple, so the OptimizedModules are not registered as submodules
+        self.compiled = (None, None, None)
+        if compile:
+            self.compiled = (torch.compile(module, mode=mode), torch.compile(bare.volume, mode=mode),
+                             torch.compile(bare.decode, mode=mode))
+
+    def _run(self, compiled, eager, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if compiled is not None and self.fallback is None:
+            try:
+                return compiled(x)
+            except Exception as e:
+                # no C++ compiler, unsupported op, backend bug: keep training / serving on the eager module
+                self.fallback = '%s: %s' % (type(e).__name__, str(e).splitlines()[0] if str(e) else '')
+                print('compiled execution failed, falling back to eager', '-', self.fallback)
+        return eager(x)
+
+    def forward(self, x):
+        return self._run(self.compiled[0], self.module, x)
+
+    def volume(self, x):
+        return self._run(self.compiled[1], unwrap(self.module).volume, x)
+
+    def decode(self, x):
+        return self._run(self.compiled[2], unwrap(self.module).decode, x)
+
+    def volume_roi(self, x, slices=None, rows=None, cols=None):
+        # compiled trunk, eager head: the head's shapes change with every ROI
+        return unwrap(self.module).head_roi(self.decode(x), slices, rows, cols)
+
+
+def inference_model(model, compile=True, channels_last=True, fold=True, mode=None):
+    """An eval-mode copy of model for app / serving: BatchNorm folded, channels_last, compiled"""
+    model = copy.deepcopy(unwrap(model)).eval()
+    if fold:
+        fold_bn(model)
+    return CompiledModel(model, compile, channels_last, mode).eval()
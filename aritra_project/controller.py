@@ -0,0 +1,87 @@
+import time
+import torch.optim as optim
+
+#learning-rate schedule, early stopping on a validation metric and best-state tracking for the epoch loop
+
+class TrainingController:
+    def __init__(self, optimizer, schedule=None, max_epochs=1000, steps_per_epoch=1, monitor='ssim', patience=None,
+                 min_delta=0.0, max_lr=None, plateau_factor=0.5, plateau_patience=10):
+        # schedule: None (constant lr), 'cosine', 'plateau' or 'onecycle'; monitor: 'ssim' or 'psnr', both maximised
+        self.optimizer = optimizer
+        self.schedule = schedule
+        self.max_epochs = max_epochs
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.scheduler = None
+        self.batch_scheduler = None
+        base_lr = optimizer.param_groups[0]['lr']
+        if schedule == 'cosine':
+            self.scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max_epochs)
+        elif schedule == 'plateau':
+            self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=plateau_factor,
+                                                                  patience=plateau_patience)
+        elif schedule == 'onecycle':
+            # stepped once per batch from inside my_train
+            self.batch_scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=max_lr or 10 * base_lr,
+                                                                 total_steps=max_epochs * steps_per_epoch)
+        elif schedule is not None:
+            raise ValueError("schedule must be None, 'cosine', 'plateau' or 'onecycle', got %r" % (schedule,))
+
+        self.best = None
+        self.best_epoch = 0
+        self.best_state = None
+        self.improved = False
+        self.epochs_run = 0
+        self.bad_epochs = 0
+        self.stopped = False
+        self.epoch_times = []
+        self._last = time.perf_counter()
+
+    def end_epoch(self, metrics, model):
+        # metrics: {'ssim': ..., 'psnr': ...} from my_eval; returns True when training should stop
+        now = time.perf_counter()
+        self.epoch_times.append(now - self._last)
+        self._last = now
+        self.epochs_run += 1
+
+        value = metrics[self.monitor]
+        self.improved = self.best is None or value > self.best + self.min_delta
+        if self.improved:
+            self.best = value
+            self.best_epoch = self.epochs_run
+            self.best_state = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+        if isinstance(self.scheduler, optim.lr_scheduler.ReduceLROnPlateau):
+            self.scheduler.step(value)
+        elif self.scheduler is not None:
+            self.scheduler.step()
+
+        self.stopped = self.patience is not None and self.bad_epochs >= self.patience
+        return self.stopped
+
+    def lr(self):
+        return self.optimizer.param_groups[0]['lr']
+
+    def restore_best(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+        return self.best_epoch
+
+    def report(self):
+        saved = self.max_epochs - self.epochs_run
+        per_epoch = sum(self.epoch_times) / max(len(self.epoch_times), 1)
+        return {
+            'epochs_run': self.epochs_run,
+            'max_epochs': self.max_epochs,
+            'stopped_early': self.stopped,
+            'best_epoch': self.best_epoch,
+            'best_%s' % self.monitor: self.best,
+            'epochs_saved': saved,
+            'compute_saved_fraction': saved / float(self.max_epochs),
+            'compute_saved_seconds': saved * per_epoch,
+        }
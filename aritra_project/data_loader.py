@@ -1,15 +1,30 @@
 import numpy as np
 import os
 import torch
-from generate_drr import do_full_prprocessing
-import albumentations as A
+from generate_drr import do_full_prprocessing, drr_views, drr_cache
+from augment import VolumeAugment
+from aug_pool import PoolData
+from shards import ShardData
+from volume_cache import VolumeCache, split_bytes
+from manifest import load_manifest, select, file_path
+from timing import null_timer
+from resources import plan_from_env
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 import ray
-import psutil
 
 
-num_cpus = psutil.cpu_count(logical=False)
-ray.init(num_cpus=num_cpus)
+# cores split between the model, the loader workers and the DRR kernels (resources.py, CPU_PLAN to override);
+# main.py applies the model's share to the training process
+
+cpu_plan = plan_from_env()
+
+# the default plan has no DRR workers: the loader workers project the DRRs themselves, as under torchrun. Ray is only
+# started for single-process runs whose CPU_PLAN asks for DRR workers
+
+use_ray = 'RANK' not in os.environ and cpu_plan.drr_workers > 0
+if use_ray:
+    cpu_plan.init_ray()
 
 # dataset paths
 
@@ -17,54 +32,69 @@ train = "/home/daisylabs/aritra_project/dataset/train"
 val = "/home/daisylabs/aritra_project/dataset/val"
 app = "/home/daisylabs/aritra_project/dataset/app"
 
+# DRR views fed to the network, in channel order; the README's best model uses ('frontal', 'lateral')
+
+all_views = ('frontal', 'lateral', 'top')
+
+
 
 class ImageData(Dataset):
-    def __init__(self, data, phase_coeff):
+    def __init__(self, data, phase_coeff, views=all_views, split=None, timer=null_timer, cache=None,
+                 drr_cache_dir=None):
+        for view in views:
+            if view not in all_views:
+                raise ValueError('unknown view %r, expected one of %s' % (view, all_views))
         self.root = data
-        self.folder = os.listdir(self.root)
-        self.folder.sort()
-        self.aug = A.Compose([
-            A.ShiftScaleRotate(shift_limit=0.15, scale_limit=0.15, rotate_limit=45, interpolation=1, border_mode=4, always_apply=False, p=0.3),
-            A.RandomCrop(220, 220, always_apply=False, p=1.0),
-            A.HorizontalFlip(always_apply=False, p=0.2),
-            A.VerticalFlip(always_apply=False, p=0.2),
-            A.ElasticTransform(alpha=1, sigma=50, alpha_affine=50, interpolation=1, border_mode=4, always_apply=False, p=0.5),
-            A.RandomBrightness(limit=0.2, always_apply=False, p=0.2),
-            A.RandomContrast(limit=0.2, always_apply=False, p=0.2),
-            A.MedianBlur(blur_limit=5, always_apply=False, p=0.2),
-            A.GaussNoise(var_limit=(10, 50), always_apply=False, p=0.2),
-            A.Resize(256, 256),
-        ])
+        self.views = tuple(views)
+        # file discovery happens once, here; items are plain lookups with no directory listing
+        self.manifest = load_manifest(self.root)
+        self.patients = select(self.manifest, self.views if phase_coeff == 0 else (), split)
+        self.folder = [p['id'] for p in self.patients]
+        self.aug = VolumeAugment(size=256)
         self.phase_coeff = phase_coeff
+        # per-item stages (load / augmentation / drr); inside DataLoader workers this is a worker_timer()
+        self.timer = timer
+        # decoded base volumes and DRRs shared by all workers (volume_cache.py); None reads from disk every time
+        self.cache = cache
+        # training DRRs kept in a drr_cache.DRRCache directory; only pays off when the same augmented volume comes back
+        self.drr_cache_dir = drr_cache_dir
 
     def __len__(self):
         return (len(self.folder))
 
+    def load(self, info):
+        path = file_path(self.manifest, info)
+        if self.cache is None:
+            return np.load(path)
+        # the size is part of the key, so a regenerated file is never served stale
+        return self.cache.get('%s:%d' % (path, info['bytes']), lambda: np.load(path))
+
     def __getitem__(self, index):
-        patient_list = os.listdir(os.path.join(self.root, self.folder[index]))
-        patient_list.sort()
+        patient = self.patients[index]
 
-        targets = np.load(os.path.join(self.root, self.folder[index], patient_list[0]))
-        targets = targets.astype('float32')
+        with self.timer.stage('load'):
+            targets = self.load(patient['ct'])
+            targets = targets.astype('float32')
 
         if (self.phase_coeff == 1):
-            targets = np.transpose(targets, (1, 2, 0))
-
-            transformed = self.aug(image=targets, mask=targets)
-            targets = transformed['mask']
-            targets = (targets - np.min(targets)) * (1.0 / (np.max(targets) - np.min(targets)))
-            targets = np.transpose(targets, (2, 0, 1))
-
-            targets_ray = ray.put(targets)
-
-            inputs = ray.get([do_full_prprocessing.remote(targets_ray)])
-
-            inputs = np.asarray(inputs)
-
-            inputs[0][1] = np.rot90(inputs[0][1])
-            inputs[0][1] = np.rot90(inputs[0][1])
-            inputs[0][1] = np.rot90(inputs[0][1])
+            with self.timer.stage('augmentation'):
+                targets, _ = self.aug(torch.from_numpy(targets))
+                targets = targets.numpy()
+
+            with self.timer.stage('drr'):
+                if use_ray:
+                    targets_ray = ray.put(targets)
+                    inputs = ray.get(do_full_prprocessing.remote(targets_ray, self.views, self.drr_cache_dir))
+                else:
+                    inputs = drr_views(targets, self.views,
+                                       drr_cache(self.drr_cache_dir) if self.drr_cache_dir else None)
+
+            # the numba projector returns the lateral view on its side
+            if 'lateral' in self.views:
+                lateral = self.views.index('lateral')
+                inputs[lateral] = np.rot90(inputs[lateral], 3)
 
+            inputs = np.array(inputs)
 
             inputs = torch.from_numpy(inputs)
             targets = torch.from_numpy(targets)
@@ -73,47 +103,53 @@ class ImageData(Dataset):
 
             inputs = []
 
-            inputs_front = np.load(os.path.join(self.root, self.folder[index], patient_list[1]))
-            inputs_lat = np.load(os.path.join(self.root, self.folder[index], patient_list[2]))
-            inputs_top = np.load(os.path.join(self.root, self.folder[index], patient_list[3]))
-            targets = np.load(os.path.join(self.root, self.folder[index], patient_list[0]))
-
-            inputs_front = inputs_front.astype('float32')
-            inputs_lat = inputs_lat.astype('float32')
-            inputs_top = inputs_top.astype('float32')
-            targets = targets.astype('float32')
-
-            inputs.append(inputs_front)
-            inputs.append(inputs_lat)
-            inputs.append(inputs_top)
+            # only the requested views are read from disk
+            with self.timer.stage('load_drr'):
+                for view in self.views:
+                    drr = self.load(patient['drr'][view])
+                    inputs.append(drr.astype('float32'))
 
             inputs = np.array(inputs)
 
             inputs = torch.from_numpy(inputs)
             targets = torch.from_numpy(targets)
 
-
-        inputs = inputs.cuda()
-        targets = targets.cuda()
-
         return inputs, targets
 
 
 
-def loaders(batch_size, phase):
+def loaders(batch_size, phase, pool_dir=None, views=all_views, distributed=False, timer=null_timer, shard_dir=None,
+            cache_bytes=0, drr_cache_dir=None):
 
-    if (phase == 0):
-        dataset = ImageData(train, 1)
+    if (shard_dir is not None):
+        # sequential shard streaming (shards.py); the dataset splits shards between workers and ranks itself
+        dataset = ShardData(shard_dir, views, train=phase == 0, batch_size=batch_size)
+    elif (phase == 0 and pool_dir is not None):
+        dataset = PoolData(pool_dir, views)
+    elif (phase == 0):
+        dataset = ImageData(train, 1, views, timer=timer.worker_timer(), drr_cache_dir=drr_cache_dir)
+        if cache_bytes:
+            dataset.cache = VolumeCache(cache_bytes)
     elif (phase == 1):
-        dataset = ImageData(val, 0)
+        dataset = ImageData(val, 0, views, timer=timer.worker_timer())
+        if cache_bytes:
+            # sized for the whole split when it fits, so from the second epoch on validation never touches the disk
+            dataset.cache = VolumeCache(min(cache_bytes, split_bytes(dataset.manifest, dataset.patients, views)
+                                            + (1 << 20) * len(dataset.patients)))
     elif (phase == 2):
-        dataset = ImageData(app, 0)
+        dataset = ImageData(app, 0, views)
+
+    # each rank sees its own shard of the patients; call loader.sampler.set_epoch(epoch) to reshuffle
+    iterable = isinstance(dataset, ShardData)
+    sampler = DistributedSampler(dataset, shuffle=True) if distributed and not iterable else None
 
     loader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=True,
-        num_workers=8
+        shuffle=sampler is None and not iterable,
+        sampler=sampler,
+        num_workers=cpu_plan.loader_workers,
+        worker_init_fn=cpu_plan.worker_init
     )
 
     return loader
@@ -0,0 +1,81 @@
+import argparse
+import os
+import socket
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+from network import UNet
+from train import my_train
+from eval import my_eval
+from distributed import init_distributed, cleanup
+
+#local multi-process check of the data-parallel path: 2-4 CPU ranks over gloo, a narrow UNet and synthetic data
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, args, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    torch.set_num_threads(1)
+    init_distributed('gloo')
+
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.rand(args.samples, 2, args.size, args.size, generator=generator)
+    targets = torch.rand(args.samples, 256, args.size, args.size, generator=generator)
+    dataset = TensorDataset(inputs, targets, torch.arange(args.samples))
+
+    sampler = DistributedSampler(dataset, shuffle=True, seed=0)
+    sampler.set_epoch(0)
+    seen = sorted(int(i) for i in sampler)
+
+    loader = DataLoader(TensorDataset(inputs, targets), batch_size=args.batch_size, sampler=sampler)
+
+    torch.manual_seed(0)
+    model = DistributedDataParallel(UNet(in_channels=2, width=args.width))
+    optimizer = optim.Adam(model.parameters(), lr=.00003, weight_decay=1e-4)
+
+    train = my_train(model, optimizer, loader, len(loader), 1, 0)
+    val = my_eval(model, loader, len(loader), 1, 0)
+
+    # after the step every replica must hold the same weights
+    checksum = sum(float(p.detach().double().sum()) for p in model.parameters())
+
+    results[rank] = {'seen': seen, 'train': train, 'val': val, 'checksum': checksum}
+    cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world-size', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--samples', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--size', type=int, default=16)
+    parser.add_argument('--width', type=float, default=1 / 32)
+    args = parser.parse_args()
+
+    for world_size in args.world_size:
+        results = mp.Manager().dict()
+        mp.spawn(worker, args=(world_size, free_port(), args, results), nprocs=world_size, join=True)
+        results = [results[r] for r in range(world_size)]
+
+        shards = [set(r['seen']) for r in results]
+        disjoint = sum(len(s) for s in shards) == len(set().union(*shards)) == args.samples
+        same_metrics = all(r['train'] == results[0]['train'] and r['val'] == results[0]['val'] for r in results)
+        same_weights = max(abs(r['checksum'] - results[0]['checksum']) for r in results) < 1e-6
+
+        print('world size', world_size, '-', 'disjoint shards', disjoint, '-', 'identical reduced metrics',
+              same_metrics, '-', 'replicas in sync', same_weights)
+        print('  train loss/PSNR/SSIM', ['%.4f' % v for v in results[0]['train']],
+              '- val loss/PSNR/SSIM', ['%.4f' % v for v in results[0]['val']])
+        if not (disjoint and same_metrics and same_weights):
+            raise SystemExit('data-parallel check failed for world size %d' % world_size)
+
+
+if __name__ == '__main__':
+    main()
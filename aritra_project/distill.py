@@ -0,0 +1,157 @@
+import hashlib
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import loss_metric
+from network import UNet
+from compiled import inference_model
+from distributed import unwrap
+from drr_cache import volume_key
+from volume_cache import VolumeCache
+
+#knowledge distillation: a frozen full-width UNet (the teacher) supervises a narrower one (the student). On top of the
+#usual loss1 / loss2 against the ground truth, the student matches the teacher's volume and reprojection with the same
+#losses, and the teacher's intermediate features through 1x1 adapters. Teacher outputs are cached on disk, keyed by the
+#teacher's weights and the input DRRs, so each (sample, augmentation) pair costs one teacher forward across epochs and
+#runs: with the augmentation pool (fixed variants) or for validation items the teacher stops running after one pass
+
+default_dir = os.environ.get('TEACHER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'teacher_cache'))
+
+# the bottleneck (2048 x 32 x 32) and the first decoder block (1024 x 64 x 64): 4 + 8 MB per item in float16, next to
+# the 32 MB volume; the later decoder blocks are 16 and 39 MB each
+feature_layers = ('dconv_down4', 'dconv_up32')
+
+
+def model_key(model):
+    """Hash of the weights and buffers: cached outputs of another teacher checkpoint are never served"""
+    digest = hashlib.blake2b(digest_size=20)
+    for name, tensor in unwrap(model).state_dict().items():
+        digest.update(name.encode())
+        digest.update(volume_key(tensor.detach().cpu().numpy()).encode())
+    return digest.hexdigest()
+
+
+class FeatureTap:
+    """Keeps the outputs of the named submodules of model from its last forward pass"""
+
+    def __init__(self, model, names):
+        self.outputs = {}
+        modules = dict(unwrap(model).named_modules())
+        self.handles = [modules[name].register_forward_hook(self._hook(name)) for name in names]
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            self.outputs[name] = output
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+class TeacherCache(VolumeCache):
+    """Persistent store of teacher outputs, one entry per (item key, output). Least recently used entries are evicted
+    beyond `capacity` bytes"""
+
+    def __init__(self, directory=default_dir, capacity=64 << 30):
+        super().__init__(capacity, directory)
+
+    def fetch(self, key, parts):
+        """{part: array} for key, or None unless every part is stored"""
+        out = {}
+        for part in parts:
+            try:
+                out[part] = np.load(self._path(key + '|' + part), mmap_mode='r')
+            except (FileNotFoundError, ValueError):
+                with self.lock:
+                    self.counters[1] += 1
+                return None
+        with self.lock:
+            self.counters[0] += 1
+        return out
+
+    def store(self, key, arrays):
+        for part, array in arrays.items():
+            self.put(key + '|' + part, array)
+
+
+class Teacher:
+    """The frozen teacher: outputs (out_1, out_2 and the feature layers) for a batch of inputs, from the cache where
+    present and from one forward pass over the missing items otherwise. Stored in float16: the volume is a sigmoid
+    output, ~1e-3 off, well below what the student gets right"""
+
+    def __init__(self, model, layers=feature_layers, cache=None, dtype=np.float16):
+        self.layers = tuple(layers)
+        self.parts = ('out_1', 'out_2') + self.layers
+        self.cache = cache
+        self.dtype = dtype
+        self.key = model_key(model) if cache is not None else None
+        # eval, BatchNorm folded, channels_last; not compiled, so the feature hooks see every call
+        self.model = inference_model(model, compile=False)
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        self.tap = FeatureTap(self.model, self.layers)
+        self.forwards = 0
+
+    def _run(self, inputs):
+        with torch.no_grad():
+            out_1, out_2 = self.model(inputs)
+        self.forwards += len(inputs)
+        out = {'out_1': out_1, 'out_2': out_2}
+        out.update((name, self.tap.outputs[name]) for name in self.layers)
+        return out
+
+    def __call__(self, inputs):
+        if self.cache is None:
+            return self._run(inputs)
+        keys = [self.key + ':' + volume_key(x) for x in inputs.cpu().numpy()]
+        found = [self.cache.fetch(key, self.parts) for key in keys]
+        missing = [i for i, f in enumerate(found) if f is None]
+        if missing:
+            computed = self._run(inputs[missing])
+            for j, i in enumerate(missing):
+                found[i] = {part: computed[part][j].cpu().numpy().astype(self.dtype) for part in self.parts}
+                self.cache.store(keys[i], found[i])
+        return {part: torch.from_numpy(np.stack([f[part] for f in found]).astype(np.float32)).to(inputs.device)
+                for part in self.parts}
+
+
+class Distiller(nn.Module):
+    """Adds the distillation terms to the student's loss. Its parameters are the 1x1 adapters from the student's
+    feature channels to the teacher's: train them with the student (optimizer over both)"""
+
+    def __init__(self, student, teacher, alpha=0.5, feature_weight=0.1):
+        super().__init__()
+        self.teacher = teacher
+        # alpha: share of the volume / reprojection loss taken against the teacher instead of the ground truth
+        self.alpha = alpha
+        self.feature_weight = feature_weight
+        bare = unwrap(student)
+        teacher_modules = dict(unwrap(teacher.model).named_modules())
+        student_modules = dict(bare.named_modules())
+        # every layer is a Sequential of conv, BN, ReLU blocks: its channels are those of the last conv (the teacher's
+        # BatchNorms are folded away)
+        channels = lambda module: [m for m in module.modules() if isinstance(m, nn.Conv2d)][-1].out_channels
+        self.adapters = nn.ModuleDict(
+            {name.replace('.', '_'): nn.Conv2d(channels(student_modules[name]), channels(teacher_modules[name]), 1)
+             for name in teacher.layers})
+        self.tap = FeatureTap(bare, teacher.layers)
+
+    def forward(self, loss, taught, out_1, out_2):
+        """The student loss: (1 - alpha) * loss (the usual one against the ground truth) + alpha * the same loss
+        against the teacher's outputs + feature_weight * the L2 distance of the adapted features"""
+        kd = loss_metric.loss1(out_1, taught['out_1'].reshape(out_1.shape)) + 0.5 * loss_metric.loss2(
+            out_2, taught['out_2'].reshape(out_2.shape))
+        features = sum(loss_metric.loss2(self.adapters[name.replace('.', '_')](self.tap.outputs[name]), taught[name])
+                       for name in self.teacher.layers)
+        return (1 - self.alpha) * loss + self.alpha * kd + self.feature_weight * features
+
+
+def load_teacher(checkpoint, in_channels, head='conv', device=None, layers=feature_layers, cache_dir=default_dir,
+                 cache_bytes=64 << 30):
+    model = UNet(in_channels=in_channels, head=head)
+    model.load_state_dict(torch.load(checkpoint, map_location=device or 'cpu'))
+    model.to(device or 'cpu')
+    cache = TeacherCache(cache_dir, cache_bytes) if cache_bytes else None
+    return Teacher(model, layers, cache)
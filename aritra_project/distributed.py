@@ -0,0 +1,66 @@
+import os
+import torch
+import torch.distributed as dist
+
+#process group setup and metric reduction for data-parallel training (torchrun / gloo on CPU-only hosts)
+
+def init_distributed(backend=None):
+    # a no-op unless launched by torchrun (or anything else that sets RANK / WORLD_SIZE)
+    if 'RANK' not in os.environ or dist.is_initialized():
+        return is_distributed()
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    dist.init_process_group(backend=backend)
+    if backend == 'nccl':
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return get_rank() == 0
+
+
+def get_device():
+    if torch.cuda.is_available():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return torch.device('cpu')
+
+
+def unwrap(model):
+    # the bare UNet behind DistributedDataParallel and / or CompiledModel wrappers, e.g. for state_dict()
+    while hasattr(model, 'module'):
+        model = model.module
+    return model
+
+
+def reduce_sum(values):
+    # element-wise sum of a list of floats over all ranks
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.cpu().tolist()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
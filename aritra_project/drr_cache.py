@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+import numpy as np
+from volume_cache import VolumeCache
+
+#content-addressed on-disk store of DRRs: key = hash of the volume contents + the projection parameters, so the same
+#projection of the same volume is computed once across runs and scripts
+
+default_dir = os.environ.get('DRR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'drr_cache'))
+
+
+def volume_key(volume):
+    # shape and dtype are part of the content: the same bytes read as another array are another volume
+    volume = np.ascontiguousarray(volume)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(('%s|%s|' % (volume.shape, volume.dtype)).encode())
+    digest.update(memoryview(volume).cast('B'))
+    return digest.hexdigest()
+
+
+class DRRCache(VolumeCache):
+    """Persistent DRR store shared by every process that points at the same directory; least recently used entries
+    are evicted once it holds more than `capacity` bytes. Hash the volume once with volume_key and look up each view
+    with its parameters (view, projector, resize, normalization)"""
+
+    def __init__(self, directory=default_dir, capacity=8 << 30):
+        super().__init__(capacity, directory)
+
+    def projection(self, key, params, compute):
+        """The DRR for volume key + params, from the store or compute() saved for next time"""
+        name = key + '|' + json.dumps(params, sort_keys=True)
+        return np.array(self.get(name, compute))
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python drr_cache.py [cache dir] [--clear]
+    args = [a for a in sys.argv[1:] if a != '--clear']
+    cache = DRRCache(args[0] if args else default_dir)
+    if '--clear' in sys.argv:
+        cache._evict(0)
+    stats = cache.stats()
+    print(cache.directory, '-', stats['entries'], 'entries', '-', '%.1f MB' % (stats['bytes'] / 2 ** 20))
@@ -0,0 +1,198 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+#projection geometry
+
+class ProjectionGeometry:
+    def __init__(self, angle=0.0, elevation=0.0, beam='parallel', source_distance=None, detector_distance=None,
+                 detector_shape=None, detector_spacing=None):
+        # angle rotates the view about volume axis 1 (frontal = 0, lateral = 90), elevation tilts it towards
+        # axis 1 (top = 90). Distances and spacing are in voxels, measured from the source / volume centre.
+        if beam not in ('parallel', 'cone'):
+            raise ValueError("beam must be 'parallel' or 'cone', got %r" % (beam,))
+        if beam == 'cone' and source_distance is None:
+            raise ValueError('cone-beam geometry needs a source_distance')
+
+        self.angle = angle
+        self.elevation = elevation
+        self.beam = beam
+        self.source_distance = source_distance
+        self.detector_distance = detector_distance
+        self.detector_shape = detector_shape
+        self.detector_spacing = detector_spacing
+
+    def __repr__(self):
+        return ('ProjectionGeometry(angle=%r, elevation=%r, beam=%r, source_distance=%r, detector_distance=%r, '
+                'detector_shape=%r, detector_spacing=%r)' % (self.angle, self.elevation, self.beam,
+                                                             self.source_distance, self.detector_distance,
+                                                             self.detector_shape, self.detector_spacing))
+
+    def frame(self):
+        a = math.radians(self.angle)
+        e = math.radians(self.elevation)
+
+        # frontal frame: detector rows along axis 1, columns along axis 2, rays along axis 0
+        rows = np.array([math.sin(e), math.cos(e), 0.0])
+        cols = np.array([0.0, 0.0, 1.0])
+        ray = np.array([math.cos(e), -math.sin(e), 0.0])
+
+        gantry = np.array([[math.cos(a), 0.0, -math.sin(a)],
+                           [0.0, 1.0, 0.0],
+                           [math.sin(a), 0.0, math.cos(a)]])
+
+        # snap the cos(90) ~ 6e-17 terms so axis-aligned views sample exact voxel centres
+        rows = np.round(gantry @ rows, 12)
+        cols = np.round(gantry @ cols, 12)
+        ray = np.round(gantry @ ray, 12)
+
+        return rows, cols, ray
+
+    def extent(self, axis, shape):
+        return int(round(float(np.sum(np.abs(axis) * (np.asarray(shape) - 1))))) + 1
+
+
+# axis-aligned views, oriented like generate_drr_from_ct with the lateral view already rotated upright
+VIEWS = {
+    'frontal': ProjectionGeometry(angle=0.0),
+    'lateral': ProjectionGeometry(angle=90.0),
+    'top': ProjectionGeometry(elevation=90.0),
+}
+
+
+def get_geometry(view):
+    if isinstance(view, ProjectionGeometry):
+        return view
+    try:
+        return VIEWS[view]
+    except KeyError:
+        raise ValueError('unknown view %r, expected one of %s' % (view, sorted(VIEWS)))
+
+
+def _sample_points(geometry, shape, device):
+    rows, cols, ray = geometry.frame()
+    shape = np.asarray(shape)
+    centre = (shape - 1) / 2.0
+
+    if geometry.detector_shape is not None:
+        n_rows, n_cols = geometry.detector_shape
+    else:
+        n_rows, n_cols = geometry.extent(rows, shape), geometry.extent(cols, shape)
+
+    # line integrals are normalised by the central ray length so axis-aligned views reduce to a mean
+    ray_length = geometry.extent(ray, shape)
+
+    if geometry.beam == 'parallel':
+        spacing = geometry.detector_spacing or 1.0
+        n_steps = ray_length
+    else:
+        sod = geometry.source_distance
+        sid = geometry.detector_distance or 2 * sod
+        spacing = geometry.detector_spacing or sid / sod
+        n_steps = int(math.ceil(float(np.linalg.norm(shape - 1)))) + 1
+
+    u = (torch.arange(n_rows, dtype=torch.float64, device=device) - (n_rows - 1) / 2.0) * spacing
+    v = (torch.arange(n_cols, dtype=torch.float64, device=device) - (n_cols - 1) / 2.0) * spacing
+    s = torch.arange(n_steps, dtype=torch.float64, device=device) - (n_steps - 1) / 2.0
+
+    rows = torch.as_tensor(rows, device=device)
+    cols = torch.as_tensor(cols, device=device)
+    ray = torch.as_tensor(ray, device=device)
+    centre = torch.as_tensor(centre, device=device)
+
+    detector = u[:, None, None] * rows + v[None, :, None] * cols
+
+    if geometry.beam == 'parallel':
+        return centre + detector[:, :, None, :] + s[None, None, :, None] * ray, ray_length
+
+    source = centre - sod * ray
+    direction = sid * ray + detector
+    direction = direction / torch.linalg.norm(direction, dim=-1, keepdim=True)
+    # march unit steps centred on each ray's closest approach to the volume centre
+    t = (direction * (centre - source)).sum(-1, keepdim=True)
+    t = t[:, :, None, :] + s[None, None, :, None]
+    return source + t * direction[:, :, None, :], ray_length
+
+
+def _axis_aligned(geometry):
+    # parallel views along a volume axis with the default detector are a plain reduction, no resampling
+    if geometry.beam != 'parallel' or geometry.detector_shape is not None:
+        return None
+    if geometry.detector_spacing not in (None, 1.0):
+        return None
+    rows, cols, ray = geometry.frame()
+    if not all(np.count_nonzero(a) == 1 for a in (rows, cols, ray)):
+        return None
+    row_axis, col_axis, ray_axis = (int(np.argmax(np.abs(a))) for a in (rows, cols, ray))
+    return ray_axis, (row_axis, rows.sum() < 0), (col_axis, cols.sum() < 0)
+
+
+def _to_grid(points, shape):
+    # voxel index -> grid_sample's [-1, 1] with align_corners=True, axes reversed to (x, y, z) = (2, 1, 0)
+    scale = torch.as_tensor([max(n - 1, 1) for n in shape], dtype=points.dtype, device=points.device)
+    grid = 2.0 * points / scale - 1.0
+    return grid.flip(-1).float()
+
+
+def project(volume, views=('frontal', 'lateral', 'top'), normalize=True, max_points=2 ** 23):
+    single = volume.dim() == 3 if torch.is_tensor(volume) else np.ndim(volume) == 3
+    volume = torch.as_tensor(volume, dtype=torch.float32)
+    if single:
+        volume = volume.unsqueeze(0)
+
+    batch = volume.shape[0]
+    shape = tuple(volume.shape[1:])
+
+    # linear attenuation of generate_drr_from_ct; zero padding outside the volume is air
+    mu = (0.2 / 1000.0) * (volume + 1000.0)
+    mu = mu.unsqueeze(1)
+
+    drrs = []
+    for view in views:
+        geometry = get_geometry(view)
+        aligned = _axis_aligned(geometry)
+        if aligned is not None:
+            ray_axis, (row_axis, row_flip), (col_axis, col_flip) = aligned
+            line = mu[:, 0].permute(0, row_axis + 1, col_axis + 1, ray_axis + 1).mean(-1)
+            flips = [d for d, flip in ((1, row_flip), (2, col_flip)) if flip]
+            if flips:
+                line = line.flip(flips)
+            drr = torch.exp(0.02 + line)
+            drrs.append(min_max(drr) if normalize else drr)
+            continue
+
+        points, ray_length = _sample_points(geometry, shape, volume.device)
+        n_rows, n_cols, n_steps = points.shape[:3]
+        chunk = max(1, max_points // (n_cols * n_steps))
+
+        line = []
+        for start in range(0, n_rows, chunk):
+            grid = _to_grid(points[start:start + chunk], shape)
+            grid = grid.unsqueeze(0).expand(batch, -1, -1, -1, -1)
+            samples = F.grid_sample(mu, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+            line.append(samples.sum(-1)[:, 0])
+        line = torch.cat(line, dim=1)
+
+        drr = torch.exp(0.02 + line / ray_length)
+        if normalize:
+            drr = min_max(drr)
+        drrs.append(drr)
+
+    if len(set(d.shape for d in drrs)) == 1:
+        out = torch.stack(drrs, dim=1)
+        return out[0] if single else out
+    return [d[0] for d in drrs] if single else drrs
+
+
+def min_max(drr):
+    flat = drr.reshape(drr.shape[0], -1)
+    low = flat.min(dim=1)[0].reshape(-1, 1, 1)
+    high = flat.max(dim=1)[0].reshape(-1, 1, 1)
+    return (drr - low) * (1.0 / (high - low))
+
+
+def generate_drr(ct_scan, view='frontal', normalize=False):
+    # numpy counterpart of generate_drr_from_ct for a single volume and view
+    drr = project(np.ascontiguousarray(ct_scan), views=(view,), normalize=normalize)
+    return drr[0].numpy()
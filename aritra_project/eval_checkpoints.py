@@ -0,0 +1,155 @@
+import argparse
+import csv
+import glob
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import loss_metric
+from network import UNet
+from manifest import load_manifest, select, file_path, view_suffix
+from resources import available_cores
+
+#many checkpoints against one validation split: the split is read from disk once into shared-memory tensors, then
+#every checkpoint is evaluated on it (in this process, or in worker processes that map the same memory), with the
+#loss / PSNR / SSIM of my_eval and the forward latency, written as one comparison table
+#
+#   python eval_checkpoints.py results/ 'sweep/*/output_best.pth' --views frontal lateral --workers 2 --output cmp.csv
+
+_data = None
+
+
+def load_split(root, views, split=None):
+    """(inputs, targets, ids) of every patient: (N, views, H, W) DRRs and (N, D, H, W) volumes, float32 tensors in
+    shared memory, each file read once straight into its slot"""
+    manifest = load_manifest(root)
+    patients = select(manifest, views, split)
+    if not patients:
+        raise ValueError('no patients in %s' % root)
+    first = patients[0]
+    inputs = torch.empty((len(patients), len(views)) + tuple(first['drr'][views[0]]['shape'])).share_memory_()
+    targets = torch.empty((len(patients),) + tuple(first['ct']['shape'])).share_memory_()
+    for i, p in enumerate(patients):
+        targets[i] = torch.from_numpy(np.load(file_path(manifest, p['ct'])).astype('float32'))
+        for j, view in enumerate(views):
+            inputs[i, j] = torch.from_numpy(np.load(file_path(manifest, p['drr'][view])).astype('float32'))
+    return inputs, targets, [p['id'] for p in patients]
+
+
+def build_model(state, depth, width=None):
+    """The UNet a state dict was saved from: views, head and (unless given) width read off the weights"""
+    first = state['dconv_down1.0.weight']
+    head = 'lift' if any(name.startswith('dconv.lift.') for name in state) else 'conv'
+    # width scales 300 channels to the first block's
+    width = width or first.shape[0] / 300.0
+    model = UNet(in_channels=first.shape[1], width=width, head=head, depth=depth)
+    model.load_state_dict(state)
+    return model, width, head
+
+
+def evaluate(path, inputs, targets, batch_size=2, width=None):
+    """my_eval's metrics (averaged over batches) of one checkpoint, plus timings"""
+    start = time.perf_counter()
+    state = torch.load(path, map_location='cpu')
+    model, width, head = build_model(state, targets.shape[1], width)
+    model.eval()
+    load_s = time.perf_counter() - start
+
+    loss, psnr, ssim, forward_s, batches = 0.0, 0.0, 0.0, 0.0, 0
+    with torch.no_grad():
+        for index in range(0, len(inputs), batch_size):
+            x, y = inputs[index:index + batch_size], targets[index:index + batch_size]
+            start = time.perf_counter()
+            out_1, out_2 = model(x)
+            forward_s += time.perf_counter() - start
+            out_1 = out_1.reshape(y.shape)
+            out_2 = out_2.reshape(x.shape)
+            loss_1, mse = loss_metric.loss1_mse(out_1, y)
+            loss += (loss_1 + 0.5 * loss_metric.loss2(out_2, x)).item()
+            psnr += loss_metric.psnr_from_mse(mse)
+            ssim += loss_metric.ssim(out_1, y).item()
+            batches += 1
+
+    return {'checkpoint': path, 'width': round(width, 4), 'head': head,
+            'params': sum(p.numel() for p in model.parameters()), 'loss': loss / batches, 'psnr': psnr / batches,
+            'ssim': ssim / batches, 'latency_s': forward_s / len(inputs), 'load_s': load_s}
+
+
+def _init(inputs, targets, threads):
+    # worker processes: the tensors arrive as handles to the parent's shared memory, not copies
+    global _data
+    torch.set_num_threads(threads)
+    _data = (inputs, targets)
+
+
+def _evaluate(job):
+    path, batch_size, width = job
+    return evaluate(path, _data[0], _data[1], batch_size, width)
+
+
+def evaluate_all(paths, inputs, targets, batch_size=2, width=None, workers=1):
+    """Rows of evaluate() in the order of paths; workers > 1 splits the checkpoints between processes, each with an
+    equal share of the cores"""
+    jobs = [(path, batch_size, width) for path in paths]
+    if workers <= 1:
+        _init(inputs, targets, torch.get_num_threads())
+        return [_evaluate(job) for job in jobs]
+    threads = max(1, len(available_cores()) // workers)
+    with mp.get_context('spawn').Pool(workers, _init, (inputs, targets, threads)) as pool:
+        return pool.map(_evaluate, jobs, chunksize=1)
+
+
+def expand(patterns):
+    # directories mean every .pth in them; anything else is a path or a glob
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths += sorted(glob.glob(os.path.join(pattern, '*.pth')))
+        else:
+            paths += sorted(glob.glob(pattern)) or [pattern]
+    return list(dict.fromkeys(paths))
+
+
+columns = ('checkpoint', 'width', 'head', 'params', 'loss', 'psnr', 'ssim', 'latency_s', 'load_s')
+
+
+def write_table(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoints', nargs='+', help='.pth files, globs or directories of them')
+    parser.add_argument('--root', default='/home/daisylabs/aritra_project/dataset/val')
+    parser.add_argument('--split', default=None, help="manifest split to keep (e.g. 'val'); default all patients")
+    parser.add_argument('--views', nargs='+', default=list(view_suffix))
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--width', type=float, default=None, help='UNet width; default read off each checkpoint')
+    parser.add_argument('--workers', type=int, default=1, help='checkpoints evaluated side by side')
+    parser.add_argument('--output', default=None, help='.csv comparison table')
+    args = parser.parse_args()
+
+    paths = expand(args.checkpoints)
+    start = time.perf_counter()
+    inputs, targets, ids = load_split(args.root, args.views, args.split)
+    print('validation split', '-', len(ids), 'patients', '-', '%.1f GB' % (
+        (inputs.numel() + targets.numel()) * 4 / 2 ** 30), 'resident', '-', 'loaded in %.1f s' % (
+        time.perf_counter() - start), flush=True)
+
+    start = time.perf_counter()
+    rows = evaluate_all(paths, inputs, targets, args.batch_size, args.width, args.workers)
+    print('%d checkpoints in %.1f s' % (len(rows), time.perf_counter() - start))
+    for row in sorted(rows, key=lambda r: -r['ssim']):
+        print(row['checkpoint'], '-', 'width', ':', row['width'], '-', 'head', ':', row['head'], '-', 'loss', ':',
+              '%.3f' % row['loss'], '-', 'PSNR(dB)', ':', '%.3f' % row['psnr'], '-', 'SSIM', ':', '%.3f' % row['ssim'],
+              '-', 'latency', ':', '%.3f s' % row['latency_s'])
+    if args.output:
+        write_table(rows, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import numpy as np
 from numba import jit
 import ray
 import cv2
+from drr_cache import DRRCache, volume_key
 
 @jit(nopython=True, parallel=True)
 def generate_drr_from_ct(ct_scan, direction='top'):
@@ -24,21 +25,41 @@ def generate_drr_from_ct(ct_scan, direction='top'):
 
 
 
-@ray.remote
-def do_full_prprocessing(ct_data):
-    drr_front = generate_drr_from_ct(ct_data, direction='frontal')
-    drr_lat = generate_drr_from_ct(ct_data, direction='lateral')
-    drr_top = generate_drr_from_ct(ct_data, direction='top')
+def min_max_drr(ct_data, view):
+    drr = generate_drr_from_ct(ct_data, direction=view)
+    drr = (drr - np.min(drr)) * (1.0 / (np.max(drr) - np.min(drr)))
+
+    #drr = cv2.resize(drr, (256, 256), interpolation=cv2.INTER_LINEAR)
+
+    return drr
+
 
-    drr_front = (drr_front - np.min(drr_front)) * (1.0 / (np.max(drr_front) - np.min(drr_front)))
-    drr_lat = (drr_lat - np.min(drr_lat)) * (1.0 / (np.max(drr_lat) - np.min(drr_lat)))
-    drr_top = (drr_top - np.min(drr_top)) * (1.0 / (np.max(drr_top) - np.min(drr_top)))
+def drr_views(ct_data, views=('frontal', 'lateral', 'top'), cache=None):
+    # views that are not requested are never projected. cache: a drr_cache.DRRCache, worth it for volumes that come
+    # back (validation, data generation, experiments), not for freshly augmented training targets
+    if cache is None:
+        return [min_max_drr(ct_data, view) for view in views]
 
-    #drr_front = cv2.resize(drr_front, (256, 256), interpolation=cv2.INTER_LINEAR)
-    #drr_lat = cv2.resize(drr_lat, (256, 256), interpolation=cv2.INTER_LINEAR)
-    #drr_top = cv2.resize(drr_top, (256, 256), interpolation=cv2.INTER_LINEAR)
+    key = volume_key(ct_data)
+    drrs = []
+    for view in views:
+        params = {'projector': 'generate_drr', 'view': view, 'normalize': 'min_max'}
+        drrs.append(cache.projection(key, params, lambda: min_max_drr(ct_data, view)))
 
-    return drr_front, drr_lat, drr_top
+    return drrs
 
 
+# one DRRCache per directory and process (Ray worker, DataLoader worker), opened on first use
+_caches = {}
 
+
+def drr_cache(directory):
+    if directory not in _caches:
+        _caches[directory] = DRRCache(directory)
+    return _caches[directory]
+
+
+@ray.remote
+def do_full_prprocessing(ct_data, views=('frontal', 'lateral', 'top'), cache_dir=None):
+    # cache_dir: a DRRCache directory, opt-in for the same reason as drr_views' cache
+    return drr_views(ct_data, views, drr_cache(cache_dir) if cache_dir else None)
@@ -5,21 +5,70 @@ import pytorch_ssim
 
 criterion = nn.MSELoss()
 
+
+def _sums(d, chunk=1 << 18):
+    # sum |d| and sum d ** 2 in one pass of chunks: the temporaries are one chunk, not the whole volume, and the
+    # partial sums are added in float64 (torch.linalg.vector_norm accumulates float32 naively on CPU, ~1e-3 off here).
+    # sum(dtype=float64) casts its chunk to float64 first, so the chunk stays small (2 MB as float64)
+    l1 = 0.0
+    sq = 0.0
+    for part in d.reshape(-1).split(chunk):
+        l1 += part.abs().sum(dtype=torch.float64)
+        sq += part.square().sum(dtype=torch.float64)
+    return l1.to(d.dtype), sq.to(d.dtype)
+
+
+class NormLoss(torch.autograd.Function):
+    # a * ||d||_1 + b * ||d||_2 for d = out_d - labels, from a single difference tensor: the reductions run chunk by
+    # chunk (no full-size |d| or d ** 2) and backward builds the gradient in one buffer. The second output is
+    # sum(d ** 2), for the MSE / PSNR of the same pair, and carries no gradient
+    @staticmethod
+    def forward(ctx, out_d, labels, a, b):
+        d = out_d.detach() - labels.detach()
+        l1, sq = _sums(d)
+        l2 = torch.sqrt(sq)
+        ctx.save_for_backward(d, l2)
+        ctx.a, ctx.b = a, b
+        ctx.mark_non_differentiable(sq)
+        return a * l1 + b * l2, sq
+
+    @staticmethod
+    def backward(ctx, grad, _):
+        d, l2 = ctx.saved_tensors
+        # a * sign(d) + b * d / ||d||_2, the same terms autograd would produce for the unfused expression
+        if ctx.a:
+            g = torch.sign(d)
+            if ctx.a != 1:
+                g.mul_(ctx.a)
+            g.addcmul_(d, ctx.b / l2)
+        else:
+            g = d * (ctx.b / l2)
+        g.mul_(grad)
+        grad_labels = -g if ctx.needs_input_grad[1] else None
+        return (g if ctx.needs_input_grad[0] else None), grad_labels, None, None
+
+
 def loss1(out_d, labels):
-    l = (out_d - labels)
-    loss_1 = 0.1 * torch.sum(torch.abs(l)) + 0.9 * torch.sqrt(torch.sum(l ** 2))
+    loss_1, _ = NormLoss.apply(out_d, labels, 0.1, 0.9)
     return loss_1
 
 def loss2(out_d, labels):
-    l = (out_d - labels)
-    loss_2 = torch.sqrt(torch.sum(l ** 2))
+    loss_2, _ = NormLoss.apply(out_d, labels, 0.0, 1.0)
     return loss_2
 
+def loss1_mse(out_d, labels):
+    # loss1 and the MSE that psnr needs, from the same pass over the difference
+    loss_1, sq = NormLoss.apply(out_d, labels, 0.1, 0.9)
+    return loss_1, sq / out_d.numel()
+
+def psnr_from_mse(mse):
+    return 10 * math.log10(1 / float(mse))
+
 def psnr(out_d, labels):
-    mse = criterion(out_d, labels)
-    metric = 10 * math.log10(1 / mse.item())
-    return metric
+    with torch.no_grad():
+        mse = _sums(out_d - labels)[1] / out_d.numel()
+    return psnr_from_mse(mse)
 
 def ssim(out_d, labels):
     metric1 = pytorch_ssim.ssim(out_d, labels)
-    return metric1
\ No newline at end of file
+    return metric1
@@ -1,27 +1,127 @@
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from network import UNet
-from data_loader import loaders
+from data_loader import loaders, train, all_views, use_ray, cpu_plan
 from train import my_train
 from eval import my_eval
 from visualize import my_vis
 from app import my_app
+from aug_pool import build_pool, PoolRefresher
+from controller import TrainingController
+from timing import StageTimer
+from compiled import CompiledModel
+from distill import Distiller, load_teacher
+from distributed import init_distributed, get_device, is_main, unwrap, barrier, cleanup
 import numpy as np
 import ray
 
+#data-parallel training: launch with `torchrun --nproc_per_node=N main.py` (gloo on CPU-only hosts, nccl on GPUs);
+#a plain `python main.py` is the single-process run
+
+distributed = init_distributed()
+device = get_device()
+
+#cpu split (resources.py): torch / OpenMP threads of this process, loader workers and Ray DRR workers; export
+#CPU_PLAN='model=..,loader=..,drr=..x..,pin=..' (see benchmark_resources.py) to override the default
+
+cpu_plan.apply()
+if is_main():
+    print('cpu plan', ':', cpu_plan, '-', 'cores', ':', len(cpu_plan.cores))
+
+#augmentation pool (optional): K augmented variants per patient generated offline, a fraction refreshed each epoch
+
+use_pool = False
+pool_dir = '/home/daisylabs/aritra_project/dataset/pool'
+pool_variants = 8
+pool_refresh = 0.1
+
+#sharded records (optional): CT volumes and DRRs packed into large sequential files by shards.py, streamed instead of
+#loading one patient directory at a time
+
+use_shards = False
+shard_dirs = {'train': '/home/daisylabs/aritra_project/dataset/shards/train',
+              'val': '/home/daisylabs/aritra_project/dataset/shards/val'}
+
+#volume cache (optional): decoded CT volumes and DRRs kept once in shared memory (/dev/shm) for all loader workers;
+#the validation split stays resident after the first epoch when it fits. Each of the two loaders (and each rank under
+#torchrun) gets its own cache of up to cache_gb, so size /dev/shm for that. 0 disables it
+
+cache_gb = 0
+
+#DRR cache (optional): training DRRs stored by volume hash in drr_cache_dir (drr_cache.py) and reused across epochs and
+#runs. A random augmentation is a new volume every draw, so this only pays off when the training volumes repeat;
+#None projects every DRR
+
+drr_cache_dir = None
+
+#input views (in channel order); ('frontal', 'lateral') is the README's best configuration
+
+views = all_views
+
+#profiling (optional): per-stage wall time (data wait, h2d, forward, loss, backward, optimizer, metrics and the
+#loader's load / augmentation / drr) printed every epoch; trace_dir also writes a torch profiler trace for a few steps
+
+profile = False
+timer = StageTimer(enabled=profile, shared=True, trace_dir=None)
+
+#compiled execution (optional): torch.compile and channels_last for training and validation, eager if compilation
+#fails; the app then runs a BatchNorm-folded compiled copy
+
+compiled = False
+
 #data loading
 batch_size = 2
-loader_tr = loaders(batch_size, 0)
-loader_vl = loaders(batch_size, 1)
+# the pool lives on shared storage: rank 0 builds and refreshes it, the other ranks only read
+if use_pool and is_main():
+    build_pool(train, pool_dir, pool_variants, views=views)
+    refresher = PoolRefresher(pool_dir, pool_refresh)
+barrier()
+loader_tr = loaders(batch_size, 0, pool_dir if use_pool else None, views, distributed, timer,
+                    shard_dirs['train'] if use_shards else None, int(cache_gb * 2 ** 30), drr_cache_dir)
+loader_vl = loaders(batch_size, 1, views=views, distributed=distributed, timer=timer,
+                    shard_dir=shard_dirs['val'] if use_shards else None, cache_bytes=int(cache_gb * 2 ** 30))
+
+#networks: head 'conv' is the published one-channel-per-slice output, 'lift' the 3D lifting head (network.LiftingHead)
+
+head = 'conv'
+
+#distillation (optional): a frozen full-width teacher supervises a narrower student of width student_width (volume,
+#reprojection and intermediate-feature matching, distill.py). Copy the trained full model's output_best.pth to
+#teacher_checkpoint first: the student's own checkpoints go to output.pth / output_best.pth as usual. Teacher outputs
+#are cached on disk per (sample, augmentation) in teacher_cache_dir, with the augmentation pool only: on-the-fly
+#augmentation never repeats an input, so without the pool (or with 0 GB) the teacher runs on every batch
 
-#networks
+distill = False
+teacher_checkpoint = '/home/daisylabs/aritra_project/results/teacher.pth'
+student_width = 0.25
+teacher_cache_dir = '/home/daisylabs/aritra_project/dataset/teacher_cache'
+teacher_cache_gb = 200
 
-output = UNet()
+width = student_width if distill else 1.0
+output = UNet(in_channels=len(views), width=width, head=head)
 
-output.cuda()
+output.to(device)
+
+distiller = None
+if distill:
+    teacher = load_teacher(teacher_checkpoint, len(views), head, device, cache_dir=teacher_cache_dir,
+                           cache_bytes=int(teacher_cache_gb * 2 ** 30) if use_pool else 0)
+    distiller = Distiller(output, teacher).to(device)
+
+if distributed:
+    output = DistributedDataParallel(output, device_ids=[device.index] if device.type == 'cuda' else None)
+
+if distiller is not None and distributed:
+    # the adapters are trained too: their gradients are averaged like the student's
+    distiller = DistributedDataParallel(distiller, device_ids=[device.index] if device.type == 'cuda' else None)
+
+if compiled:
+    output = CompiledModel(output)
 
 #optimizer
 
-optimizer = optim.Adam(output.parameters(), lr=.00003, weight_decay=1e-4)
+parameters = list(output.parameters()) + (list(distiller.parameters()) if distiller is not None else [])
+optimizer = optim.Adam(parameters, lr=.00003, weight_decay=1e-4)
 
 #training
 
@@ -30,22 +130,27 @@ metric_values, metric1_values, val_metric_values, val_metric1_values, epoch_valu
 no_of_epochs = 1000
 no_of_batches = len(loader_tr)
 no_of_batches_1 = len(loader_vl)
-best_metric = 0
+
+#lr schedule (None, 'cosine', 'plateau' or 'onecycle') and early stopping on validation SSIM; patience=None trains
+#for all epochs
+
+controller = TrainingController(optimizer, schedule=None, max_epochs=no_of_epochs, steps_per_epoch=no_of_batches,
+                                monitor='ssim', patience=None, min_delta=0.001)
 
 for epoch in range(no_of_epochs):
+    if use_pool and is_main():
+        refresher.step()
+
+    if use_shards:
+        loader_tr.dataset.set_epoch(epoch)
+    elif distributed:
+        loader_tr.sampler.set_epoch(epoch)
+
     epoch_loss, epoch_acc, epoch_acc1 = my_train(output, optimizer, loader_tr, no_of_batches,
-                                                 no_of_epochs, epoch)
+                                                 no_of_epochs, epoch, controller.batch_scheduler, timer, distiller)
 
     running_val_loss, running_val_metric, running_val_metric1 = my_eval(output, loader_vl,
-                                                                        no_of_batches_1, no_of_epochs, epoch)
-
-    print('epoch', epoch + 1, 'of', no_of_epochs, '-', 'train loss', ':',
-          "%.3f" % round((epoch_loss), 3), '-', 'train PSNR(dB)', ':', "%.3f" % round((epoch_acc), 3), '-',
-          'train SSIM', ':',
-          "%.3f" % round((epoch_acc1), 3), '-', 'val loss', ':', "%.3f" % round((running_val_loss), 3), '-',
-          'val PSNR(dB)', ':',
-          "%.3f" % round((running_val_metric), 3), '-', 'val SSIM', ':',
-          "%.3f" % round((running_val_metric1), 3))
+                                                                        no_of_batches_1, no_of_epochs, epoch, timer)
 
     metric_values.append(round(epoch_acc, 3))
     val_metric_values.append(round(running_val_metric, 3))
@@ -56,39 +161,80 @@ for epoch in range(no_of_epochs):
     metric1_values.append(round(epoch_acc1, 3))
     val_metric1_values.append(round(running_val_metric1, 3))
 
-    current_metric = round(running_val_metric1, 3)
+    epoch_values.append(epoch + 1)
+
+    # metrics are already all-reduced, so every rank takes the same decisions
+    stop = controller.end_epoch({'ssim': running_val_metric1, 'psnr': running_val_metric}, unwrap(output))
 
-    if(current_metric>best_metric):
-        best_metric_coeff = 1
-        best_metric = current_metric
-    else:
-        best_metric_coeff = 0
+    best_metric_coeff = 1 if controller.improved else 0
 
-    epoch_values.append(epoch + 1)
+    # only rank 0 prints, plots and checkpoints
+    if is_main():
+        print('epoch', epoch + 1, 'of', no_of_epochs, '-', 'train loss', ':',
+              "%.3f" % round((epoch_loss), 3), '-', 'train PSNR(dB)', ':', "%.3f" % round((epoch_acc), 3), '-',
+              'train SSIM', ':',
+              "%.3f" % round((epoch_acc1), 3), '-', 'val loss', ':', "%.3f" % round((running_val_loss), 3), '-',
+              'val PSNR(dB)', ':',
+              "%.3f" % round((running_val_metric), 3), '-', 'val SSIM', ':',
+              "%.3f" % round((running_val_metric1), 3), '-', 'lr', ':', "%.2e" % controller.lr())
+
+        with timer.stage('checkpoint'):
+            my_vis(epoch_values, loss_values, val_loss_values, metric_values, val_metric_values, metric1_values,
+                   val_metric1_values, unwrap(output), best_metric_coeff)
+
+        vmv = np.amax(np.asarray(val_metric_values))
+        vm1v = np.amax(np.asarray(val_metric1_values))
+        vlv = np.amin(np.asarray(val_loss_values))
+
+        print('Maximum Validation PSNR(dB)', ':', "%.3f" % vmv)
+        print('Maximum Validation SSIM', ':', "%.3f" % vm1v)
+        print('Minimum Validation Loss', ':', "%.3f" % vlv)
 
-    my_vis(epoch_values, loss_values, val_loss_values, metric_values, val_metric_values, metric1_values,
-           val_metric1_values, output, best_metric_coeff)
+        np.save('/home/daisylabs/aritra_project/results/val_psnr_values.npy', val_metric_values)
+        np.save('/home/daisylabs/aritra_project/results/val_ssim_values.npy', val_metric1_values)
+        np.save('/home/daisylabs/aritra_project/results/val_loss_values.npy', val_loss_values)
 
-    vmv = np.amax(np.asarray(val_metric_values))
-    vm1v = np.amax(np.asarray(val_metric1_values))
-    vlv = np.amin(np.asarray(val_loss_values))
+        np.save('/home/daisylabs/aritra_project/results/psnr_values.npy', metric_values)
+        np.save('/home/daisylabs/aritra_project/results/ssim_values.npy', metric1_values)
+        np.save('/home/daisylabs/aritra_project/results/loss_values.npy', loss_values)
 
-    print('Maximum Validation PSNR(dB)', ':', "%.3f" % vmv)
-    print('Maximum Validation SSIM', ':', "%.3f" % vm1v)
-    print('Minimum Validation Loss', ':', "%.3f" % vlv)
+        if profile:
+            print(timer.format_report('stage breakdown, epoch %d' % (epoch + 1)))
 
-    np.save('/home/daisylabs/aritra_project/results/val_psnr_values.npy', val_metric_values)
-    np.save('/home/daisylabs/aritra_project/results/val_ssim_values.npy', val_metric1_values)
-    np.save('/home/daisylabs/aritra_project/results/val_loss_values.npy', val_loss_values)
+        for name, loader in (('train', loader_tr), ('val', loader_vl)):
+            cache = getattr(loader.dataset, 'cache', None)
+            if cache is not None:
+                stats = cache.stats()
+                print(name, 'volume cache', '-', 'hits', ':', stats['hits'], '-', 'misses', ':', stats['misses'], '-',
+                      'hit rate', ':', "%.2f" % stats['hit_rate'], '-', 'evictions', ':', stats['evictions'], '-',
+                      'resident', ':', "%.2f" % (stats['bytes'] / 2 ** 30), 'GB')
 
-    np.save('/home/daisylabs/aritra_project/results/psnr_values.npy', metric_values)
-    np.save('/home/daisylabs/aritra_project/results/ssim_values.npy', metric1_values)
-    np.save('/home/daisylabs/aritra_project/results/loss_values.npy', loss_values)
+    timer.reset()
 
+    if stop:
+        break
 
-ray.shutdow()
+
+# continue from the best validation state (the one saved as output_best.pth)
+best_epoch = controller.restore_best(unwrap(output))
+
+if is_main():
+    report = controller.report()
+    print('Stopped early' if report['stopped_early'] else 'Ran all epochs', '-', 'epochs', ':', report['epochs_run'],
+          'of', report['max_epochs'], '-', 'best epoch', ':', best_epoch, '-', 'epochs saved', ':',
+          report['epochs_saved'], '(', "%.1f" % (100 * report['compute_saved_fraction']), '%', ',',
+          "%.0f" % report['compute_saved_seconds'], 's', ')')
+
+if use_pool and is_main():
+    refresher.close()
+
+if use_ray:
+    ray.shutdown()
 print('Finished Training')
 
 #app
 
-my_app()
+if is_main():
+    my_app(views, compiled, head, width)
+
+cleanup()
@@ -0,0 +1,144 @@
+import ast
+import hashlib
+import json
+import os
+import numpy as np
+
+#dataset manifest: per-patient file paths, shapes, dtypes, spacing and normalization stats, built once per root
+
+manifest_name = 'manifest.json'
+
+# file name suffixes written by data_generation.py / data_generation_kaggle.py
+view_suffix = {'frontal': '_drrFrontal', 'lateral': '_drrLateral', 'top': '_drrTop'}
+
+
+def _array_info(root, relpath, stats=False):
+    path = os.path.join(root, relpath)
+    array = np.load(path, mmap_mode='r')
+    info = {'path': relpath, 'shape': list(array.shape), 'dtype': str(array.dtype), 'bytes': os.path.getsize(path)}
+
+    if stats:
+        # slab by slab so a 512^3 volume never has to be resident twice
+        low, high, total, total_sq = np.inf, -np.inf, 0.0, 0.0
+        for start in range(0, array.shape[0], 32):
+            slab = np.asarray(array[start:start + 32], dtype=np.float64)
+            low = min(low, float(slab.min()))
+            high = max(high, float(slab.max()))
+            total += float(slab.sum())
+            total_sq += float(np.square(slab).sum())
+        mean = total / array.size
+        std = float(np.sqrt(max(total_sq / array.size - mean ** 2, 0.0)))
+        info['stats'] = {'min': low, 'max': high, 'mean': mean, 'std': std}
+
+    return info
+
+
+def _read_spacing(path):
+    # "original_spacing: [1.25, 0.703125, 0.703125]" in the _info.txt of data_generation_kaggle.py
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key.strip() == 'original_spacing':
+                return [float(x) for x in ast.literal_eval(value.strip())]
+    return None
+
+
+def build_manifest(root, stats=True):
+    patients = []
+    for patient in sorted(os.listdir(root)):
+        folder = os.path.join(root, patient)
+        if not os.path.isdir(folder):
+            continue
+
+        names = set(os.listdir(folder))
+        ct_name = patient + '.npy'
+        if ct_name not in names:
+            print('manifest', '-', patient, '-', 'no CT volume', ct_name, '- skipped')
+            continue
+
+        entry = {
+            'id': patient,
+            'ct': _array_info(root, os.path.join(patient, ct_name), stats),
+            'drr': {},
+            'spacing': _read_spacing(os.path.join(folder, patient + '_info.txt')),
+            'split': None,
+        }
+        for view, suffix in view_suffix.items():
+            name = patient + suffix + '.npy'
+            if name in names:
+                entry['drr'][view] = _array_info(root, os.path.join(patient, name))
+        patients.append(entry)
+
+    return {'root': os.path.abspath(root), 'patients': patients}
+
+
+def save_manifest(manifest, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_manifest(root, path=None, rebuild=False):
+    path = path or os.path.join(root, manifest_name)
+    if rebuild or not os.path.exists(path):
+        manifest = build_manifest(root)
+        save_manifest(manifest, path)
+        return manifest
+    with open(path) as f:
+        manifest = json.load(f)
+    # the dataset may have moved since the manifest was written; paths are relative to it
+    manifest['root'] = os.path.abspath(root)
+    return manifest
+
+
+def file_path(manifest, info):
+    return os.path.join(manifest['root'], info['path'])
+
+
+def select(manifest, views=(), split=None):
+    patients = manifest['patients']
+    if split is not None:
+        patients = [p for p in patients if p['split'] == split]
+    for p in patients:
+        missing = [view for view in views if view not in p['drr']]
+        if missing:
+            raise ValueError('patient %s has no %s DRR in %s' % (p['id'], ', '.join(missing), manifest['root']))
+    return patients
+
+
+def verify(manifest):
+    # cheap integrity check: every listed file exists with the recorded size
+    problems = []
+    for p in manifest['patients']:
+        for info in [p['ct']] + list(p['drr'].values()):
+            path = file_path(manifest, info)
+            if not os.path.exists(path):
+                problems.append((p['id'], info['path'], 'missing'))
+            elif os.path.getsize(path) != info['bytes']:
+                problems.append((p['id'], info['path'], 'size changed'))
+    return problems
+
+
+def assign_splits(manifest, fractions=(('train', 0.8), ('val', 0.2)), seed=0):
+    # each patient id hashes to a fixed point in [0, 1), so adding patients never moves existing ones
+    for p in manifest['patients']:
+        digest = hashlib.sha1(('%s:%s' % (seed, p['id'])).encode()).hexdigest()
+        point = int(digest[:12], 16) / float(16 ** 12)
+        upper = 0.0
+        for split, fraction in fractions:
+            upper += fraction
+            p['split'] = split
+            if point < upper:
+                break
+    return manifest
+
+
+if __name__ == '__main__':
+    import sys
+
+    for root in sys.argv[1:]:
+        manifest = load_manifest(root, rebuild=True)
+        print(root, '-', len(manifest['patients']), 'patients', '-', len(verify(manifest)), 'integrity problems')
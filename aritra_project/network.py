@@ -1,5 +1,7 @@
 import torch.nn as nn
 import torch
+import torch.nn.functional as F
+import math
 
 #network
 
@@ -26,31 +28,144 @@ def single_out(in_channels, out_channels):
         nn.Sigmoid()
     )
 
+def slice_batch_norm(x, bn):
+    # training-mode bn applied to each (1, 1, h, w) image of x separately, as one op: every image is normalized with
+    # its own statistics (an instance norm) and the running statistics get each image's momentum update, in order
+    n = x.shape[0]
+    with torch.no_grad():
+        mean = x.mean(dim=(1, 2, 3), dtype=torch.float64)
+        var = x.double().var(dim=(1, 2, 3))
+        decay = (1 - bn.momentum) ** torch.arange(n - 1, -1, -1, dtype=torch.float64, device=x.device)
+        keep = (1 - bn.momentum) ** n
+        bn.running_mean.copy_(keep * bn.running_mean.double() + bn.momentum * (decay * mean).sum())
+        bn.running_var.copy_(keep * bn.running_var.double() + bn.momentum * (decay * var).sum())
+        bn.num_batches_tracked.add_(n)
+    return F.instance_norm(x, weight=bn.weight, bias=bn.bias, eps=bn.eps)
+
+def roi_range(span, size):
+    # (start, stop) of an output axis; None is the whole axis
+    start, stop = (0, size) if span is None else (int(span[0]), int(span[1]))
+    if not 0 <= start < stop <= size:
+        raise ValueError('range %s outside [0, %d) or empty' % ((start, stop), size))
+    return start, stop
+
+class LiftingHead(nn.Module):
+    # 2D decoder features -> (depth, h, w) volume without one output channel per slice: average-pool by `factor`,
+    # a 1x1 conv to channels x coarse_depth maps read as a coarse 3D feature volume, then stride-2 transposed 3D convs
+    # (halving the channels) back to full size, depth-only stages first while depth needs more doubling than h and w.
+    # The output depth costs stages at the coarse end, not 2D channels at full resolution
+    def __init__(self, in_channels, depth=256, channels=8, coarse_depth=None, factor=2):
+        super().__init__()
+        # default: 1/4 of the depth (64 slices for 256), one depth-only stage ahead of the factor-2 plane stage; factor 4
+        # with 1/8 of the depth costs less but trained to a lower PSNR in benchmark_heads.py
+        coarse_depth = coarse_depth or max(depth // 4, 1)
+        self.channels = channels
+        self.depth = depth
+        self.coarse_depth = coarse_depth
+        self.factor = factor
+
+        depth_stages = int(round(math.log2(depth / coarse_depth)))
+        plane_stages = int(round(math.log2(factor)))
+        if coarse_depth << depth_stages != depth or 1 << plane_stages != factor or depth_stages < max(plane_stages, 1):
+            raise ValueError('depth / coarse_depth and factor must be powers of two, with depth / coarse_depth >= '
+                             'factor; got depth=%d, coarse_depth=%d, factor=%d' % (depth, coarse_depth, factor))
+
+        self.pool = nn.AvgPool2d(factor)
+        self.lift = nn.Sequential(
+            nn.Conv2d(in_channels, channels * coarse_depth, 1),
+            nn.BatchNorm2d(channels * coarse_depth, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+            nn.ReLU(inplace=True)
+        )
+        strides = [(2, 1, 1)] * (depth_stages - plane_stages) + [(2, 2, 2)] * plane_stages
+        stages = []
+        c = channels
+        for stride in strides[:-1]:
+            stages += [nn.ConvTranspose3d(c, max(c // 2, 2), stride, stride=stride),
+                       nn.BatchNorm3d(max(c // 2, 2), eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+                       nn.ReLU(inplace=True)]
+            c = max(c // 2, 2)
+        self.up = nn.Sequential(*stages)
+        # the last stage goes straight to the one output channel: nothing else is held at full resolution
+        self.out = nn.Sequential(
+            nn.ConvTranspose3d(c, 1, strides[-1], stride=strides[-1]),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        b, _, h, w = x.shape
+        x = self.lift(self.pool(x))
+        x = x.reshape(b, self.channels, self.coarse_depth, h // self.factor, w // self.factor)
+        return self.out(self.up(x)).squeeze(1)
+
+    def roi(self, x, slices, rows, cols):
+        # every output voxel comes from one coarse voxel (kernel = stride everywhere): lift only the coarse window
+        # covering the ROI, and only its coarse slices (the rows of the 1x1 conv and BN that produce them), then crop
+        b = x.shape[0]
+        step, depth_step = self.factor, self.depth // self.coarse_depth
+        (s0, s1), (r0, r1), (c0, c1) = slices, rows, cols
+        d0, d1 = s0 // depth_step, -(-s1 // depth_step)
+        y0, y1, x0, x1 = r0 // step, -(-r1 // step), c0 // step, -(-c1 // step)
+        conv, bn, relu = self.lift
+        index = (torch.arange(self.channels, device=x.device)[:, None] * self.coarse_depth
+                 + torch.arange(d0, d1, device=x.device)).reshape(-1)
+        x = F.conv2d(self.pool(x[..., y0 * step:y1 * step, x0 * step:x1 * step]), conv.weight[index],
+                     None if conv.bias is None else conv.bias[index])
+        if isinstance(bn, nn.BatchNorm2d):
+            # inference statistics (fold_bn may have folded this BN into the conv already)
+            x = F.batch_norm(x, bn.running_mean[index], bn.running_var[index], bn.weight[index], bn.bias[index],
+                             False, 0.0, bn.eps)
+        x = relu(x).reshape(b, self.channels, d1 - d0, y1 - y0, x1 - x0)
+        x = self.out(self.up(x)).squeeze(1)
+        return x[:, s0 - d0 * depth_step:s1 - d0 * depth_step, r0 - y0 * step:r1 - y0 * step,
+                 c0 - x0 * step:c1 - x0 * step]
+
 class UNet(nn.Module):
 
-    def __init__(self):
+    def __init__(self, in_channels=3, width=1.0, head='conv', depth=256):
         super().__init__()
 
-        self.dconv_down1 = double_conv(3, 300)
-        self.dconv_down2 = double_conv(300, 512)
-        self.dconv_down3 = double_conv(512, 1024)
-        self.dconv_down4 = double_conv(1024, 2048)
+        # one input channel per DRR view; the reprojection head predicts the same views back
+        self.in_channels = in_channels
+
+        # head: 'conv' is the published 1x1 conv with one output channel per slice, 'lift' the LiftingHead
+        if head not in ('conv', 'lift'):
+            raise ValueError("head must be 'conv' or 'lift', got %r" % (head,))
+        self.head = head
+        # output slices; the output plane is the DRR size (the network is fully convolutional over it)
+        self.depth = depth
+
+        # width scales every encoder/decoder block; 1.0 is the published 300-512-1024-2048 network
+        c1, c2, c3, c4 = (max(1, int(round(c * width))) for c in (300, 512, 1024, 2048))
+
+        self.dconv_down1 = double_conv(in_channels, c1)
+        self.dconv_down2 = double_conv(c1, c2)
+        self.dconv_down3 = double_conv(c2, c3)
+        self.dconv_down4 = double_conv(c3, c4)
 
         self.maxpool = nn.MaxPool2d(2)
         self.dropout = nn.Dropout(0.5)
         self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
-        self.dconv_up31 = single_out1(3072, 2048)
-        self.dconv_up32 = single_out1(2048, 1024)
-        self.dconv_up21 = single_out1(1536, 1024)
-        self.dconv_up22 = single_out1(1024, 512)
-        self.dconv_up11 = single_out1(812, 512)
-        self.dconv_up12 = single_out1(512, 300)
-        self.dconv = single_out(300, 256)
+        self.dconv_up31 = single_out1(c4 + c3, c4)
+        self.dconv_up32 = single_out1(c4, c3)
+        self.dconv_up21 = single_out1(c3 + c2, c3)
+        self.dconv_up22 = single_out1(c3, c2)
+        self.dconv_up11 = single_out1(c2 + c1, c2)
+        self.dconv_up12 = single_out1(c2, c1)
+        self.dconv = single_out(c1, depth) if head == 'conv' else LiftingHead(c1, depth)
         self.dconv1 = single_out1(1, 1)
-        self.dconv2 = single_out(1, 3)
+        self.dconv2 = single_out(1, in_channels)
 
     def forward(self, x):
+        out_1 = self.volume(x)
+        return out_1, self.reproject(out_1)
+
+    def volume(self, x):
+        # the 256-slice reconstruction alone; inference that does not need the reprojected views stops here
+        return self.dconv(self.decode(x))
+
+    def decode(self, x):
+        # the decoder features every output slice is computed from
         conv1 = self.dconv_down1(x)
         x = self.maxpool(conv1)
 
@@ -81,31 +196,38 @@ class UNet(nn.Module):
         x = self.dconv_up11(x)
         x = self.dconv_up12(x)
 
-        x = self.dconv(x)
-
-        out_1 = x
-
-        i = out_1.shape[0]
-        j = out_1.shape[1]
-
-        for u in range(i):
-            out_1_1 = out_1[u]
-            for v in range(j):
-                out_1_1_1 = out_1_1[v]
-                out_1_1_1 = out_1_1_1.unsqueeze(0)
-                out_1_1_1 = out_1_1_1.unsqueeze(0)
-                out_1_1_1 = self.dconv1(out_1_1_1)
-                if (v == 0):
-                    out_2_1_1 = out_1_1_1
-                else:
-                    out_2_1_1 = torch.cat([out_2_1_1, out_1_1_1], dim=1)
-            out_2_1 = torch.sum(out_2_1_1, dim=1)
-            out_2_1 = out_2_1.unsqueeze(0)
-            out_2_1 = self.dconv2(out_2_1)
-            if (u == 0):
-                out_2 = out_2_1
-            else:
-                out_2 = torch.cat([out_2, out_2_1], dim=0)
-
-        return out_1, out_2
-
+        return x
+
+    def volume_roi(self, x, slices=None, rows=None, cols=None):
+        """volume(x)[:, slices, rows, cols] without the rest of the head: slices, rows and cols are (start, stop)
+        output ranges, None for the whole axis. The encoder / decoder still runs in full (every output pixel sees
+        a wide neighbourhood); the head computes only the requested slices over the requested window"""
+        return self.head_roi(self.decode(x), slices, rows, cols)
+
+    def head_roi(self, features, slices=None, rows=None, cols=None):
+        """The head of volume_roi, on decode(x)"""
+        depth = self.dconv[0].out_channels if self.head == 'conv' else self.dconv.depth
+        slices = roi_range(slices, depth)
+        rows = roi_range(rows, features.shape[-2])
+        cols = roi_range(cols, features.shape[-1])
+        (s0, s1), (r0, r1), (c0, c1) = slices, rows, cols
+        if self.training:
+            # batch statistics of the lifting head's BatchNorms depend on the whole output: run it all, then crop
+            return self.dconv(features)[:, s0:s1, r0:r1, c0:c1]
+        if self.head == 'lift':
+            return self.dconv.roi(features, slices, rows, cols)
+        # the 1x1 conv is pointwise: its output slices are the rows of the weight, its pixels those of the input
+        conv, activation = self.dconv
+        out = F.conv2d(features[..., r0:r1, c0:c1], conv.weight[s0:s1],
+                       None if conv.bias is None else conv.bias[s0:s1])
+        return activation(out)
+
+    def reproject(self, out_1):
+        # dconv1 sees every slice of every sample as its own one-channel image, dconv2 the per-sample sum of them;
+        # all slices go through as one batch
+        b, c, h, w = out_1.shape
+        conv, bn, relu = self.dconv1
+        x = conv(out_1.reshape(b * c, 1, h, w))
+        x = slice_batch_norm(x, bn) if self.training else bn(x)
+        x = relu(x).reshape(b, c, h, w)
+        return self.dconv2(torch.sum(x, dim=1, keepdim=True))
@@ -0,0 +1,118 @@
+import threading
+import time
+import torch
+import torch.nn.functional as F
+
+#coarse-to-fine reconstruction: the UNet is fully convolutional over the DRR plane, so a forward pass on DRRs
+#area-downsampled to size x size costs ~(size / 256)^2 of the full one; its 256 output slices are pooled to size,
+#giving a size^3 preview. Levels run smallest first and the last one is the normal full-resolution output
+
+
+def level_input(drrs, size):
+    if size >= drrs.shape[-1]:
+        return drrs
+    return F.interpolate(drrs, size=(size, size), mode='area')
+
+
+def level_volume(out_1, size):
+    # (batch, slices, size, size) -> (batch, size, size, size), averaging groups of slices
+    if size >= out_1.shape[1]:
+        return out_1
+    return F.adaptive_avg_pool3d(out_1.unsqueeze(1), (size, size, size)).squeeze(1)
+
+
+# the UNet pools three times and concatenates the upsampled maps with the skips: sides must divide by 2^3
+level_multiple = 8
+
+
+def check_levels(levels, full):
+    """Sorted distinct level sizes, capped at the DRR size; ValueError for sizes the UNet cannot run at"""
+    levels = sorted(set(min(size, full) for size in levels))
+    bad = [size for size in levels if size <= 0 or size % level_multiple]
+    if bad:
+        raise ValueError('level sizes must be positive multiples of %d, got %s' % (level_multiple, bad))
+    return levels
+
+
+def refine(model, drrs, levels=(64, 128, 256)):
+    """Yields (size, volume, seconds) per level, on demand: the next level is only computed when the caller asks for
+    it, so a caller satisfied with a preview just stops iterating. model: UNet or anything with .volume (CompiledModel)"""
+    levels = check_levels(levels, drrs.shape[-1])
+    with torch.no_grad():
+        for size in levels:
+            start = time.perf_counter()
+            out_1 = model.volume(level_input(drrs, size))
+            yield size, level_volume(out_1, size), time.perf_counter() - start
+
+
+class ProgressiveReconstruction:
+    """Background refinement: every level is computed on a worker thread as soon as the previous one is done.
+    latest() returns the best volume so far without waiting, wait(size) blocks until that level (or the full volume)
+    is ready, cancel() stops after the level in progress. on_level(size, volume) is called from the worker thread."""
+
+    def __init__(self, model, drrs, levels=(64, 128, 256), on_level=None):
+        self.results = {}
+        self.times = {}
+        self.error = None
+        # set by the worker thread on its way out, under _ready: it is still alive after its last notify
+        self.finished = False
+        self.levels = check_levels(levels, drrs.shape[-1])
+        self._cancel = threading.Event()
+        self._ready = threading.Condition()
+        self._on_level = on_level
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, args=(model, drrs), daemon=True)
+        self.thread.start()
+
+    def _run(self, model, drrs):
+        try:
+            for size, volume, _ in refine(model, drrs, self.levels):
+                with self._ready:
+                    self.results[size] = volume
+                    # time to this level from the start of the request, not just its own forward pass
+                    self.times[size] = time.perf_counter() - self.started
+                    self._ready.notify_all()
+                if self._on_level is not None:
+                    self._on_level(size, volume)
+                if self._cancel.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._ready:
+                self.finished = True
+                self._ready.notify_all()
+
+    def latest(self):
+        """(size, volume) of the finest level ready so far, or (None, None)"""
+        with self._ready:
+            if not self.results:
+                return None, None
+            size = max(self.results)
+            return size, self.results[size]
+
+    def wait(self, size=None, timeout=None):
+        """Blocks until the level `size` (default: the full volume) or a finer one is ready, the work stops, or
+        timeout runs out; returns latest()"""
+        size = self.levels[-1] if size is None else size
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._ready:
+            while not any(s >= size for s in self.results) and not self.finished:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            # with the last level (or after its last notify) the thread only has on_level and its exit left; a caller
+            # exiting before the thread does aborts the interpreter
+            ending = self.finished or self.levels[-1] in self.results
+        if ending and threading.current_thread() is not self.thread:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.latest()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def done(self):
+        return self.levels[-1] in self.results
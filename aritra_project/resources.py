@@ -0,0 +1,139 @@
+import os
+import sys
+import psutil
+import torch
+
+#one split of the cores between the training process (torch / OpenMP / BLAS threads), the DataLoader workers and the
+#DRR kernels (Ray workers running the parallel numba projector), instead of every library sizing itself to the whole
+#machine. Training defaults to DRRs projected in the loader workers without Ray (drr=0x1); set CPU_PLAN (e.g.
+#'model=8,loader=4,drr=0x2', or 'model=8,loader=2,drr=6x1,pin=1' for Ray DRR workers where Ray works from forked
+#loader workers; benchmark_resources.py searches for one) to override the default split; under torchrun every rank
+#splits its own share of the cores
+
+# read once, when each library loads its thread pool; set for processes started after the plan is known
+thread_vars = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS', 'NUMBA_NUM_THREADS')
+
+
+def thread_env(threads):
+    return {name: str(threads) for name in thread_vars}
+
+
+def available_cores():
+    """Core ids this process (this rank, under torchrun) may use: the affinity mask, one logical CPU per physical core
+    (Linux numbers SMT siblings after the first thread of every core), divided between the local ranks"""
+    allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    physical = psutil.cpu_count(logical=False) or len(allowed)
+    logical = psutil.cpu_count() or len(allowed)
+    cores = allowed[:max(1, len(allowed) * physical // logical)]
+    local_world = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world > 1:
+        per_rank = max(1, len(cores) // local_world)
+        start = int(os.environ.get('LOCAL_RANK', 0)) * per_rank % len(cores)
+        cores = cores[start:start + per_rank]
+    return cores
+
+
+def set_threads(threads):
+    """torch intra-op and (already loaded) numba threads of the calling process"""
+    torch.set_num_threads(threads)
+    numba = sys.modules.get('numba')
+    if numba is not None:
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+
+class CpuPlan:
+    """model_threads for the training process, loader_workers DataLoader workers and drr_workers Ray workers with
+    drr_threads numba threads each. drr_workers=0 keeps Ray out of training: the loader workers project the DRRs
+    themselves, with drr_threads numba threads each. With pin every role runs on its own cores, in that order; a plan
+    larger than the cores wraps around"""
+
+    def __init__(self, model_threads, loader_workers, drr_workers, drr_threads=1, pin=False, cores=None):
+        self.model_threads = model_threads
+        self.loader_workers = loader_workers
+        self.drr_workers = drr_workers
+        self.drr_threads = drr_threads
+        self.pin = pin
+        self.cores = list(cores) if cores is not None else available_cores()
+
+    def __str__(self):
+        return 'model=%d,loader=%d,drr=%dx%d,pin=%d' % (self.model_threads, self.loader_workers, self.drr_workers,
+                                                        self.drr_threads, self.pin)
+
+    @classmethod
+    def parse(cls, spec, cores=None):
+        fields = dict(item.split('=', 1) for item in spec.replace(' ', '').split(',') if item)
+        unknown = set(fields) - {'model', 'loader', 'drr', 'pin'}
+        if unknown:
+            raise ValueError('unknown CPU_PLAN fields %s in %r' % (', '.join(sorted(unknown)), spec))
+        drr_workers, _, drr_threads = fields.get('drr', '1x1').partition('x')
+        return cls(int(fields.get('model', 1)), int(fields.get('loader', 1)), int(drr_workers),
+                   int(drr_threads or 1), fields.get('pin', '0') not in ('0', 'false', ''), cores)
+
+    def assignment(self):
+        """{role: core ids}; the loader role gets one core per worker (drr_threads without Ray), the DRR role
+        drr_workers * drr_threads"""
+        loader = self.loader_workers * (1 if self.drr_workers else self.drr_threads)
+        counts = (('model', self.model_threads), ('loader', loader), ('drr', self.drr_workers * self.drr_threads))
+        out, start = {}, 0
+        for role, count in counts:
+            out[role] = [self.cores[(start + i) % len(self.cores)] for i in range(count)]
+            start += count
+        return out
+
+    def apply(self):
+        """Threads (and cores, with pin) of the training process; call before the first forward pass"""
+        set_threads(max(1, self.model_threads))
+        try:
+            # one inter-op thread: the UNet is a chain, there is nothing to run side by side
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # only possible before any parallel work has started
+            pass
+        if self.pin and self.model_threads:
+            os.sched_setaffinity(0, self.assignment()['model'])
+
+    def worker_init(self, worker_id):
+        """DataLoader worker_init_fn"""
+        threads = 1 if self.drr_workers else self.drr_threads
+        set_threads(threads)
+        if self.pin and self.loader_workers:
+            cores = self.assignment()['loader']
+            os.sched_setaffinity(0, [cores[(worker_id * threads + i) % len(cores)] for i in range(threads)])
+
+    def init_ray(self, **kwargs):
+        """ray.init with drr_workers CPUs and workers started with drr_threads OpenMP / numba threads; with pin the
+        Ray processes inherit the DRR cores"""
+        import ray
+        env = dict(kwargs.pop('runtime_env', {}) or {})
+        env['env_vars'] = dict(thread_env(self.drr_threads), **env.get('env_vars', {}))
+        previous = os.sched_getaffinity(0) if self.pin else None
+        if self.pin:
+            os.sched_setaffinity(0, self.assignment()['drr'])
+        try:
+            ray.init(num_cpus=max(1, self.drr_workers), runtime_env=env, **kwargs)
+        finally:
+            if previous is not None:
+                os.sched_setaffinity(0, previous)
+
+
+def default_plan(cores=None, use_ray=False, train=True, pin=False):
+    """Half the cores to the model, the rest to data; without a model (preprocessing) everything goes to DRR tasks.
+    Training projects the DRRs in the loader workers unless use_ray: Ray calls from forked DataLoader workers hang or
+    crash on some Ray versions (benchmark_resources.py shows whether they work on a machine)"""
+    cores = list(cores) if cores is not None else available_cores()
+    n = len(cores)
+    if not train:
+        return CpuPlan(0, 0, n, 1, pin, cores)
+    model = max(1, n // 2)
+    if not use_ray:
+        # the loader workers project the DRRs themselves, one numba thread each
+        return CpuPlan(model, max(1, n - model), 0, 1, pin, cores)
+    # with Ray the loader workers mostly wait for DRRs: a few of them, the rest of the cores to the kernels
+    loader = max(1, n // 8)
+    return CpuPlan(model, loader, max(1, n - model - loader), 1, pin, cores)
+
+
+def plan_from_env(use_ray=False, train=True):
+    spec = os.environ.get('CPU_PLAN')
+    return CpuPlan.parse(spec) if spec else default_plan(use_ray=use_ray, train=train)
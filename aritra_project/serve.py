@@ -0,0 +1,253 @@
+import argparse
+import collections
+import io
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from network import UNet, roi_range
+from manifest import view_suffix
+from distributed import get_device
+from compiled import inference_model
+from distributed import unwrap
+
+#long-running reconstruction service: UNet loaded once, concurrent requests coalesced into batches
+#
+#   POST /reconstruct[?dtype=float16|uint8|float32]   body: .npy of one DRR set, (views, 256, 256) float
+#                    [&slices=a:b][&rows=a:b][&cols=a:b]
+#                                                      reply: .npy of the (256, 256, 256) volume, or of the
+#                                                      (b - a, ...) sub-volume when a region is requested
+#   GET  /stats                                        latency, queue depth and batch size counters (JSON)
+#
+#the volume is a sigmoid output in [0, 1]: float16 (default, 32 MB) keeps it to ~1e-3, uint8 (16 MB) to 1/255
+
+reply_dtypes = {'float32': np.float32, 'float16': np.float16, 'uint8': np.uint8}
+
+
+class Request:
+    __slots__ = ('drrs', 'roi', 'volume', 'error', 'done', 'arrived')
+
+    def __init__(self, drrs, roi=None):
+        self.drrs = drrs
+        # (slices, rows, cols) ranges, None for the whole volume
+        self.roi = roi
+        self.volume = None
+        self.error = None
+        self.done = threading.Event()
+        self.arrived = time.perf_counter()
+
+
+class Batcher:
+    """One model thread: waits for a request, then keeps collecting until max_batch requests or max_wait seconds
+    after the first, and runs them through the network together"""
+
+    def __init__(self, model, device, max_batch=4, max_wait=0.01):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.batch_sizes = collections.Counter()
+        self.counters = {'requests': 0, 'errors': 0, 'batches': 0, 'max_queue_depth': 0, 'model_s': 0.0}
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, drrs, roi=None):
+        request = Request(drrs, roi)
+        self.queue.put(request)
+        with self.lock:
+            self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self.queue.qsize())
+        request.done.wait()
+        with self.lock:
+            self.counters['requests'] += 1
+            self.latencies.append(time.perf_counter() - request.arrived)
+            if request.error is not None:
+                self.counters['errors'] += 1
+        return request
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                inputs = torch.from_numpy(np.stack([r.drrs for r in batch])).to(self.device)
+                # only the volume: the reprojection head is a training-time output
+                with torch.no_grad():
+                    if all(r.roi is None for r in batch):
+                        out_1 = list(self.model.volume(inputs).cpu().numpy())
+                    else:
+                        # the trunk once for the batch, the head of each request over its own region only
+                        features = self.model.decode(inputs)
+                        head = unwrap(self.model).head_roi
+                        out_1 = [head(features[i:i + 1], *(r.roi or (None, None, None)))[0].cpu().numpy()
+                                 for i, r in enumerate(batch)]
+                for r, volume in zip(batch, out_1):
+                    r.volume = volume
+            except Exception as e:
+                for r in batch:
+                    r.error = str(e)
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['model_s'] += time.perf_counter() - start
+                self.batch_sizes[len(batch)] += 1
+            for r in batch:
+                r.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            counters = dict(self.counters)
+            sizes = dict(self.batch_sizes)
+        batched = sum(n * count for n, count in sizes.items())
+        out = {'uptime_s': time.time() - self.started, 'queue_depth': self.queue.qsize(),
+               'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000.0,
+               'batch_sizes': {str(n): sizes[n] for n in sorted(sizes)},
+               'mean_batch': batched / float(counters['batches']) if counters['batches'] else 0.0}
+        out.update(counters)
+        if len(latencies):
+            out['latency_ms'] = {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                                 'p90': float(np.percentile(latencies, 90)),
+                                 'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}
+        return out
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def make_handler(batcher, views, size, depth=256):
+    expected = (len(views), size, size)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._reply(code, json.dumps({'error': message}).encode(), 'application/json')
+
+        def do_GET(self):
+            if self.path.split('?')[0] == '/stats':
+                self._reply(200, json.dumps(batcher.stats()).encode(), 'application/json')
+            else:
+                self._error(404, 'not found')
+
+        def do_POST(self):
+            path, _, query = self.path.partition('?')
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if path != '/reconstruct':
+                return self._error(404, 'not found')
+            params = dict(p.split('=', 1) for p in query.split('&') if '=' in p)
+            dtype = params.get('dtype', 'float16')
+            if dtype not in reply_dtypes:
+                return self._error(400, 'dtype must be one of %s' % ', '.join(reply_dtypes))
+            roi = None
+            if any(axis in params for axis in ('slices', 'rows', 'cols')):
+                # slices index the model's output depth, rows / cols the output plane (the DRR size)
+                try:
+                    roi = tuple(roi_range(params[axis].split(':', 1), extent) if axis in params else None
+                                for axis, extent in (('slices', depth), ('rows', size), ('cols', size)))
+                except (ValueError, IndexError) as e:
+                    return self._error(400, 'slices must be start:stop within [0, %d), rows / cols within [0, %d): %s'
+                                       % (depth, size, e))
+            try:
+                drrs = np.load(io.BytesIO(body), allow_pickle=False)
+            except Exception as e:
+                return self._error(400, 'body is not a .npy array: %s' % str(e))
+            if drrs.shape == (1,) + expected:
+                drrs = drrs[0]
+            if drrs.shape != expected:
+                return self._error(400, 'expected DRRs of shape %s (%s), got %s' % (expected, ', '.join(views),
+                                                                                  drrs.shape))
+
+            request = batcher.submit(np.ascontiguousarray(drrs, dtype=np.float32), roi)
+            if request.error is not None:
+                return self._error(500, request.error)
+            volume = request.volume
+            if dtype == 'uint8':
+                volume = np.rint(volume * 255.0)
+            self._reply(200, to_npy(volume.astype(reply_dtypes[dtype])), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def load_model(checkpoint, views, width=1.0, device=None, compiled=False, head='conv'):
+    device = device or get_device()
+    model = UNet(in_channels=len(views), width=width, head=head)
+    if checkpoint:
+        model.load_state_dict(torch.load(checkpoint, map_location=device))
+    model.to(device)
+    model.eval()
+    if compiled:
+        # BatchNorm folded, channels_last, torch.compile; compiles on the first batch of each size
+        model = inference_model(model)
+    return model, device
+
+
+def serve(checkpoint, views=tuple(view_suffix), host='127.0.0.1', port=8080, max_batch=4, max_wait=0.01, width=1.0,
+          size=256, compiled=False, head='conv'):
+    model, device = load_model(checkpoint, views, width, compiled=compiled, head=head)
+    batcher = Batcher(model, device, max_batch, max_wait)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, tuple(views), size, unwrap(model).depth))
+    server.daemon_threads = True
+    print('serving', checkpoint or 'untrained weights', '-', 'views', ':', ', '.join(views), '-',
+          'http://%s:%d' % server.server_address[:2], '-', 'max batch', ':', max_batch, '-',
+          'max wait', ':', '%.1f ms' % (max_wait * 1000), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default='/home/daisylabs/aritra_project/results/output_best.pth',
+                        help="state dict saved by training; '' serves untrained weights")
+    parser.add_argument('--views', nargs='+', default=list(view_suffix))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=4)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0)
+    parser.add_argument('--width', type=float, default=1.0)
+    parser.add_argument('--compiled', action='store_true')
+    parser.add_argument('--head', default='conv', choices=['conv', 'lift'], help='head the checkpoint was trained with')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    serve(args.checkpoint, args.views, args.host, args.port, args.max_batch, args.max_wait_ms / 1000.0, args.width,
+          compiled=args.compiled, head=args.head)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import json
+import math
+import os
+import random
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from aug_pool import make_variant
+from distributed import get_rank, get_world_size
+from manifest import load_manifest, file_path
+
+#sharded training records: CT volumes and DRRs packed back to back into large files, read front to back
+
+all_views = ('frontal', 'lateral', 'top')
+
+index_name = 'shards.json'
+
+# records start on page boundaries, so readahead and the page cache never straddle two patients
+_align = 4096
+
+
+def _aligned(offset):
+    return (offset + _align - 1) // _align * _align
+
+
+def write_shards(root, shard_dir, shard_bytes=2 << 30, dtype=None):
+    """Packs every patient of a dataset root (CT + whatever DRRs it has) into shard files of about shard_bytes.
+    dtype=None keeps the stored dtype; 'float16' halves the I/O"""
+    manifest = load_manifest(root)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shards = []
+    current = None
+    for patient in manifest['patients']:
+        if current is None or current['bytes'] >= shard_bytes:
+            if current is not None:
+                f.close()
+                os.replace(tmp, os.path.join(shard_dir, current['name']))
+            current = {'name': 'shard-%05d.bin' % len(shards), 'bytes': 0, 'patients': []}
+            shards.append(current)
+            tmp = os.path.join(shard_dir, current['name'] + '.tmp')
+            f = open(tmp, 'wb')
+
+        # one record: the CT volume followed by the DRRs, contiguous, so a patient is a single sequential read
+        record = {'id': patient['id'], 'offset': current['bytes'], 'arrays': {}}
+        offset = current['bytes']
+        for key, info in [('ct', patient['ct'])] + sorted(patient['drr'].items()):
+            array = np.load(file_path(manifest, info))
+            if dtype is not None:
+                array = array.astype(dtype)
+            array = np.ascontiguousarray(array)
+            f.seek(offset)
+            f.write(array.tobytes())
+            record['arrays'][key] = {'offset': offset, 'shape': list(array.shape), 'dtype': str(array.dtype),
+                                     'nbytes': array.nbytes}
+            offset += array.nbytes
+        record['nbytes'] = offset - record['offset']
+        current['bytes'] = _aligned(offset)
+        current['patients'].append(record)
+
+    if current is not None:
+        f.close()
+        os.replace(tmp, os.path.join(shard_dir, current['name']))
+
+    # the index is written last: a reader never sees shards that are still being written
+    index = {'root': os.path.abspath(root), 'shards': shards}
+    tmp = os.path.join(shard_dir, index_name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(shard_dir, index_name))
+    return index
+
+
+def load_index(shard_dir):
+    with open(os.path.join(shard_dir, index_name)) as f:
+        return json.load(f)
+
+
+def read_shard(path, records, readahead=True):
+    """Yields (record, {key: array}) for the given records of one shard, in file order with one read per record"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if readahead and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        records = sorted(records, key=lambda r: r['offset'])
+        for i, record in enumerate(records):
+            # ask the kernel for the next record while this one is decoded and used
+            if readahead and hasattr(os, 'posix_fadvise') and i + 1 < len(records):
+                following = records[i + 1]
+                os.posix_fadvise(fd, following['offset'], following['nbytes'], os.POSIX_FADV_WILLNEED)
+
+            buffer = bytearray(record['nbytes'])
+            view = memoryview(buffer)
+            done = 0
+            while done < record['nbytes']:
+                n = os.preadv(fd, [view[done:]], record['offset'] + done)
+                if n == 0:
+                    raise IOError('%s is truncated at record %s' % (path, record['id']))
+                done += n
+
+            arrays = {}
+            for key, info in record['arrays'].items():
+                start = info['offset'] - record['offset']
+                arrays[key] = np.frombuffer(buffer, dtype=info['dtype'], count=int(np.prod(info['shape'])),
+                                            offset=start).reshape(info['shape'])
+            yield record, arrays
+    finally:
+        os.close(fd)
+
+
+class ShardData(IterableDataset):
+    """Streaming counterpart of ImageData over a shard directory.
+
+    Shards are shuffled per epoch and split between DataLoader workers (and DDP ranks) without overlap; inside a
+    shard records are read in file order and mixed through a shuffle buffer of `buffer` patients. train=True does the
+    training-phase work (augment, then project the DRRs); train=False returns the stored DRRs."""
+
+    def __init__(self, shard_dir, views=all_views, train=True, buffer=4, seed=0, readahead=True, batch_size=1):
+        for view in views:
+            if view not in all_views:
+                raise ValueError('unknown view %r, expected one of %s' % (view, all_views))
+        self.shard_dir = shard_dir
+        self.views = tuple(views)
+        self.train = train
+        self.buffer = buffer
+        self.seed = seed
+        self.readahead = readahead
+        # the DataLoader's: workers get whole batches, so no worker ends on an extra partial one
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.shards = load_index(shard_dir)['shards']
+        self.count = sum(len(s['patients']) for s in self.shards)
+        if not train:
+            for shard in self.shards:
+                for record in shard['patients']:
+                    missing = [view for view in views if view not in record['arrays']]
+                    if missing:
+                        raise ValueError('patient %s has no %s DRR in %s' % (record['id'], ', '.join(missing),
+                                                                             shard_dir))
+
+    def set_epoch(self, epoch):
+        # like DistributedSampler.set_epoch: same shard order on every rank, a new one every epoch
+        self.epoch = epoch
+
+    def __len__(self):
+        # patients this rank sees per epoch: the records padded to a multiple of the world size, like DistributedSampler
+        return int(math.ceil(self.count / float(get_world_size())))
+
+    def _assignment(self):
+        worker = get_worker_info()
+        workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        world, rank = get_world_size(), get_rank()
+
+        rng = random.Random(self.seed + self.epoch)
+        order = list(range(len(self.shards)))
+        rng.shuffle(order)
+        records = [(i, r) for i in order for r in self.shards[i]['patients']]
+
+        # under DDP every rank has to run the same number of steps: padded cyclically to a multiple of the world size
+        pad = -len(records) % world
+        if pad:
+            records += (records * math.ceil(pad / len(records)))[:pad]
+        per_rank = len(records) // world
+        records = records[rank * per_rank:(rank + 1) * per_rank]
+
+        # contiguous runs of the shuffled shard order per worker, so each reads (mostly) whole shards front to back. The
+        # runs are whole batches, all but the last worker's, so the workers' batches add up to len(loader)
+        batches = int(math.ceil(len(records) / float(self.batch_size)))
+        per_worker = int(math.ceil(batches / float(workers))) * self.batch_size
+        records = records[worker_id * per_worker:(worker_id + 1) * per_worker]
+        return [(self.shards[i], [r for j, r in records if j == i]) for i in order]
+
+    def _item(self, arrays):
+        targets = arrays['ct'].astype('float32')
+        if self.train:
+            inputs, targets = make_variant(targets, views=self.views)
+        else:
+            inputs = np.array([arrays[view].astype('float32') for view in self.views])
+        return torch.from_numpy(inputs), torch.from_numpy(targets)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        rng = random.Random(self.seed + self.epoch * 1000003 + get_rank() * 1009 + (worker.id if worker else 0))
+
+        pending = []
+        for shard, records in self._assignment():
+            if not records:
+                continue
+            path = os.path.join(self.shard_dir, shard['name'])
+            for _, arrays in read_shard(path, records, self.readahead):
+                pending.append(arrays)
+                if len(pending) >= self.buffer:
+                    yield self._item(pending.pop(rng.randrange(len(pending))))
+        rng.shuffle(pending)
+        for arrays in pending:
+            yield self._item(arrays)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python shards.py <dataset root> <shard dir> [shard GB]
+    index = write_shards(sys.argv[1], sys.argv[2], int(float(sys.argv[3]) * (1 << 30)) if len(sys.argv) > 3 else 2 << 30)
+    print(sys.argv[2], '-', len(index['shards']), 'shards', '-',
+          sum(len(s['patients']) for s in index['shards']), 'patients')
@@ -0,0 +1,148 @@
+import time
+import multiprocessing
+import numpy as np
+import torch
+
+#named stage timers for the train/eval hot path, with optional torch profiler traces for a window of steps
+
+class _Null:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null = _Null()
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    def __init__(self, enabled=False, sync=False, shared=False, trace_dir=None, trace_start=10, trace_steps=5):
+        # disabled timers hand out one shared no-op context, so instrumented code pays a method call and a branch.
+        # shared=True adds a queue so timers handed to DataLoader workers (worker_timer) report back here
+        self.enabled = enabled
+        self.sync = enabled and sync and torch.cuda.is_available()
+        self.samples = {}
+        self.queue = multiprocessing.get_context().Queue() if enabled and shared else None
+        self.trace_dir = trace_dir if enabled else None
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.profiler = None
+        self.steps = 0
+        self._worker = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return _null
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        if self._worker:
+            self.queue.put((name, seconds))
+        else:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def worker_timer(self):
+        # a copy for the dataset: inside DataLoader workers it reports through the queue
+        timer = StageTimer(False)
+        timer.enabled = self.enabled and self.queue is not None
+        timer.queue = self.queue
+        timer._worker = True
+        return timer
+
+    def iterate(self, iterable, name='data'):
+        # times how long the loop waits for each item, i.e. data loading not hidden by prefetching
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def step(self):
+        # once per training batch; drives the torch profiler window when trace_dir is set
+        if self.trace_dir is None:
+            return
+        if self.profiler is None and self.steps == 0:
+            self.profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=self.trace_start, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                record_shapes=True, profile_memory=True)
+            self.profiler.start()
+        self.steps += 1
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.steps >= self.trace_start + 1 + self.trace_steps:
+                self.profiler.stop()
+                self.profiler = None
+
+    def drain(self):
+        if self.queue is None:
+            return
+        while True:
+            try:
+                name, seconds = self.queue.get_nowait()
+            except Exception:
+                return
+            self.samples.setdefault(name, []).append(seconds)
+
+    def report(self):
+        self.drain()
+        total = sum(sum(v) for v in self.samples.values())
+        rows = {}
+        for name, values in self.samples.items():
+            values = np.asarray(values) * 1000.0
+            rows[name] = {
+                'count': len(values),
+                'total_s': float(values.sum() / 1000.0),
+                'share': float(values.sum() / 1000.0 / total) if total else 0.0,
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(np.percentile(values, 50)),
+                'p90_ms': float(np.percentile(values, 90)),
+                'p99_ms': float(np.percentile(values, 99)),
+            }
+        return rows
+
+    def format_report(self, title='stage breakdown'):
+        rows = self.report()
+        lines = [title]
+        for name, r in sorted(rows.items(), key=lambda kv: -kv[1]['total_s']):
+            lines.append('  %-16s %6d x  total %8.2f s  %5.1f %%  mean %8.2f ms  p50 %8.2f  p90 %8.2f  p99 %8.2f'
+                         % (name, r['count'], r['total_s'], 100 * r['share'], r['mean_ms'], r['p50_ms'],
+                            r['p90_ms'], r['p99_ms']))
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.drain()
+        self.samples = {}
+
+
+null_timer = StageTimer(False)
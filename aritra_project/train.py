@@ -1,9 +1,13 @@
 import torch
 import gc
 import loss_metric
+from distributed import reduce_sum, is_main, unwrap
+from timing import null_timer
 
-def my_train(output, optimizer, loader_tr, no_of_batches, no_of_epochs, epoch):
+def my_train(output, optimizer, loader_tr, no_of_batches, no_of_epochs, epoch, scheduler=None, timer=null_timer,
+             distiller=None):
     output.train()
+    device = next(output.parameters()).device
 
     epoch_loss = 0.0
     epoch_acc = 0.0
@@ -12,44 +16,68 @@ def my_train(output, optimizer, loader_tr, no_of_batches, no_of_epochs, epoch):
     batch_index = 1
     samples = 1
 
-    for u, (inputs, targets) in enumerate(loader_tr):
+    for u, (inputs, targets) in enumerate(timer.iterate(loader_tr, 'data')):
         optimizer.zero_grad()
 
         batch_length = len(inputs)
 
-        inputs = inputs.reshape((batch_length, 3, 256, 256))
-        targets = targets.reshape((batch_length, 256, 256, 256))
+        with timer.stage('h2d'):
+            inputs = inputs.to(device)
+            targets = targets.to(device)
 
-        out_1, out_2 = output(inputs)
+        # distillation (distill.py): the frozen teacher's outputs for this batch, cached or computed
+        if distiller is not None:
+            with timer.stage('teacher'):
+                taught = unwrap(distiller).teacher(inputs)
 
-        out_1 = out_1.reshape((batch_length, 256, 256, 256))
-        out_2 = out_2.reshape((batch_length, 3, 256, 256))
+        with timer.stage('forward'):
+            out_1, out_2 = output(inputs)
 
+            out_1 = out_1.reshape(targets.shape)
+            out_2 = out_2.reshape(inputs.shape)
 
-        loss_1 = loss_metric.loss1(out_1, targets)
-        loss_2 = loss_metric.loss2(out_2, inputs)
+        with timer.stage('loss'):
+            loss_1, mse = loss_metric.loss1_mse(out_1, targets)
+            loss_2 = loss_metric.loss2(out_2, inputs)
 
-        loss = loss_1 + 0.5 * loss_2
+            loss = loss_1 + 0.5 * loss_2
 
-        loss.backward(retain_graph=True)
-        optimizer.step()
+            if distiller is not None:
+                loss = distiller(loss, taught, out_1, out_2)
 
-        epoch_loss = epoch_loss + loss.item()
+        with timer.stage('backward'):
+            loss.backward(retain_graph=True)
 
-        metric = loss_metric.psnr(out_1, targets)
-        epoch_acc = epoch_acc + metric
+        with timer.stage('optimizer'):
+            optimizer.step()
 
-        metric1 = loss_metric.ssim(out_1, targets)
-        epoch_acc1 = epoch_acc1 + metric1.item()
+            # per-batch schedules (one-cycle); epoch-level ones are stepped by the controller
+            if scheduler is not None:
+                scheduler.step()
 
-        print('batch', batch_index, 'of', no_of_batches, 'epoch', epoch + 1, 'of', no_of_epochs, 'samples', '(', samples, '-',
-              samples + batch_length - 1, ')', '-', 'loss', ':',
-              "%.3f" % round((loss.item()), 3), '-', 'PSNR(dB)', ':', "%.3f" % round((metric), 3), '-',
-              'SSIM', ':', "%.3f" % round((metric1.item()), 3))
+        timer.step()
+
+        with timer.stage('metrics'):
+            epoch_loss = epoch_loss + loss.item()
+
+            metric = loss_metric.psnr_from_mse(mse)
+            epoch_acc = epoch_acc + metric
+
+            metric1 = loss_metric.ssim(out_1, targets)
+            epoch_acc1 = epoch_acc1 + metric1.item()
+
+        if is_main():
+            print('batch', batch_index, 'of', no_of_batches, 'epoch', epoch + 1, 'of', no_of_epochs, 'samples', '(', samples, '-',
+                  samples + batch_length - 1, ')', '-', 'loss', ':',
+                  "%.3f" % round((loss.item()), 3), '-', 'PSNR(dB)', ':', "%.3f" % round((metric), 3), '-',
+                  'SSIM', ':', "%.3f" % round((metric1.item()), 3))
 
         batch_index = batch_index + 1
         samples = samples + batch_length
 
+    # averaged over the batches of every rank; a no-op in a single process
+    epoch_loss, epoch_acc, epoch_acc1, no_of_batches = reduce_sum([epoch_loss, epoch_acc, epoch_acc1, no_of_batches])
+
     epoch_loss = epoch_loss / no_of_batches
     epoch_acc = epoch_acc / no_of_batches
     epoch_acc1 = epoch_acc1 / no_of_batches
@@ -57,6 +85,7 @@ def my_train(output, optimizer, loader_tr, no_of_batches, no_of_epochs, epoch):
     del inputs
     del targets
     gc.collect()
-    torch.cuda.empty_cache()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
     return epoch_loss, epoch_acc, epoch_acc1
@@ -0,0 +1,133 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
+
+#byte-bounded LRU cache of decoded volumes in shared memory, one copy for the main process and all DataLoader workers
+
+_shm = '/dev/shm'
+
+
+class VolumeCache:
+    """Entries are .npy files in a tmpfs directory that every process maps read-only, so a cached volume costs its
+    size once however many workers read it. Recency is the file mtime, bumped on every hit; inserts evict the least
+    recently used entries until the new one fits in `capacity` bytes. The lock and counters are multiprocessing
+    objects, so a cache handed to a Dataset keeps working inside DataLoader workers, which are restarted every epoch."""
+
+    def __init__(self, capacity, directory=None):
+        # directory=None: a private tmpfs directory removed at exit; a given directory is kept and reused, with the
+        # entries already in it counted against the capacity
+        self.capacity = int(capacity)
+        self.temporary = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='volume_cache_',
+                                                       dir=_shm if os.path.isdir(_shm) else None)
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = multiprocessing.Lock()
+        # hits, misses, evictions, resident bytes, entries
+        self.counters = multiprocessing.Array('q', 5, lock=False)
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                self.counters[3] += os.path.getsize(os.path.join(self.directory, name))
+                self.counters[4] += 1
+        self.owner = os.getpid()
+        atexit.register(self.close)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def get(self, key, load):
+        """The cached array for key (read-only, memory-mapped), or load() stored for the next caller"""
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            # ValueError: evicted while being mapped; treat as a miss
+            array = None
+        if array is not None:
+            with self.lock:
+                self.counters[0] += 1
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            return array
+
+        with self.lock:
+            self.counters[1] += 1
+        array = load()
+        self.put(key, array)
+        return array
+
+    def put(self, key, array):
+        array = np.ascontiguousarray(array)
+        size = array.nbytes + 128
+        if size > self.capacity:
+            return False
+        path = self._path(key)
+        with self.lock:
+            if os.path.exists(path):
+                return True
+            self._evict(self.capacity - size)
+            tmp = path + '.%d.tmp' % os.getpid()
+            try:
+                with open(tmp, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp, path)
+            except OSError:
+                # tmpfs full (other tenants of /dev/shm): skip caching rather than fail the item
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return False
+            self.counters[3] += os.path.getsize(path)
+            self.counters[4] += 1
+        return True
+
+    def _evict(self, budget):
+        # caller holds the lock
+        if self.counters[3] <= budget:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        # recount: other processes (not sharing this lock) may have added or removed entries in a kept directory
+        self.counters[3] = sum(size for _, size, _ in entries)
+        self.counters[4] = len(entries)
+        for _, size, name in entries:
+            if self.counters[3] <= budget:
+                break
+            # readers that already mapped the file keep their pages until they drop the array
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self.counters[2] += 1
+            self.counters[3] -= size
+            self.counters[4] -= 1
+
+    def stats(self):
+        hits, misses, evictions, resident, entries = self.counters[:]
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / float(lookups) if lookups else 0.0,
+                'evictions': evictions, 'bytes': resident, 'entries': entries, 'capacity': self.capacity}
+
+    def close(self):
+        # only the process that created a temporary cache removes it; workers just exit
+        if self.temporary and os.getpid() == self.owner and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def split_bytes(manifest, patients, views=()):
+    # what a whole split costs resident: the CT volumes plus the requested DRRs
+    total = 0
+    for p in patients:
+        total += p['ct']['bytes'] + sum(p['drr'][view]['bytes'] for view in views if view in p['drr'])
+    return total
@@ -0,0 +1,68 @@
+import argparse
+import gc
+import os
+import tempfile
+import time
+import numpy as np
+from skimage import measure
+from benchmark_suite import ellipsoids
+from mesh_export import export_mesh
+
+# surface extraction at 256^3 and 512^3 on an ellipsoid HU phantom: plot_3d's single marching-cubes call on the full
+# grid against mesh_export (blockwise, optionally pooled and decimated), with triangle counts and binary file sizes
+
+
+def phantom(size, seed=0):
+    """The benchmark_suite phantom built slab by slab, so 512^3 fits next to the meshes (int16 HU, light noise)"""
+    rng = np.random.default_rng(seed)
+    grid = np.linspace(0, 1, size, dtype=np.float32)
+    y, x = np.meshgrid(grid, grid, indexing='ij')
+    volume = np.empty((size, size, size), dtype=np.int16)
+    for i, z in enumerate(grid):
+        plane = np.full((size, size), -1000, dtype=np.float32)
+        for (cz, cy, cx), (az, ay, ax), hu in ellipsoids:
+            plane[((z - cz) / az) ** 2 + ((y - cy) / ay) ** 2 + ((x - cx) / ax) ** 2 <= 1] = hu
+        plane += rng.normal(0, 20, (size, size)).astype(np.float32)
+        volume[i] = np.clip(plane, -1024, 3071)
+    return volume
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--level', type=float, default=-300.0)
+    parser.add_argument('--target-faces', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            volume = phantom(size).astype(np.float32)
+
+            start = time.perf_counter()
+            _, faces, _, _ = measure.marching_cubes(volume, args.level)
+            rows.append((size, 'single call (plot_3d)', time.perf_counter() - start, len(faces), None))
+            del faces
+            gc.collect()
+
+            for name, factor, target in (('blockwise', 1, None), ('blockwise + decimate', 1, args.target_faces),
+                                         ('pooled x2', 2, None), ('pooled x2 + decimate', 2, args.target_faces)):
+                path = os.path.join(tmp, 'mesh.ply')
+                start = time.perf_counter()
+                _, faces, _ = export_mesh(volume, path, args.level, factor, target, workers=args.workers)
+                rows.append((size, name, time.perf_counter() - start, len(faces), os.path.getsize(path)))
+                del faces
+                gc.collect()
+            del volume
+            gc.collect()
+
+    print('level', args.level, '-', 'decimation target', args.target_faces, '-', 'workers',
+          args.workers or os.cpu_count())
+    for size, name, seconds, n, nbytes in rows:
+        print('%d^3' % size, '%-24s' % name, '%8.2f s' % seconds, '-', '%9d triangles' % n,
+              '' if nbytes is None else '- PLY %7.1f MB' % (nbytes / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
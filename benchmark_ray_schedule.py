@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+import ray
+from ray_schedule import run_tasks
+
+# wall clock of the Ray preprocessing layouts on a skewed synthetic workload: data_generation.py's old static
+# np.array_split into one task per CPU against ray_schedule.run_tasks (one task per patient). A patient "costs" time in
+# proportion to its slice count; most series have ~130 slices, a few have 550. Tasks sleep instead of computing, so
+# the logical CPUs given to Ray are all busy in parallel even on a small host and only the scheduling differs
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def workload(patients, heavy, seed=0):
+    rng = np.random.default_rng(seed)
+    slices = rng.integers(100, 160, patients)
+    slices[rng.choice(patients, heavy, replace=False)] = 550
+    return {'patient%03d' % i: int(n) for i, n in enumerate(slices)}
+
+
+def cost(slices, ms_per_slice, fail, patient):
+    if patient == fail:
+        raise RuntimeError('corrupt series')
+    time.sleep(slices * ms_per_slice / 1000.0)
+    return [1.0, 0.7, 0.7]
+
+
+@ray.remote
+def chunk_task(chunk, slices, ms_per_slice, fail):
+    # the old do_full_prprocessing: a chunk of patients in order, results only at the end
+    return [(patient, cost(slices[patient], ms_per_slice, fail, patient)) for patient in chunk]
+
+
+@ray.remote
+def patient_task(patient, slices, ms_per_slice, fail):
+    return cost(slices[patient], ms_per_slice, fail, patient)
+
+
+def static(patients, slices, ms_per_slice, fail, num_cpus):
+    start = time.perf_counter()
+    refs = [chunk_task.remote(list(chunk), slices, ms_per_slice, fail)
+            for chunk in np.array_split(np.array(patients, dtype=object), num_cpus)]
+    results = {}
+    for ref in refs:
+        try:
+            results.update(ray.get(ref))
+        except Exception:
+            pass
+    return time.perf_counter() - start, len(results)
+
+
+def dynamic(patients, slices, ms_per_slice, fail, done_file):
+    start = time.perf_counter()
+    results, errors = run_tasks(patient_task, patients, args=(slices, ms_per_slice, fail), done_file=done_file)
+    return time.perf_counter() - start, len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patients', type=int, default=64)
+    parser.add_argument('--heavy', type=int, default=6)
+    parser.add_argument('--cpus', type=int, default=8)
+    parser.add_argument('--ms-per-slice', type=float, default=2.0)
+    parser.add_argument('--fail', action='store_true', help='one patient raises, as a corrupt series would')
+    args = parser.parse_args()
+
+    slices = workload(args.patients, args.heavy)
+    patients = sorted(slices)
+    fail = patients[len(patients) // 2] if args.fail else None
+    ideal = max(sum(slices.values()) / args.cpus, max(slices.values())) * args.ms_per_slice / 1000.0
+
+    ray.init(num_cpus=args.cpus, include_dashboard=False, logging_level=logging.WARNING)
+    slices = ray.put(slices)
+    # warm the worker pool, so neither layout pays for process start-up
+    ray.get([patient_task.remote(p, slices, 0.0, None) for p in patients[:args.cpus]])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        done_file = os.path.join(tmp, 'processed_patients.jsonl')
+        static_s, static_n = static(patients, slices, args.ms_per_slice, fail, args.cpus)
+        dynamic_s, dynamic_n = dynamic(patients, slices, args.ms_per_slice, fail, done_file)
+        # restart with the same done file: every finished patient is skipped
+        resume_s, _ = dynamic(patients, slices, args.ms_per_slice, fail, done_file)
+    ray.shutdown()
+
+    print('patients', args.patients, '-', 'heavy (550 slices)', args.heavy, '-', 'cpus', args.cpus, '-',
+          'lower bound %.2f s' % ideal)
+    for name, seconds, n in (('static chunks', static_s, static_n), ('per-patient tasks', dynamic_s, dynamic_n)):
+        print('%-20s' % name, '%7.2f s' % seconds, '-', '%d/%d patients saved' % (n, args.patients))
+    print('speed-up', ':', '%.2fx' % (static_s / dynamic_s), '-', 'restart after completion : %.2f s' % resume_s)
+
+
+if __name__ == '__main__':
+    main()
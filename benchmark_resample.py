@@ -0,0 +1,95 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+from scipy import ndimage
+from scipy.ndimage import zoom
+from skimage.transform import resize
+from resample_volume import resample_to_grid
+
+# wall time and peak RSS per patient: the old two-pass / whole-volume resampling against resample_to_grid
+
+
+def phantom(shape, seed=0):
+    """Smooth synthetic int16 HU volume, so interpolation differences are meaningful"""
+    rng = np.random.default_rng(seed)
+    volume = ndimage.gaussian_filter(rng.standard_normal(shape, dtype=np.float32), 3) * 8000 - 500
+    return np.clip(volume, -1024, 3000).astype(np.int16)
+
+
+def two_pass(image, spacing, target):
+    """data_generation.py: zoom to 1 mm, transpose, zoom again to the target grid"""
+    new_shape = np.round(image.shape * np.asarray(spacing))
+    mid = zoom(image, new_shape / image.shape, mode='nearest')
+    mid = np.transpose(mid, (1, 0, 2))
+    out = zoom(mid, (target[1] / mid.shape[0], target[0] / mid.shape[1], target[2] / mid.shape[2]))
+    return np.transpose(out, (1, 0, 2)).astype(np.float32)
+
+
+def skimage_resize(image, spacing, target):
+    """data_generation_kaggle.py: skimage resize of the whole float32 volume"""
+    return resize(image.astype(np.float32), target, order=1, preserve_range=True, anti_aliasing=True).astype(np.float32)
+
+
+def single_pass_spline(image, spacing, target):
+    return resample_to_grid(image, target, spacing=spacing, order=3)[0]
+
+
+def single_pass_linear(image, spacing, target):
+    return resample_to_grid(image, target, spacing=spacing, order=1, align_corners=False, anti_aliasing=True,
+                            mode='mirror')[0]
+
+
+methods = {
+    'two-pass zoom (data_generation)': two_pass,
+    'single-pass spline': single_pass_spline,
+    'skimage resize (kaggle)': skimage_resize,
+    'single-pass linear + AA': single_pass_linear,
+}
+
+
+def run(name, path, spacing, target, queue):
+    image = np.load(path)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    out = methods[name](image, spacing, target)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, peak / 1024.0, (peak - base) / 1024.0, out))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=3, default=[400, 512, 512])
+    parser.add_argument('--spacing', type=float, nargs=3, default=[1.25, 0.703125, 0.703125])
+    parser.add_argument('--target', type=int, nargs=3, default=[256, 256, 256])
+    args = parser.parse_args()
+
+    # every method runs in a fresh process so peak RSS is not shared between them
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'phantom.npy')
+        np.save(path, phantom(tuple(args.shape)))
+        for name in methods:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run, args=(name, path, args.spacing, tuple(args.target), queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+
+    print('input', tuple(args.shape), '-', 'spacing', tuple(args.spacing), '-', 'target', tuple(args.target))
+    for name, (seconds, peak, extra, _) in results.items():
+        print('%-34s' % name, '%8.2f s' % seconds, '-', 'peak RSS %8.1f MB' % peak, '-', '+%.1f MB' % extra)
+
+    for old, new in (('two-pass zoom (data_generation)', 'single-pass spline'),
+                     ('skimage resize (kaggle)', 'single-pass linear + AA')):
+        diff = np.abs(results[old][3] - results[new][3])
+        print('%s vs %s' % (new, old), '-', 'max %.3f HU' % diff.max(), '-', 'mean %.4f HU' % diff.mean())
+
+
+if __name__ == '__main__':
+    main()
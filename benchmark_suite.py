@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aritra_project'))
+
+from resample_volume import resample_to_grid
+from data_generation_kaggle import get_pixels_hu
+from generate_drr import generate_drr_from_ct
+from augment import VolumeAugment
+from network import UNet
+import loss_metric
+
+# end-to-end CPU timings on synthetic ellipsoid phantoms, written to a JSON report that later runs compare against:
+#   python benchmark_suite.py --sizes 128 256 --report bench.json
+#   python benchmark_suite.py --sizes 128 256 --baseline bench.json
+
+stages = ('dicom_load', 'hu_conversion', 'resample', 'drr', 'augmentation', 'unet_forward', 'unet_forward_backward',
+          'ssim_psnr', 'checkpoint_save', 'checkpoint_load')
+
+# (centre, semi-axes) as fractions of the volume and the HU value painted inside, later shapes drawn over earlier ones
+ellipsoids = (
+    ((0.50, 0.50, 0.50), (0.46, 0.36, 0.44), 40),      # soft tissue
+    ((0.50, 0.50, 0.30), (0.38, 0.26, 0.14), -850),    # right lung
+    ((0.50, 0.50, 0.70), (0.38, 0.26, 0.14), -850),    # left lung
+    ((0.50, 0.78, 0.50), (0.40, 0.06, 0.06), 700),     # spine
+    ((0.55, 0.45, 0.55), (0.12, 0.10, 0.10), 60),      # heart
+    ((0.45, 0.50, 0.32), (0.02, 0.02, 0.02), 20),      # nodule
+)
+
+
+def phantom(shape, seed=0):
+    """int16 HU volume (slices, rows, cols): air outside the body, nested ellipsoids and mild noise"""
+    z, y, x = np.meshgrid(*(np.linspace(0, 1, n, dtype=np.float32) for n in shape), indexing='ij')
+    volume = np.full(shape, -1000, dtype=np.float32)
+    for (cz, cy, cx), (az, ay, ax), hu in ellipsoids:
+        inside = ((z - cz) / az) ** 2 + ((y - cy) / ay) ** 2 + ((x - cx) / ax) ** 2 <= 1
+        volume[inside] = hu
+    volume += np.random.default_rng(seed).normal(0, 20, shape).astype(np.float32)
+    return np.clip(volume, -1024, 3071).astype(np.int16)
+
+
+def write_series(volume, spacing, folder):
+    """One CT DICOM file per slice, stored as uint16 with the usual -1024 rescale intercept"""
+    series = generate_uid()
+    for i, image in enumerate(volume):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series
+        ds.Modality = 'CT'
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i * spacing[0])]
+        ds.SliceThickness = float(spacing[0])
+        ds.PixelSpacing = [float(spacing[1]), float(spacing[2])]
+        ds.RescaleIntercept = -1024
+        ds.RescaleSlope = 1
+        ds.Rows, ds.Columns = image.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = (image.astype(np.int32) + 1024).astype(np.uint16).tobytes()
+        # shuffled file names, so the loader has to sort by position like it does for LIDC
+        ds.save_as(os.path.join(folder, '%s.dcm' % generate_uid()), enforce_file_format=True)
+
+
+def load_series(folder):
+    slices = [pydicom.dcmread(os.path.join(folder, f)) for f in os.listdir(folder)]
+    slices.sort(key=lambda s: float(s.ImagePositionPatient[2]))
+    return slices
+
+
+def timed(fn, repeats):
+    """Seconds per call after one warm-up call (numba compilation, allocator and page-cache warm-up)"""
+    result = fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def summary(samples):
+    samples = np.asarray(samples)
+    return {'mean_s': float(samples.mean()), 'min_s': float(samples.min()), 'p50_s': float(np.median(samples)),
+            'max_s': float(samples.max()), 'repeats': len(samples)}
+
+
+def bench_size(size, args, tmp):
+    # the raw scan is finer in-plane and coarser along z than the target grid, like a typical LIDC series
+    spacing = (1.25, 0.7, 0.7)
+    raw_shape = (max(2, int(round(size * 0.8))), size, size)
+    folder = os.path.join(tmp, 'series_%d' % size)
+    os.makedirs(folder)
+    write_series(phantom(raw_shape), spacing, folder)
+
+    results = {}
+    samples, slices = timed(lambda: load_series(folder), args.repeats)
+    results['dicom_load'] = summary(samples)
+
+    samples, hu = timed(lambda: get_pixels_hu(slices), args.repeats)
+    results['hu_conversion'] = summary(samples)
+    del slices
+
+    samples, (ct, _) = timed(lambda: resample_to_grid(hu, (size, size, size), spacing=spacing, order=1,
+                                                       align_corners=False, anti_aliasing=True, mode='mirror'),
+                             args.repeats)
+    results['resample'] = summary(samples)
+    del hu
+
+    views = ('frontal', 'lateral', 'top')
+    samples, _ = timed(lambda: [generate_drr_from_ct(ct, direction=v) for v in views], args.repeats)
+    results['drr'] = summary(samples)
+
+    # the training-phase transform ImageData applies to every target volume
+    aug = VolumeAugment(size=size, generator=torch.Generator().manual_seed(0))
+    volume = torch.from_numpy(ct)
+    samples, _ = timed(lambda: aug(volume), args.repeats)
+    results['augmentation'] = summary(samples)
+
+    # the network always predicts 256 slices; the input and target planes follow the benchmark size
+    torch.manual_seed(0)
+    model = UNet(in_channels=len(views), width=args.width)
+    inputs = torch.rand(args.batch, len(views), size, size)
+    targets = torch.rand(args.batch, 256, size, size)
+
+    def forward():
+        with torch.no_grad():
+            return model(inputs)
+
+    def forward_backward():
+        model.zero_grad()
+        out_1, out_2 = model(inputs)
+        out_1 = out_1.reshape(targets.shape)
+        out_2 = out_2.reshape(inputs.shape)
+        loss = loss_metric.loss1(out_1, targets) + 0.5 * loss_metric.loss2(out_2, inputs)
+        loss.backward()
+        return out_1.detach()
+
+    samples, _ = timed(forward, args.repeats)
+    results['unet_forward'] = summary(samples)
+    samples, out_1 = timed(forward_backward, args.repeats)
+    results['unet_forward_backward'] = summary(samples)
+
+    samples, _ = timed(lambda: (loss_metric.psnr(out_1, targets), loss_metric.ssim(out_1, targets).item()),
+                       args.repeats)
+    results['ssim_psnr'] = summary(samples)
+
+    path = os.path.join(tmp, 'output_%d.pth' % size)
+    samples, _ = timed(lambda: torch.save(model.state_dict(), path), args.repeats)
+    results['checkpoint_save'] = summary(samples)
+    samples, _ = timed(lambda: model.load_state_dict(torch.load(path, map_location='cpu')), args.repeats)
+    results['checkpoint_load'] = summary(samples)
+    results['checkpoint_load']['bytes'] = os.path.getsize(path)
+
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'torch': torch.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(report, baseline, tolerance):
+    # stages slower than baseline by more than the tolerance (on the median) are listed as regressions
+    regressions = []
+    for size, results in report['results'].items():
+        for stage, r in results.items():
+            old = baseline.get('results', {}).get(size, {}).get(stage)
+            if old is None:
+                continue
+            ratio = r['p50_s'] / old['p50_s'] if old['p50_s'] else float('inf')
+            r['baseline_p50_s'] = old['p50_s']
+            r['ratio'] = ratio
+            if ratio > 1 + tolerance:
+                regressions.append((size, stage, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--width', type=float, default=1 / 8)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--report', default='benchmark_report.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    report = {'environment': environment(), 'config': vars(args), 'results': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            report['results'][str(size)] = bench_size(size, args, tmp)
+
+            print('volume', '%d^3' % size, '-', 'UNet width', args.width, '-', 'batch', args.batch)
+            for stage in stages:
+                r = report['results'][str(size)][stage]
+                print('  %-22s' % stage, '%9.4f s' % r['p50_s'], '-', 'min %9.4f s' % r['min_s'])
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = [{'size': int(s), 'stage': st, 'ratio': ratio} for s, st, ratio in regressions]
+        for size, stage, ratio in regressions:
+            print('regression', '-', '%s^3' % size, stage, '-', '%.2fx baseline' % ratio)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report written to', args.report)
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ import pydicom
 import scipy.ndimage
 import matplotlib.pyplot as plt
 
-from skimage import measure, morphology
+from skimage import morphology
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 import os
 from configparser import ConfigParser
@@ -12,18 +12,25 @@ import pylidc as pl
 from numba import jit
 import ray
 from skimage import io
-import psutil
-from scipy.ndimage import zoom
 import cv2
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aritra_project'))
+from resample_volume import resample_to_grid
+from mesh_export import export_mesh
+from drr_cache import DRRCache, volume_key
+from ray_schedule import run_tasks
+from resources import plan_from_env
 
 warnings.filterwarnings(action='ignore')
 
-def plot_3d(image, threshold=-300):
+def plot_3d(image, threshold=-300, path=None, factor=2, target_faces=100000):
 	# Position the scan upright,
 	# so the head of the patient would be at the top facing the camera
 	p = image.transpose(2, 1, 0)
 
-	verts, faces, normals, values = measure.marching_cubes_lewiner(p, threshold)
+	# blockwise marching cubes on the mean-pooled volume, decimated so matplotlib can draw it;
+	# with path (.ply / .stl) the mesh is also written for a proper viewer
+	verts, faces, _ = export_mesh(p, path, threshold, factor, target_faces)
 
 	fig = plt.figure(figsize=(10, 10))
 	ax = fig.add_subplot(111, projection='3d')
@@ -124,60 +131,72 @@ def generate_drr_from_ct(ct_scan, direction='frontal'):
 			drr_out[x, z] = np.exp(0.02 + u_av)
 	return drr_out
 
-@ray.remote
-def do_full_prprocessing(patients, output_folder, pat_idxs):
-	out_meta = []
-	for i in pat_idxs:
-		scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patients[i]).first()
-		dcm_slices = scan.load_all_dicom_images()
-		patient_pixels = get_pixels_hu(dcm_slices)
-		pix_resampled, spacing = resample(patient_pixels, dcm_slices, [1, 1, 1])
-		if not os.path.isdir(os.path.join(output_folder, patients[i])):
-			os.makedirs(os.path.join(output_folder, patients[i]))
-
-
-		drr_front = generate_drr_from_ct(pix_resampled, direction='frontal')
-		drr_lat = generate_drr_from_ct(pix_resampled, direction='lateral')
-		drr_top = generate_drr_from_ct(pix_resampled, direction='top')
-
-		pix_resampled = np.transpose(pix_resampled, axes=(1, 0, 2))
-		org_shape = pix_resampled.shape
-		pix_resampled = zoom(pix_resampled, (512 / org_shape[0], 512 / org_shape[1], 512 / org_shape[2]))
-		pix_resampled = (pix_resampled - np.min(pix_resampled)) * (1.0 / (np.max(pix_resampled) - np.min(pix_resampled)))
-		np.save(os.path.join(output_folder, patients[i], f"{patients[i]}.npy"), pix_resampled)
-
-		drr_front = cv2.resize(drr_front, (512, 512), interpolation=cv2.INTER_LINEAR)
-		drr_front = (drr_front - np.min(drr_front)) * (1.0 / (np.max(drr_front) - np.min(drr_front)))
-		np.save(os.path.join(output_folder, patients[i], f"{patients[i]}_drrFrontal.npy"), drr_front)
-
-		drr_lat = cv2.resize(drr_lat, (512, 512), interpolation=cv2.INTER_LINEAR)
-		drr_lat = (drr_lat - np.min(drr_lat)) * (1.0 / (np.max(drr_lat) - np.min(drr_lat)))
-		np.save(os.path.join(output_folder, patients[i], f"{patients[i]}_drrLateral.npy"), drr_lat)
-
-		drr_top = cv2.resize(drr_top, (512, 512), interpolation=cv2.INTER_LINEAR)
-		drr_top = (drr_top - np.min(drr_top)) * (1.0 / (np.max(drr_top) - np.min(drr_top)))
-		np.save(os.path.join(output_folder, patients[i], f"{patients[i]}_drrTop.npy"), drr_top)
-
-		out_meta.append((i, spacing))
-	return out_meta
-
-
-# Read the configuration file generated from config_file_create.py
-parser = ConfigParser()
-parser.read('./lidc.conf')
-
-# Some constants
-input_folder = '/home/daisylabs/aritra_project/LIDC-IDRI/'
-output_folder = '/home/daisylabs/aritra_project/dataset'
-patients = os.listdir(input_folder)
-patients.sort()
-
-num_cpus = psutil.cpu_count(logical=False)
-ray.init(num_cpus=num_cpus)
-pat_idxs = np.array_split(np.arange(len(patients)), num_cpus)
-patients = ray.put(patients)
-output_folder = ray.put(output_folder)
-meta_infos = ray.get([do_full_prprocessing.remote(patients, output_folder, pat_idxs[i]) for i in range(num_cpus)])
-ray.shutdown()
-print(meta_infos)
-
+def cached_drr(cache, key, ct_scan, direction, size=512):
+	# projection, resize and min-max normalisation as saved below; looked up by volume content + parameters first
+	def compute():
+		drr = generate_drr_from_ct(ct_scan, direction=direction)
+		drr = cv2.resize(drr, (size, size), interpolation=cv2.INTER_LINEAR)
+		return (drr - np.min(drr)) * (1.0 / (np.max(drr) - np.min(drr)))
+
+	params = {'projector': 'data_generation', 'direction': direction, 'resize': size, 'normalize': 'min_max'}
+	return cache.projection(key, params, compute)
+
+# peak host memory of one patient: its DICOM slices, the int16 HU volume, the float32 512^3 grid and its normalized
+# copy; the scheduler keeps only as many patients in flight as fit
+patient_bytes = 2 << 30
+
+@ray.remote(max_retries=2)
+def do_full_prprocessing(patient, output_folder):
+	# DRRs of a volume seen before (a rerun, another script) come from the cache instead of the projector
+	cache = DRRCache()
+	scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patient).first()
+	dcm_slices = scan.load_all_dicom_images()
+	patient_pixels = get_pixels_hu(dcm_slices)
+	if not os.path.isdir(os.path.join(output_folder, patient)):
+		os.makedirs(os.path.join(output_folder, patient))
+
+	# one spline pass straight to the 512^3 grid; going through the 1 mm grid first composes to the same
+	# corner-aligned mapping, so the intermediate volume is never materialised
+	dcm_spacing = np.array([dcm_slices[0].SliceThickness] + list(dcm_slices[0].PixelSpacing), dtype=np.float32)
+	del dcm_slices
+	pix_resampled, spacing = resample_to_grid(patient_pixels, (512, 512, 512), spacing=dcm_spacing, order=3)
+	del patient_pixels
+
+	key = volume_key(pix_resampled)
+	drr_front = cached_drr(cache, key, pix_resampled, 'frontal')
+	drr_lat = cached_drr(cache, key, pix_resampled, 'lateral')
+	drr_top = cached_drr(cache, key, pix_resampled, 'top')
+
+	pix_resampled = np.transpose(pix_resampled, axes=(1, 0, 2))
+	pix_resampled = (pix_resampled - np.min(pix_resampled)) * (1.0 / (np.max(pix_resampled) - np.min(pix_resampled)))
+	np.save(os.path.join(output_folder, patient, f"{patient}.npy"), pix_resampled)
+
+	np.save(os.path.join(output_folder, patient, f"{patient}_drrFrontal.npy"), drr_front)
+	np.save(os.path.join(output_folder, patient, f"{patient}_drrLateral.npy"), drr_lat)
+	np.save(os.path.join(output_folder, patient, f"{patient}_drrTop.npy"), drr_top)
+
+	return [float(x) for x in spacing]
+
+
+if __name__ == '__main__':
+	# Read the configuration file generated from config_file_create.py
+	parser = ConfigParser()
+	parser.read('./lidc.conf')
+
+	# Some constants
+	input_folder = '/home/daisylabs/aritra_project/LIDC-IDRI/'
+	output_folder = '/home/daisylabs/aritra_project/dataset'
+	patients = os.listdir(input_folder)
+	patients.sort()
+	os.makedirs(output_folder, exist_ok=True)
+
+	# every core to the per-patient tasks, each numba kernel on drr_threads of them (CPU_PLAN='drr=..x..' to change)
+	plan_from_env(train=False).init_ray()
+	# one task per patient, collected as they finish; patients in processed_patients.jsonl (with their spacing) are
+	# skipped on a restart, and a failed patient is reported without losing the others
+	meta_infos, failed = run_tasks(do_full_prprocessing, patients, args=(output_folder,), task_bytes=patient_bytes,
+								   done_file=os.path.join(output_folder, 'processed_patients.jsonl'))
+	ray.shutdown()
+	print(meta_infos)
+	if failed:
+		print('failed:', failed)
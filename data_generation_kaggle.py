@@ -4,7 +4,7 @@ import os
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import time
-from skimage.transform import resize
+from resample_volume import resample_to_grid
 
 # Thiết lập để sử dụng GPU nếu có
 import os
@@ -31,28 +31,75 @@ def get_pixels_hu(slices):
     
     return np.array(image, dtype=np.int16)
 
-def resample_to_target_shape(image, target_shape=(256, 256, 256)):
+def resample_to_target_shape(image, target_shape=(256, 256, 256), spacing=None):
     """
-    Lấy mẫu lại khối dữ liệu về kích thước mục tiêu sử dụng skimage.transform.resize
-    Phương pháp này sẽ tiết kiệm bộ nhớ và đảm bảo kích thước chính xác
+    Lấy mẫu lại khối dữ liệu về kích thước mục tiêu trong một lượt, theo từng lát dày (z-slab) song song
+    Kết quả giống skimage.transform.resize (order=1, anti_aliasing=True) nhưng không cần bản sao float32 của cả khối
     """
     start_time = time.time()
     print(f"Resampling từ {image.shape} sang {target_shape}")
     
-    # Lấy mẫu lại với skimage.transform.resize
-    resampled = resize(
-        image.astype(np.float32),  # Chuyển thành float32 cho xử lý nhẹ hơn
+    resampled, resampled_spacing = resample_to_grid(
+        image,
         target_shape,
+        spacing=spacing,
         order=1,                   # Linear interpolation
-        preserve_range=True,       # Giữ nguyên khoảng giá trị
-        anti_aliasing=True         # Chống răng cưa
+        align_corners=False,       # Tâm pixel như skimage
+        anti_aliasing=True,        # Chống răng cưa
+        mode='mirror'
     )
     
     end_time = time.time()
     print(f"Hoàn thành resampling trong {end_time - start_time:.2f} giây")
     print(f"Kích thước sau khi resampling: {resampled.shape}")
     
-    return resampled.astype(np.float32)
+    return resampled, resampled_spacing
+
+def get_spacing(dcm_slices):
+    """Spacing gốc (độ dày lát cắt, pixel spacing) của chuỗi DICOM"""
+    try:
+        return [float(dcm_slices[0].SliceThickness)] + [float(x) for x in dcm_slices[0].PixelSpacing]
+    except:
+        print("Không tìm thấy thông tin spacing, sử dụng giá trị mặc định")
+        return [1.0, 1.0, 1.0]  # Giá trị mặc định nếu không tìm thấy
+
+def normalize_volume(patient_pixels, resampled_volume, original_spacing, resampled_spacing):
+    """Chuẩn hóa khối đã lấy mẫu lại về [0, 1] và tạo thông tin cấu hình để lưu kèm"""
+    min_val = np.min(resampled_volume)
+    max_val = np.max(resampled_volume)
+    normalized_volume = (resampled_volume - min_val) / (max_val - min_val)
+    
+    info = {
+        'original_shape': patient_pixels.shape,
+        'resampled_shape': resampled_volume.shape,
+        'original_spacing': original_spacing,
+        'resampled_spacing': [float(x) for x in resampled_spacing],
+        'hu_min': float(min_val),
+        'hu_max': float(max_val)
+    }
+    return normalized_volume, info
+
+def save_patient(patient_id, output_folder, normalized_volume, info):
+    """Lưu khối CT, thông tin spacing (_info.txt) và ảnh mẫu của một bệnh nhân"""
+    # Tạo thư mục đầu ra
+    patient_output_dir = os.path.join(output_folder, patient_id)
+    os.makedirs(patient_output_dir, exist_ok=True)
+    
+    # Lưu khối CT
+    np.save(os.path.join(patient_output_dir, f"{patient_id}.npy"), normalized_volume)
+    
+    # Lưu thông tin dưới dạng text
+    with open(os.path.join(patient_output_dir, f"{patient_id}_info.txt"), 'w') as f:
+        for key, value in info.items():
+            f.write(f"{key}: {value}\n")
+    
+    # Tạo một hình ảnh mẫu để kiểm tra
+    mid_slice = normalized_volume.shape[1] // 2
+    plt.figure(figsize=(10, 10))
+    plt.imshow(normalized_volume[:, mid_slice, :], cmap='gray')
+    plt.title(f"Mid-slice of {patient_id}")
+    plt.savefig(os.path.join(patient_output_dir, f"{patient_id}_sample.png"))
+    plt.close()
 
 def process_patient(patient_id, input_folder, output_folder, target_shape=(256, 256, 256)):
     """Xử lý dữ liệu CT của một bệnh nhân và lưu kết quả"""
@@ -84,7 +131,7 @@ def process_patient(patient_id, input_folder, output_folder, target_shape=(256,
         dcm_slices = []
         for file_path in tqdm(dcm_files, desc="Đọc DICOM"):
             try:
-                dicom = pydicom.read_file(file_path, force=True)
+                dicom = pydicom.dcmread(file_path, force=True)
                 dcm_slices.append(dicom)
             except Exception as e:
                 print(f"Lỗi khi đọc {file_path}: {str(e)}")
@@ -111,53 +158,20 @@ def process_patient(patient_id, input_folder, output_folder, target_shape=(256,
         print(f"Khối dữ liệu gốc: {patient_pixels.shape}, Min: {np.min(patient_pixels)}, Max: {np.max(patient_pixels)}")
         
         # Lưu thông tin spacing gốc
-        try:
-            original_spacing = [float(dcm_slices[0].SliceThickness)] + [float(x) for x in dcm_slices[0].PixelSpacing]
-        except:
-            original_spacing = [1.0, 1.0, 1.0]  # Giá trị mặc định nếu không tìm thấy
-            print("Không tìm thấy thông tin spacing, sử dụng giá trị mặc định")
+        original_spacing = get_spacing(dcm_slices)
         
         # Resampling
         print(f"Đang lấy mẫu lại khối dữ liệu...")
-        resampled_volume = resample_to_target_shape(patient_pixels, target_shape)
+        resampled_volume, resampled_spacing = resample_to_target_shape(patient_pixels, target_shape, original_spacing)
         print(f"Khối dữ liệu sau khi lấy mẫu lại: {resampled_volume.shape}")
         
         # Chuẩn hóa giá trị về [0, 1]
         print("Chuẩn hóa giá trị pixel...")
-        min_val = np.min(resampled_volume)
-        max_val = np.max(resampled_volume)
-        normalized_volume = (resampled_volume - min_val) / (max_val - min_val)
-        
-        # Tạo thư mục đầu ra
-        patient_output_dir = os.path.join(output_folder, patient_id)
-        os.makedirs(patient_output_dir, exist_ok=True)
-        
-        # Lưu khối CT
-        output_path = os.path.join(patient_output_dir, f"{patient_id}.npy")
-        print(f"Đang lưu khối CT vào {output_path}")
-        np.save(output_path, normalized_volume)
-        
-        # Lưu thông tin cấu hình và spacing
-        info = {
-            'original_shape': patient_pixels.shape,
-            'resampled_shape': resampled_volume.shape,
-            'original_spacing': original_spacing,
-            'hu_min': float(min_val),
-            'hu_max': float(max_val)
-        }
-        
-        # Lưu thông tin dưới dạng text
-        with open(os.path.join(patient_output_dir, f"{patient_id}_info.txt"), 'w') as f:
-            for key, value in info.items():
-                f.write(f"{key}: {value}\n")
+        normalized_volume, info = normalize_volume(patient_pixels, resampled_volume, original_spacing, resampled_spacing)
         
-        # Tạo một hình ảnh mẫu để kiểm tra
-        mid_slice = normalized_volume.shape[1] // 2
-        plt.figure(figsize=(10, 10))
-        plt.imshow(normalized_volume[:, mid_slice, :], cmap='gray')
-        plt.title(f"Mid-slice of {patient_id}")
-        plt.savefig(os.path.join(patient_output_dir, f"{patient_id}_sample.png"))
-        plt.close()
+        # Lưu khối CT, thông tin spacing và ảnh mẫu
+        print(f"Đang lưu khối CT vào {os.path.join(output_folder, patient_id, f'{patient_id}.npy')}")
+        save_patient(patient_id, output_folder, normalized_volume, info)
         
         end_time = time.time()
         print(f"Hoàn thành xử lý bệnh nhân {patient_id} trong {end_time - start_time:.2f} giây")
@@ -79,57 +79,65 @@ class LIDCFilter:
         """Đếm số lượng file DICOM trong một thư mục"""
         return len([f for f in os.listdir(directory) if f.endswith('.dcm')])
             
-    def process_patient(self, patient_id):
-        """Xử lý dữ liệu của một bệnh nhân"""
-        try:
-            patient_path = os.path.join(self.input_folder, patient_id)
-            if not os.path.isdir(patient_path):
-                return False
-                
-            # Tìm tất cả các thư mục chứa file DICOM
-            dicom_dirs = self.find_dicom_directories(patient_path)
-            if not dicom_dirs:
-                return False
-                
-            # Chọn thư mục có nhiều file DICOM nhất
-            best_dir = max(dicom_dirs, key=self.get_dicom_files_count)
-            logger.info(f"Bệnh nhân {patient_id}: Chọn thư mục {best_dir} với {self.get_dicom_files_count(best_dir)} file DICOM")
-                
-            # Đọc các file DICOM từ thư mục được chọn
-            slices = []
-            for file in os.listdir(best_dir):
-                if file.endswith('.dcm'):
-                    try:
-                        file_path = os.path.join(best_dir, file)
-                        dicom = pydicom.read_file(file_path)
-                        slices.append(dicom)
-                    except:
-                        continue
-                    
-            if not slices:
-                return False
+    def load_patient(self, patient_id):
+        """Đọc chuỗi DICOM của thư mục có nhiều file nhất, đã sắp xếp theo vị trí; trả về (thư mục, các lát cắt)"""
+        patient_path = os.path.join(self.input_folder, patient_id)
+        if not os.path.isdir(patient_path):
+            return None, []
+            
+        # Tìm tất cả các thư mục chứa file DICOM
+        dicom_dirs = self.find_dicom_directories(patient_path)
+        if not dicom_dirs:
+            return None, []
+            
+        # Chọn thư mục có nhiều file DICOM nhất
+        best_dir = max(dicom_dirs, key=self.get_dicom_files_count)
+        logger.info(f"Bệnh nhân {patient_id}: Chọn thư mục {best_dir} với {self.get_dicom_files_count(best_dir)} file DICOM")
+            
+        # Đọc các file DICOM từ thư mục được chọn
+        slices = []
+        for file in os.listdir(best_dir):
+            if file.endswith('.dcm'):
+                try:
+                    file_path = os.path.join(best_dir, file)
+                    dicom = pydicom.dcmread(file_path)
+                    slices.append(dicom)
+                except:
+                    continue
                 
+        if slices:
             # Sắp xếp các lát cắt theo vị trí
             slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
+        return best_dir, slices
+            
+    def check_patient(self, patient_id, best_dir, slices):
+        """Kiểm tra các tiêu chí và lưu thông tin nếu bệnh nhân phù hợp"""
+        if not (self.check_slice_thickness(slices) and 
+               self.check_image_quality(slices) and 
+               self.check_contrast(slices)):
+            return False
+            
+        # Lưu thông tin bệnh nhân
+        patient_info = {
+            'patient_id': patient_id,
+            'num_slices': len(slices),
+            'slice_thickness': float(slices[0].SliceThickness),
+            'pixel_spacing': slices[0].PixelSpacing,
+            'image_size': slices[0].pixel_array.shape,
+            'selected_directory': best_dir
+        }
+        self.patient_info.append(patient_info)
+        
+        return True
             
-            # Kiểm tra các tiêu chí
-            if not (self.check_slice_thickness(slices) and 
-                   self.check_image_quality(slices) and 
-                   self.check_contrast(slices)):
+    def process_patient(self, patient_id):
+        """Xử lý dữ liệu của một bệnh nhân"""
+        try:
+            best_dir, slices = self.load_patient(patient_id)
+            if not slices:
                 return False
                 
-            # Lưu thông tin bệnh nhân
-            patient_info = {
-                'patient_id': patient_id,
-                'num_slices': len(slices),
-                'slice_thickness': float(slices[0].SliceThickness),
-                'pixel_spacing': slices[0].PixelSpacing,
-                'image_size': slices[0].pixel_array.shape,
-                'selected_directory': best_dir
-            }
-            self.patient_info.append(patient_info)
-            
-            return True
+            return self.check_patient(patient_id, best_dir, slices)
             
         except Exception as e:
             logger.error(f"Lỗi khi xử lý bệnh nhân {patient_id}: {str(e)}")
@@ -0,0 +1,209 @@
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+from skimage import measure
+
+# surface meshes of CT / reconstructed volumes: marching cubes per z-slab in parallel, seams stitched by merging the
+# vertices the neighbouring slabs both produce on their shared plane, optional mean-pooled level and vertex-clustering
+# decimation to a triangle budget, written as binary PLY or STL
+
+_volume = None
+
+
+def downsample(volume, factor):
+    """Mean over factor^3 blocks (the trailing partial block is dropped); a smoother level than strided sampling"""
+    if factor == 1:
+        return volume
+    shape = [n // factor for n in volume.shape]
+    volume = volume[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor]
+    return volume.reshape(shape[0], factor, shape[1], factor, shape[2], factor).mean(axis=(1, 3, 5),
+                                                                                    dtype=np.float32)
+
+
+def _slab(bounds, level):
+    z0, z1 = bounds
+    # one plane of overlap: the cubes between z1 - 1 and z1 belong to this slab, the plane z1 is shared with the next
+    part = _volume[z0:z1 + 1]
+    if part.shape[0] < 2 or not (part.min() <= level <= part.max()):
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int64)
+    verts, faces, _, _ = measure.marching_cubes(part, level, allow_degenerate=False)
+    verts[:, 0] += z0
+    return verts.astype(np.float32), faces.astype(np.int64)
+
+
+def weld(verts, faces, planes):
+    """Merge the vertices neighbouring slabs both put on their shared planes: every cube belongs to one slab, so those
+    are the only duplicates. Both copies are interpolated from the same two voxels, so they match bit for bit"""
+    seam = np.nonzero(np.isin(verts[:, 0], planes))[0]
+    rows = np.ascontiguousarray(verts[seam]).view(np.dtype((np.void, verts.dtype.itemsize * 3))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    target = np.arange(len(verts))
+    target[seam] = seam[first][inverse.reshape(-1)]
+    used, index = np.unique(target, return_inverse=True)
+    faces = index.reshape(-1)[faces]
+    # a voxel exactly at the level puts vertices of several edges on one grid point; within a slab skimage already
+    # dropped the triangles this collapses, across a seam they only collapse here
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    return verts[used], faces
+
+
+def _clean(faces, n_verts):
+    """Drop faces that collapsed to an edge or a point, and repeats of the same triangle"""
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    # rotate each triangle to start at its smallest index (keeps the winding), then compare as one integer key
+    start = np.argmin(faces, axis=1)
+    rolled = np.stack([faces[np.arange(len(faces)), (start + k) % 3] for k in range(3)], axis=1)
+    if n_verts ** 3 < 2 ** 62:
+        keys = (rolled[:, 0] * n_verts + rolled[:, 1]) * n_verts + rolled[:, 2]
+        _, keep = np.unique(keys, return_index=True)
+    else:
+        _, keep = np.unique(rolled, axis=0, return_index=True)
+    return faces[np.sort(keep)]
+
+
+def marching_cubes_blocks(volume, level=None, block=64, workers=None):
+    """Marching cubes of the whole volume, run on z-slabs of `block` planes in parallel (forked workers read the
+    volume without copying it) and welded into one mesh. Vertices are in voxel coordinates (axis order of volume)"""
+    global _volume
+    volume = np.asarray(volume, dtype=np.float32)
+    if level is None:
+        # skimage's default
+        level = float(volume.min() + volume.max()) / 2
+    bounds = [(z0, min(z0 + block, volume.shape[0] - 1)) for z0 in range(0, volume.shape[0] - 1, block)]
+    workers = min(workers or os.cpu_count(), len(bounds))
+
+    _volume = volume
+    try:
+        if workers > 1:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                parts = pool.starmap(_slab, [(b, level) for b in bounds])
+        else:
+            parts = [_slab(b, level) for b in bounds]
+    finally:
+        _volume = None
+
+    offsets = np.cumsum([0] + [len(v) for v, _ in parts])
+    verts = np.concatenate([v for v, _ in parts])
+    faces = np.concatenate([f + offset for (_, f), offset in zip(parts, offsets)])
+    return weld(verts, faces, [z1 for _, z1 in bounds[:-1]])
+
+
+def decimate(verts, faces, target_faces, iterations=8):
+    """Vertex clustering: vertices in the same grid cell become one (their mean). The cell size is searched until the
+    mesh has at most target_faces triangles; coarser than quadric simplification, but linear-time and numpy only"""
+    if len(faces) <= target_faces:
+        return verts, faces
+    # triangles scale with 1 / cell^2: start from the mean edge length scaled by the reduction wanted
+    edges = np.linalg.norm(verts[faces[:, 1]] - verts[faces[:, 0]], axis=1).mean()
+    cell = float(edges * np.sqrt(len(faces) / float(target_faces)))
+    best = None
+    for _ in range(iterations):
+        out = _cluster(verts, faces, cell)
+        ratio = len(out[1]) / float(target_faces)
+        if ratio <= 1:
+            best = out
+            if ratio > 0.9:
+                break
+        # aim a little under the target so the next step lands inside it
+        cell *= np.sqrt(max(ratio, 1e-3) / 0.95)
+    while best is None:
+        cell *= 1.5
+        out = _cluster(verts, faces, cell)
+        best = out if len(out[1]) <= target_faces else None
+    return best
+
+
+def _cluster(verts, faces, cell):
+    cells = np.floor((verts - verts.min(axis=0)) / cell).astype(np.int64)
+    keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+    _, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    count = np.bincount(inverse).astype(np.float64)
+    merged = np.stack([np.bincount(inverse, weights=verts[:, k]) for k in range(3)], axis=1) / count[:, None]
+    faces = _clean(inverse[faces], len(count))
+    # drop vertices no face refers to any more
+    used, faces = np.unique(faces, return_inverse=True)
+    return merged[used].astype(np.float32), faces.reshape(-1, 3)
+
+
+def write_ply(path, verts, faces):
+    face_records = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+    face_records['n'] = 3
+    face_records['v'] = faces
+    with open(path, 'wb') as f:
+        f.write(('ply\nformat binary_little_endian 1.0\nelement vertex %d\nproperty float x\nproperty float y\n'
+                 'property float z\nelement face %d\nproperty list uchar int vertex_indices\nend_header\n'
+                 % (len(verts), len(faces))).encode('ascii'))
+        f.write(np.ascontiguousarray(verts, dtype='<f4').tobytes())
+        f.write(face_records.tobytes())
+
+
+def write_stl(path, verts, faces):
+    triangles = verts[faces].astype(np.float32)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    records = np.zeros(len(faces), dtype=[('normal', '<f4', (3,)), ('verts', '<f4', (3, 3)), ('attr', '<u2')])
+    records['normal'] = normals
+    records['verts'] = triangles
+    with open(path, 'wb') as f:
+        f.write(b'binary STL, mesh_export.py'.ljust(80, b' '))
+        f.write(np.uint32(len(faces)).tobytes())
+        f.write(records.tobytes())
+
+
+writers = {'.ply': write_ply, '.stl': write_stl}
+
+
+def export_mesh(volume, path=None, level=None, factor=1, target_faces=None, spacing=(1.0, 1.0, 1.0), block=64,
+                workers=None):
+    """Surface of `volume` at `level`, on the full grid or mean-pooled by `factor`, decimated to at most target_faces
+    triangles and written to path (.ply or .stl) when given. Vertices are scaled by spacing (voxel size, mm).
+    Returns verts, faces and the time of each step"""
+    times = {}
+    start = time.perf_counter()
+    small = downsample(np.asarray(volume, dtype=np.float32), factor)
+    times['downsample'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    verts, faces = marching_cubes_blocks(small, level, block, workers)
+    times['marching_cubes'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if target_faces:
+        verts, faces = decimate(verts, faces, target_faces)
+    times['decimate'] = time.perf_counter() - start
+
+    # pooled voxel centres sit (factor - 1) / 2 voxels into their block
+    verts = (verts * factor + (factor - 1) / 2.0) * np.asarray(spacing, dtype=np.float32)
+    if path is not None:
+        start = time.perf_counter()
+        writers[os.path.splitext(path)[1].lower()](path, verts, faces)
+        times['write'] = time.perf_counter() - start
+    return verts, faces, times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('volume', help='.npy volume (ground truth or prediction)')
+    parser.add_argument('output', help='.ply or .stl')
+    parser.add_argument('--level', type=float, default=None, help='iso-value; default is (min + max) / 2')
+    parser.add_argument('--downsample', type=int, default=1)
+    parser.add_argument('--target-faces', type=int, default=None)
+    parser.add_argument('--spacing', type=float, nargs=3, default=[1.0, 1.0, 1.0])
+    parser.add_argument('--block', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if os.path.splitext(args.output)[1].lower() not in writers:
+        parser.error('output must end in %s' % ' or '.join(writers))
+    volume = np.load(args.volume, mmap_mode='r')
+    verts, faces, times = export_mesh(volume, args.output, args.level, args.downsample, args.target_faces,
+                                      args.spacing, args.block, args.workers)
+    print(args.output, '-', len(verts), 'vertices', '-', len(faces), 'triangles', '-',
+          ' - '.join('%s %.2f s' % item for item in times.items()))
+
+
+if __name__ == '__main__':
+    main()
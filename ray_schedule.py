@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import psutil
+import ray
+
+logger = logging.getLogger(__name__)
+
+# per-item Ray scheduling for the preprocessing scripts: one task per patient instead of one chunk per CPU, so a slow
+# patient holds up only itself and idle workers pick up what is left. Submission is throttled by a cap on tasks in
+# flight and by the memory each task is expected to hold, results are collected as they finish (ray.wait) and appended
+# to a done file, so a restart skips finished patients and a failed one loses only its own work
+
+
+def load_done(done_file):
+    """{item: result} of an earlier run; a half-written last line (killed mid-write) is ignored"""
+    done = {}
+    if done_file and os.path.exists(done_file):
+        with open(done_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                done[record['item']] = record['result']
+    return done
+
+
+def in_flight_cap(task_bytes, num_cpus, reserve=1 << 30):
+    # enough tasks to keep every CPU busy plus one queued each, but never more volumes than fit in available memory
+    fit = (psutil.virtual_memory().available - reserve) // max(task_bytes, 1)
+    return int(max(1, min(2 * num_cpus, fit)))
+
+
+def run_tasks(remote_fn, items, args=(), max_in_flight=None, task_bytes=0, done_file=None, reserve=1 << 30):
+    """remote_fn.remote(item, *args) for every item not already in done_file, at most max_in_flight at a time and only
+    while `task_bytes` more fit in available memory. Returns ({item: result}, {item: error}); results include those
+    of earlier runs. Results must be JSON-serialisable to be persisted."""
+    done = load_done(done_file)
+    todo = [item for item in items if item not in done]
+    if max_in_flight is None:
+        max_in_flight = in_flight_cap(task_bytes, int(ray.available_resources().get('CPU', 1)), reserve)
+    logger.info(f"{len(items)} items, {len(done)} done earlier, {len(todo)} to run, at most {max_in_flight} in flight")
+
+    # memory= makes Ray's scheduler account for the volume too, so other tasks on the cluster see the reservation
+    options = {'memory': task_bytes} if task_bytes else {}
+    results, errors = dict(done), {}
+    pending = {}
+    todo.reverse()
+    out = open(done_file, 'a') if done_file else None
+    try:
+        while todo or pending:
+            # backpressure: submit while under the cap and the next volume fits; with nothing running, submit anyway
+            while todo and len(pending) < max_in_flight and (
+                    not pending or psutil.virtual_memory().available - reserve >= task_bytes):
+                item = todo.pop()
+                pending[remote_fn.options(**options).remote(item, *args)] = item
+
+            # the timeout rechecks memory while items are waiting for it
+            ready, _ = ray.wait(list(pending), num_returns=1, timeout=None if not todo else 5.0)
+            for ref in ready:
+                item = pending.pop(ref)
+                try:
+                    results[item] = ray.get(ref)
+                except Exception as e:
+                    errors[item] = str(e)
+                    logger.error(f"{item}: {str(e)}")
+                    continue
+                if out is not None:
+                    out.write(json.dumps({'item': item, 'result': results[item]}) + '\n')
+                    out.flush()
+    finally:
+        if out is not None:
+            out.close()
+    return results, errors
+
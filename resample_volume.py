@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+
+
+def composite_transform(in_shape, target_shape, spacing=None, new_spacing=None, align_corners=True):
+    """Per-axis (scale, offset) mapping an output index to an input index, computed once.
+
+    With new_spacing the output grid is physical (spacing / new_spacing, as resample() in
+    data_generation.py); otherwise it is fitted to target_shape. align_corners=True matches
+    scipy zoom, False matches skimage.transform.resize (pixel centres)."""
+    in_shape = np.asarray(in_shape, dtype=np.float64)
+    if new_spacing is not None:
+        factor = np.round(in_shape * np.asarray(spacing, dtype=np.float64) / np.asarray(new_spacing)) / in_shape
+        target_shape = np.round(in_shape * factor).astype(int)
+    target_shape = np.asarray(target_shape)
+
+    if align_corners:
+        scale = (in_shape - 1) / np.maximum(target_shape - 1, 1)
+        offset = np.zeros(3)
+    else:
+        scale = in_shape / target_shape
+        offset = 0.5 * scale - 0.5
+
+    out_spacing = None if spacing is None else np.asarray(spacing, dtype=np.float64) * scale
+    return tuple(int(n) for n in target_shape), scale, offset, out_spacing
+
+
+def resample_to_grid(image, target_shape=None, spacing=None, new_spacing=None, order=1, align_corners=True,
+                     anti_aliasing=False, mode='nearest', slab=16, workers=None):
+    """Resample a volume to its target grid in one pass, processing z-slabs in parallel.
+
+    Each slab reads only the input rows it needs (plus a margin for the spline prefilter and
+    anti-aliasing), so peak memory is the input, the float32 output and a few slabs."""
+    target_shape, scale, offset, out_spacing = composite_transform(image.shape, target_shape, spacing,
+                                                                   new_spacing, align_corners)
+    out = np.empty(target_shape, dtype=np.float32)
+
+    # skimage.transform.resize's anti-aliasing sigma for downsampled axes
+    sigma = np.maximum(0, (scale - 1) / 2) if anti_aliasing else np.zeros(3)
+    margin = int(np.ceil(4 * sigma[0])) + (12 if order > 1 else 2)
+
+    def run(z0):
+        z1 = min(z0 + slab, target_shape[0])
+        lo = int(np.floor(z0 * scale[0] + offset[0])) - margin
+        hi = int(np.ceil((z1 - 1) * scale[0] + offset[0])) + margin + 1
+        lo, hi = max(lo, 0), min(hi, image.shape[0])
+
+        part = image[lo:hi].astype(np.float32)
+        if anti_aliasing and np.any(sigma > 0):
+            part = ndimage.gaussian_filter(part, sigma, mode='mirror')
+
+        ndimage.affine_transform(part, scale, offset=[offset[0] + z0 * scale[0] - lo, offset[1], offset[2]],
+                                 output_shape=(z1 - z0,) + target_shape[1:], output=out[z0:z1], order=order,
+                                 mode=mode, prefilter=order > 1)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(run, range(0, target_shape[0], slab)))
+
+    return out, out_spacing
@@ -0,0 +1,197 @@
+import argparse
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aritra_project'))
+
+from filter_data import LIDCFilter
+from data_generation_kaggle import get_pixels_hu, get_spacing, resample_to_target_shape, normalize_volume, save_patient
+from drr_projector import project
+from manifest import view_suffix, load_manifest
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# one streaming pass from the raw LIDC tree to training records: filter_data.py, copy_filtered_data.py and
+# data_generation_kaggle.py read every series up to three times; here each series is read once and handed through
+#   read + filter -> HU conversion -> resample + normalize -> DRR -> save
+# with bounded queues between the stages, so different patients are in different stages at the same time and at most
+# `maxsize` volumes wait in front of each stage. Outputs match the three-script flow (same filter reports, CT .npy,
+# _info.txt and sample png) plus the validation DRRs and the dataset manifest
+
+_done = object()
+
+
+def run_pipeline(items, stages, maxsize=2):
+    """stages: [(name, fn, workers)]; fn(item) returns the item for the next stage or None to drop it"""
+    queues = [queue.Queue(maxsize) for _ in stages]
+    lock = threading.Lock()
+    remaining = [workers for _, _, workers in stages]
+    stats = {name: {'items': 0, 'dropped': 0, 'errors': 0, 'busy_s': 0.0} for name, _, _ in stages}
+
+    def worker(i):
+        name, fn, _ = stages[i]
+        while True:
+            item = queues[i].get()
+            if item is _done:
+                with lock:
+                    remaining[i] -= 1
+                    last = remaining[i] == 0
+                # the last worker out closes the next stage, after every sibling has handed on its items
+                if last and i + 1 < len(stages):
+                    for _ in range(stages[i + 1][2]):
+                        queues[i + 1].put(_done)
+                return
+
+            start = time.perf_counter()
+            try:
+                out = fn(item)
+            except Exception as e:
+                logger.error(f"{name}: {item if isinstance(item, str) else item['id']}: {str(e)}")
+                out = None
+                stats[name]['errors'] += 1
+            with lock:
+                stats[name]['busy_s'] += time.perf_counter() - start
+                stats[name]['items'] += 1
+                if out is None:
+                    stats[name]['dropped'] += 1
+
+            if out is not None and i + 1 < len(stages):
+                queues[i + 1].put(out)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True)
+               for i, (_, _, workers) in enumerate(stages) for _ in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0][2]):
+        queues[0].put(_done)
+    for t in threads:
+        t.join()
+
+    wall = time.perf_counter() - start
+    for s in stats.values():
+        s['utilisation'] = s['busy_s'] / wall if wall else 0.0
+    return wall, stats
+
+
+class StreamPreprocessor:
+    def __init__(self, input_folder, filter_folder, output_folder, target_shape=(256, 256, 256),
+                 views=('frontal', 'lateral', 'top')):
+        self.filter = LIDCFilter(input_folder, filter_folder)
+        self.output_folder = output_folder
+        self.target_shape = tuple(target_shape)
+        self.views = tuple(views)
+        self.processed_file = os.path.join(output_folder, 'processed_patients.txt')
+        self.lock = threading.Lock()
+        os.makedirs(output_folder, exist_ok=True)
+
+    def read(self, patient_id):
+        # the only pass over the DICOM files: filter_data.py's series choice and checks on the decoded slices
+        best_dir, slices = self.filter.load_patient(patient_id)
+        if not slices or not self.filter.check_patient(patient_id, best_dir, slices):
+            return None
+        return {'id': patient_id, 'slices': slices}
+
+    def hu(self, item):
+        slices = item.pop('slices')
+        item['spacing'] = get_spacing(slices)
+        item['pixels'] = get_pixels_hu(slices)
+        return item
+
+    def resample(self, item):
+        pixels = item.pop('pixels')
+        resampled_volume, resampled_spacing = resample_to_target_shape(pixels, self.target_shape, item['spacing'])
+        item['volume'], item['info'] = normalize_volume(pixels, resampled_volume, item['spacing'], resampled_spacing)
+        return item
+
+    def drr(self, item):
+        # the projections ImageData computes on the fly for training targets (lateral upright), through the torch
+        # projector: it releases the GIL, and numba's parallel kernels launched off the main thread hang at exit
+        item['drrs'] = [drr.numpy() for drr in project(item['volume'], self.views)]
+        return item
+
+    def save(self, item):
+        patient_id = item['id']
+        save_patient(patient_id, self.output_folder, item['volume'], item['info'])
+        for view, drr in zip(self.views, item['drrs']):
+            np.save(os.path.join(self.output_folder, patient_id, f"{patient_id}{view_suffix[view]}.npy"), drr)
+        with self.lock:
+            with open(self.processed_file, 'a') as f:
+                f.write(f"{patient_id}\n")
+        return item
+
+    def earlier_info(self, todo):
+        # patient_info.csv rows of earlier runs, minus the patients this run filtered again
+        path = os.path.join(self.filter.output_folder, 'patient_info.csv')
+        if not os.path.exists(path):
+            return []
+        replaced = set(todo) | {info['patient_id'] for info in self.filter.patient_info}
+        return [info for info in pd.read_csv(path).to_dict('records') if info['patient_id'] not in replaced]
+
+    def run(self, read_workers=2, resample_workers=1, drr_workers=1, maxsize=2):
+        patients = sorted(d for d in os.listdir(self.filter.input_folder) if d.startswith('LIDC-IDRI-'))
+
+        # resume: patients already saved by an earlier run are skipped; their rows in the filter reports are kept
+        processed = set()
+        if os.path.exists(self.processed_file):
+            with open(self.processed_file) as f:
+                processed = set(line.strip() for line in f)
+        todo = [p for p in patients if p not in processed]
+        logger.info(f"{len(patients)} patients, {len(todo)} to process")
+
+        stages = [
+            ('read', self.read, read_workers),
+            ('hu', self.hu, 1),
+            ('resample', self.resample, resample_workers),
+            ('drr', self.drr, drr_workers),
+            # matplotlib's pyplot is not thread-safe, so saving stays on one thread
+            ('save', self.save, 1),
+        ]
+        wall, stats = run_pipeline(todo, stages, maxsize)
+
+        self.filter.patient_info = self.earlier_info(todo) + self.filter.patient_info
+        self.filter.suitable_patients = sorted(info['patient_id'] for info in self.filter.patient_info)
+        self.filter.patient_info.sort(key=lambda info: info['patient_id'])
+        if self.filter.patient_info:
+            self.filter.save_results()
+
+        manifest = load_manifest(self.output_folder, rebuild=True)
+
+        saved = stats['save']['items'] - stats['save']['dropped']
+        logger.info(f"{saved}/{len(todo)} patients saved in {wall:.1f} s, {len(manifest['patients'])} in the manifest")
+        for name, s in stats.items():
+            logger.info(f"  {name:<9} {s['items']:5d} items  {s['dropped']:4d} dropped  {s['errors']:3d} errors  "
+                        f"busy {s['busy_s']:8.1f} s  ({100 * s['utilisation']:5.1f} % of wall time)")
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='./aritra_project/Data_LIDC/LIDC_IDRI')
+    parser.add_argument('--filter-output', default='./aritra_project/filtered_data')
+    parser.add_argument('--output', default='./aritra_project/dataset')
+    parser.add_argument('--target', type=int, nargs=3, default=[256, 256, 256])
+    parser.add_argument('--views', nargs='+', default=['frontal', 'lateral', 'top'])
+    parser.add_argument('--read-workers', type=int, default=2)
+    parser.add_argument('--resample-workers', type=int, default=1)
+    parser.add_argument('--drr-workers', type=int, default=1)
+    parser.add_argument('--queue-size', type=int, default=2)
+    args = parser.parse_args()
+
+    pipeline = StreamPreprocessor(args.input, args.filter_output, args.output, args.target, args.views)
+    pipeline.run(args.read_workers, args.resample_workers, args.drr_workers, args.queue_size)
+
+
+if __name__ == '__main__':
+    main()